@@ -0,0 +1,17 @@
+from argparse import ArgumentParser
+from datetime import date
+
+from src import archive
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Export closed days of station_status '
+                                        'to a Parquet archive')
+    parser.add_argument('--dir', default=archive.ARCHIVE_DIR,
+                        help='archive directory')
+    parser.add_argument('--since', type=date.fromisoformat, default=None,
+                        help='first day to export if the archive is empty '
+                             '(YYYY-MM-DD, default the oldest row)')
+    parser.add_argument('--until', type=date.fromisoformat, default=None,
+                        help='export days before this one (default today)')
+    args = parser.parse_args()
+    archive.main(args.dir, args.since, args.until)
@@ -0,0 +1,22 @@
+from argparse import ArgumentParser
+
+from src import backfill
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Load archived station_status '
+                                        'snapshots into the db')
+    parser.add_argument('path',
+                        help='directory or tarball of station_status '
+                             'json snapshots')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes to use (default: one per cpu)')
+    parser.add_argument('--batch-files', type=int, default=1000,
+                        help='snapshots to parse, diff and commit at a time')
+    parser.add_argument('--write-mode', default='copy',
+                        choices=('copy', 'values'))
+    parser.add_argument('--no-resume', action='store_true',
+                        help="don't start from the db's latest data "
+                             '(for archives older than what is loaded)')
+    args = parser.parse_args()
+    backfill.main(args.path, args.workers, args.batch_files, args.write_mode,
+                  resume=not args.no_resume)
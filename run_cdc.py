@@ -1,4 +1,42 @@
+from argparse import ArgumentParser
+
 from src import station_status_cdc
 
 if __name__ == '__main__':
-    station_status_cdc.main()
+    parser = ArgumentParser(description='Run station_status CDC')
+    parser.add_argument('--write-mode', default='orm',
+                        choices=station_status_cdc.WRITE_MODES,
+                        help='how changed rows are written to the db')
+    parser.add_argument('--group-commit', action='store_true',
+                        help='buffer rows across ticks and write them '
+                             'from a background thread')
+    parser.add_argument('--flush-rows', type=int, default=5000,
+                        help='with --group-commit, flush at this many rows')
+    parser.add_argument('--flush-age', type=float, default=30,
+                        help='with --group-commit, flush when the oldest '
+                             'buffered row is this many seconds old')
+    parser.add_argument('--max-batches', type=int, default=100,
+                        help='with --group-commit, ticks that can queue '
+                             'up before polling waits on the writer')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='time polls from the observed publish cadence '
+                             'instead of sleeping the ttl')
+    parser.add_argument('--gbfs', default=None,
+                        help="the system's gbfs.json url "
+                             '(capital bikeshare by default)')
+    parser.add_argument('--intervals', action='store_true',
+                        help='also keep station_status_interval '
+                             '(valid_from/valid_to rows) up to date')
+    parser.add_argument('--rollups', action='store_true',
+                        help='also keep the hourly availability rollups '
+                             '(station_status_hourly) up to date')
+    args = parser.parse_args()
+    station_status_cdc.main(write_mode=args.write_mode,
+                            group_commit=args.group_commit,
+                            flush_rows=args.flush_rows,
+                            flush_age=args.flush_age,
+                            max_batches=args.max_batches,
+                            adaptive=args.adaptive,
+                            discovery_url=args.gbfs,
+                            intervals=args.intervals,
+                            rollups=args.rollups)
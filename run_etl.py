@@ -1,4 +1,14 @@
+from argparse import ArgumentParser
+
 from src import bikeshare_etl
 
 if __name__ == '__main__':
-    bikeshare_etl.main()
+    parser = ArgumentParser(description='Load bikeshare dimensions')
+    parser.add_argument('--bulk', action='store_true',
+                        help='compare and load with one set based upsert '
+                             'per table instead of row by row')
+    parser.add_argument('--gbfs', default=None,
+                        help="the system's gbfs.json url "
+                             '(capital bikeshare by default)')
+    args = parser.parse_args()
+    bikeshare_etl.main(bulk=args.bulk, discovery_url=args.gbfs)
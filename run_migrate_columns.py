@@ -0,0 +1,4 @@
+from src.db import migrate_columns
+
+if __name__ == '__main__':
+    migrate_columns.main()
@@ -0,0 +1,4 @@
+from src.db import migrate_indexes
+
+if __name__ == '__main__':
+    migrate_indexes.main()
@@ -0,0 +1,24 @@
+from argparse import ArgumentParser
+
+from src import multi_cdc
+from src.station_status_cdc import WRITE_MODES
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run station_status CDC for '
+                                        'many GBFS systems at once')
+    parser.add_argument('systems',
+                        help='json file of {"name": "station_status url"}')
+    parser.add_argument('--write-mode', default='copy', choices=WRITE_MODES)
+    parser.add_argument('--pool-size', type=int, default=5,
+                        help='db connections shared by all systems')
+    parser.add_argument('--http-workers', type=int, default=20,
+                        help='feeds that can be fetched at the same time')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='time polls from each feed\'s observed '
+                             'publish cadence instead of its ttl')
+    args = parser.parse_args()
+    multi_cdc.main(args.systems,
+                   write_mode=args.write_mode,
+                   pool_size=args.pool_size,
+                   http_workers=args.http_workers,
+                   adaptive=args.adaptive)
@@ -0,0 +1,26 @@
+from argparse import ArgumentParser
+from datetime import datetime
+
+from src.db import partitions
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Create upcoming station_status '
+                                        'partitions and remove old ones')
+    parser.add_argument('--interval', choices=partitions.INTERVALS,
+                        default=partitions.PARTITION_INTERVAL,
+                        help='length of each partition')
+    parser.add_argument('--ahead', type=int, default=3,
+                        help='partitions to create past the current one')
+    parser.add_argument('--since', type=datetime.fromisoformat,
+                        default=None,
+                        help='also create partitions back to this date '
+                             '(YYYY-MM-DD), e.g. before a backfill')
+    parser.add_argument('--keep', type=int, default=None,
+                        help='remove partitions that ended more than this '
+                             'many intervals ago (default keeps all)')
+    parser.add_argument('--detach', action='store_true',
+                        help='detach expired partitions instead of '
+                             'dropping them')
+    args = parser.parse_args()
+    partitions.main(ahead=args.ahead, keep=args.keep, since=args.since,
+                    interval=args.interval, detach_only=args.detach)
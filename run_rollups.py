@@ -0,0 +1,16 @@
+from argparse import ArgumentParser
+from datetime import datetime
+
+from src import rollups
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Rebuild hourly station availability '
+                                        'rollups from station_status')
+    parser.add_argument('start', type=datetime.fromisoformat,
+                        help='first hour to rebuild (YYYY-MM-DD[THH])')
+    parser.add_argument('--end', type=datetime.fromisoformat, default=None,
+                        help='rebuild up to this hour (default now)')
+    parser.add_argument('--days', type=int, default=7,
+                        help='days rebuilt per transaction')
+    args = parser.parse_args()
+    rollups.main(args.start, args.end, args.days)
@@ -0,0 +1,206 @@
+''' src.archive
+
+    Parquet archive of station_status, for analysis without the database.
+
+    Each day of station_status is written to
+        <archive_dir>/date=YYYY-MM-DD/station_status.parquet
+    zstd compressed, with station_id dictionary encoded and timestamps
+    as int64 microseconds since the epoch (as in status_diff).
+    Rows are streamed out of postgres with a server-side cursor, so
+    memory use depends on batch_rows rather than the size of the range.
+
+    Only closed days (before today) are exported. manifest.json records
+    every exported day, so a repeat run starts where the last one
+    stopped. read_archive loads a time and station slice from the files
+    into numpy arrays.
+'''
+
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .models import Station_Status
+from .status_diff import COUNT_COLUMNS, NULL_COUNT, datetime_to_micros
+from .status_diff import column_sql, column_array
+from .utils import get_session, server_cursor
+
+
+ARCHIVE_DIR = 'archive/station_status'
+MANIFEST = 'manifest.json'
+FILE_NAME = 'station_status.parquet'
+
+COLUMNS = ('status_id',) + Station_Status.load_columns
+DAY_MICROS = 24 * 60 * 60 * 1000000
+
+SCHEMA = pa.schema([('status_id', pa.int64()),
+                    ('last_updated', pa.int64()),
+                    ('station_id', pa.int32()),
+                    ('num_bikes_available', pa.int16()),
+                    ('num_bikes_disabled', pa.int16()),
+                    ('num_docks_available', pa.int16()),
+                    ('num_docks_disabled', pa.int16()),
+                    ('is_installed', pa.bool_()),
+                    ('is_renting', pa.bool_()),
+                    ('is_returning', pa.bool_()),
+                    ('last_reported', pa.int64())])
+
+
+class Day_Writer():
+    ''' Writes one day's rows to its parquet file, batch by batch '''
+
+    def __init__(self, archive_dir, day):
+        self.day = day
+        self.path = os.path.join(archive_dir, f'date={day}', FILE_NAME)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # written under a temp name so a crash never leaves a file
+        # that looks finished
+        self.writer = pq.ParquetWriter(f'{self.path}.tmp', SCHEMA,
+                                       compression='zstd',
+                                       use_dictionary=['station_id'])
+        self.rows = 0
+
+    def write(self, cols):
+        self.writer.write_table(to_table(cols))
+        self.rows += len(cols['status_id'])
+
+    def close(self):
+        self.writer.close()
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+def to_table(cols):
+    ''' pyarrow Table from {column: array}, as status_diff.column_array
+        returns them '''
+    arrays = []
+    for name in COLUMNS:
+        values = cols[name]
+        if name in COUNT_COLUMNS:
+            missing = values == NULL_COUNT
+            values = pa.array(np.where(missing, 0, values).astype(np.int16),
+                              mask=missing)
+        arrays.append(pa.array(values, type=SCHEMA.field(name).type))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+
+def read_manifest(archive_dir):
+    try:
+        with open(os.path.join(archive_dir, MANIFEST), 'r') as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {'days': {}}
+
+
+def write_manifest(archive_dir, manifest):
+    path = os.path.join(archive_dir, MANIFEST)
+    with open(f'{path}.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def first_day(session):
+    ''' date of the oldest station_status row, or None '''
+    oldest = session.execute(
+        f'SELECT min(last_updated) FROM {Station_Status.__tablename__}'
+    ).scalar()
+    return oldest.date() if oldest is not None else None
+
+
+def export_days(session, archive_dir=ARCHIVE_DIR, since=None, until=None,
+                batch_rows=50000):
+    ''' Export each day from the day after the last exported one
+        (or since, or the oldest row) up to until (a date, exclusive,
+        default today). Days with no rows are recorded too, so they
+        aren't scanned again. Returns {day: rows} for the new days. '''
+    manifest = read_manifest(archive_dir)
+    until = until or datetime.now().date()
+    if manifest['days']:
+        start = datetime.strptime(max(manifest['days']), '%Y-%m-%d').date()
+        start += timedelta(days=1)
+    else:
+        start = since or first_day(session)
+    if start is None or start >= until:
+        return {}
+    os.makedirs(archive_dir, exist_ok=True)
+
+    cursor = server_cursor(session, 'archive', batch_rows)
+    cursor.execute(f'''SELECT {', '.join(map(column_sql, COLUMNS))}
+                       FROM {Station_Status.__tablename__}
+                       WHERE last_updated >= %s AND last_updated < %s
+                       ORDER BY last_updated, station_id''',
+                   (start, until))
+    exported = {}
+    writer = None
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        # still wall clock micros here, so these are local days
+        days = np.array(columns[COLUMNS.index('last_updated')],
+                        dtype=np.int64) // DAY_MICROS
+        cols = {col: column_array(col, values)
+                for col, values in zip(COLUMNS, columns)}
+        # a batch can span days, split it where the day changes
+        for number in np.unique(days).tolist():
+            first, end = np.searchsorted(days, [number, number + 1])
+            day = date(1970, 1, 1) + timedelta(days=number)
+            if writer is None or writer.day != day:
+                if writer is not None:
+                    writer.close()
+                    exported[str(writer.day)] = writer.rows
+                writer = Day_Writer(archive_dir, day)
+            writer.write({col: array[first:end]
+                          for col, array in cols.items()})
+    if writer is not None:
+        writer.close()
+        exported[str(writer.day)] = writer.rows
+    cursor.close()
+    session.commit()
+
+    day = start
+    while day < until:
+        rows = exported.get(str(day), 0)
+        manifest['days'][str(day)] = {
+            'file': f'date={day}/{FILE_NAME}' if rows else None,
+            'rows': rows}
+        day += timedelta(days=1)
+    manifest['exported'] = datetime.now().isoformat(sep=' ')
+    write_manifest(archive_dir, manifest)
+    return exported
+
+
+def read_archive(start, end, station_ids=None, archive_dir=ARCHIVE_DIR):
+    ''' Rows with start <= last_updated < end (datetimes) and, if given,
+        station_id in station_ids, as {column: numpy array} sorted by
+        last_updated and station_id. Timestamps are int64 microseconds.
+        Only reads the files in the manifest that cover the range. '''
+    manifest = read_manifest(archive_dir)
+    first, last = str(start.date()), str(end.date())
+    files = [os.path.join(archive_dir, entry['file'])
+             for day, entry in sorted(manifest['days'].items())
+             if entry['file'] is not None and first <= day <= last]
+    if not files:
+        table = SCHEMA.empty_table()
+        return {name: table.column(name).to_numpy() for name in COLUMNS}
+    filters = [('last_updated', '>=', datetime_to_micros(start)),
+               ('last_updated', '<', datetime_to_micros(end))]
+    if station_ids is not None:
+        filters.append(('station_id', 'in', list(station_ids)))
+    table = pq.read_table(files, filters=filters)
+    table = table.sort_by([('last_updated', 'ascending'),
+                           ('station_id', 'ascending')])
+    return {name: table.column(name).to_numpy() for name in COLUMNS}
+
+
+def main(archive_dir=ARCHIVE_DIR, since=None, until=None):
+    ''' Export new closed days from the dev db '''
+    session = get_session(role='read')
+    exported = export_days(session, archive_dir, since, until)
+    for day, rows in sorted(exported.items()):
+        print(f'{day}: {rows} rows')
+    print(f'exported {len(exported)} days to {archive_dir}')
+    session.close()
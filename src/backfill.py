@@ -0,0 +1,269 @@
+''' src.backfill
+
+    Load archived station_status.json snapshots into station_status.
+
+    Snapshots are the same shape as the API response (see tests/dummy*.json)
+    and are diffed with the same rules as the live CDC, so only changed
+    rows are loaded. Snapshots are put in last_updated order first
+    (file names don't always sort in time order). The work is split over
+    a process pool:
+        1. parse: snapshot files are decoded into numpy columns in parallel
+        2. diff: stations are split into partitions by station_id, and each
+           partition walks every snapshot in timestamp order, so the order
+           within a station is kept
+        3. load: changed rows from all partitions are bulk loaded
+           (COPY by default) one batch of snapshots at a time
+    Snapshots that can't be read or aren't newer than what's already
+    loaded, and rows for stations missing from station_information,
+    are skipped and counted in backfill's return value.
+'''
+
+import gzip
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .latest_state import Latest_Status, records_from_columns
+from .models import Station_Information
+from .status_diff import Status_Columns, decode_feed, to_micros
+from .station_status_cdc import get_latest_from_db, load_db
+from .utils import get_session
+
+
+# the feed's own last_updated. stations only have last_reported
+LAST_UPDATED = re.compile(rb'"last_updated"\s*:\s*(\d+)')
+
+
+def new_skipped():
+    return {'older': 0, 'bad': 0, 'unknown_station_rows': 0}
+
+
+def is_snapshot_name(name):
+    return name.endswith('.json') or name.endswith('.json.gz')
+
+
+def snapshot_time(name, raw):
+    ''' last_updated of a raw snapshot, found without decoding the
+        whole thing. None if there isn't one. '''
+    try:
+        if name.endswith('.gz'):
+            raw = gzip.decompress(raw)
+    except OSError:
+        return None
+    match = LAST_UPDATED.search(raw)
+    return int(match.group(1)) if match else None
+
+
+def file_time(path):
+    ''' snapshot_time of a file. Runs in the pool. '''
+    with open(path, 'rb') as snapshot_file:
+        return snapshot_time(path, snapshot_file.read())
+
+
+def list_snapshots(path, pool=None, skipped=None, work_dir=None):
+    ''' Return the snapshot files under path (a directory or a tarball),
+        sorted by their last_updated, then name.
+        A tarball is unpacked into work_dir first (a new temp dir if
+        None, the caller removes it).
+        Files without a last_updated are left out and counted in
+        skipped['bad'] (see new_skipped). pool is used to read the
+        files' last_updated. '''
+    if skipped is None:
+        skipped = new_skipped()
+    if os.path.isdir(path):
+        files = []
+        for root, _, names in os.walk(path):
+            files += [os.path.join(root, name) for name in names
+                      if is_snapshot_name(name)]
+        times = (pool.map(file_time, files, chunksize=64) if pool
+                 else map(file_time, files))
+        found = [(time, name) for time, name in zip(times, files)
+                 if time is not None]
+        skipped['bad'] += len(files) - len(found)
+        return [name for _, name in sorted(found)]
+    if tarfile.is_tarfile(path):
+        return list_snapshots(unpack_tarball(path, work_dir), pool, skipped)
+    raise ValueError(f'{path} should be a directory or a tarball')
+
+
+def unpack_tarball(path, work_dir=None):
+    ''' Copy the tarball's snapshots into files in work_dir, reading
+        the tarball once, front to back (a .tar.gz can't seek back
+        without decompressing from the start again). Files are numbered
+        in archive order, which breaks ties in list_snapshots.
+        Returns work_dir. '''
+    work_dir = work_dir or tempfile.mkdtemp(prefix='backfill_')
+    os.makedirs(work_dir, exist_ok=True)
+    with tarfile.open(path, 'r|*') as tar:
+        for i, member in enumerate(tar):
+            if member.isfile() and is_snapshot_name(member.name):
+                name = f'{i:08d}_{os.path.basename(member.name)}'
+                with open(os.path.join(work_dir, name), 'wb') as out:
+                    shutil.copyfileobj(tar.extractfile(member), out)
+    return work_dir
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as snapshot_file:
+        raw = snapshot_file.read()
+    if path.endswith('.gz'):
+        raw = gzip.decompress(raw)
+    return json.loads(raw)
+
+
+def parse_snapshot(path):
+    ''' Decode one snapshot. Returns (last_updated, Status_Columns)
+        with last_updated in microseconds, or None if the file isn't a
+        station_status snapshot. Runs in the pool. '''
+    try:
+        data = read_snapshot(path)
+        return to_micros(data['last_updated']), decode_feed(data)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f'skipping {path}: {e}')
+        return None
+
+
+def split_columns(cols, partitions):
+    ''' Split Status_Columns into one per partition (station_id % n) '''
+    part = cols.station_id % partitions
+    out = []
+    for p in range(partitions):
+        rows = (part == p).nonzero()[0]
+        counts = {col: array[rows] for col, array in cols.counts.items()}
+        flags = {col: array[rows] for col, array in cols.flags.items()}
+        out.append(Status_Columns(cols.station_id[rows], counts, flags,
+                                  cols.last_reported[rows]))
+    return out
+
+
+def split_snapshot(snapshot, partitions):
+    ''' Split a Latest_Status.snapshot() into one per partition '''
+    part = snapshot['station_id'] % partitions
+    return [{key: array[part == p] for key, array in snapshot.items()}
+            for p in range(partitions)]
+
+
+def diff_partition(snapshots, latest_snapshot):
+    ''' Walk one partition's snapshots (list of (last_updated, columns),
+        oldest first) and collect changed rows.
+        Returns (list of Status_Records, updated latest snapshot).
+        Runs in the pool. '''
+    latest = Latest_Status.restore(latest_snapshot)
+    out = []
+    for last_updated, cols in snapshots:
+        changed = latest.merge(cols, last_updated)
+        out += records_from_columns(cols, changed, last_updated)
+    return out, latest.snapshot()
+
+
+def batches(sources, size):
+    batch = []
+    for source in sources:
+        batch.append(source)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def diff_snapshots(sources, latest, pool, partitions, batch_files=1000,
+                   skipped=None):
+    ''' Parse and diff snapshots batch by batch.
+        latest is the Latest_Status to start from.
+        Yields a list of changed Status_Records for each batch.
+        Snapshots that aren't newer than the newest one already processed
+        (or already in latest) are skipped, so sources should be in
+        timestamp order (as list_snapshots returns them). Skipped and
+        unreadable snapshots are counted in skipped['older'] and
+        skipped['bad'] (see new_skipped). '''
+    if skipped is None:
+        skipped = new_skipped()
+    snapshot = latest.snapshot()
+    state = split_snapshot(snapshot, partitions)
+    newest = None
+    if len(snapshot['last_updated']) > 0:
+        newest = int(snapshot['last_updated'].max())
+    for batch in batches(sources, batch_files):
+        parsed = [snap for snap in pool.map(parse_snapshot, batch,
+                                            chunksize=16)
+                  if snap is not None]
+        skipped['bad'] += len(batch) - len(parsed)
+        parsed.sort(key=lambda snap: snap[0])
+        parts = [[] for _ in range(partitions)]
+        for last_updated, cols in parsed:
+            if newest is not None and last_updated <= newest:
+                skipped['older'] += 1
+                continue
+            newest = last_updated
+            for p, part_cols in enumerate(split_columns(cols, partitions)):
+                if len(part_cols) > 0:
+                    parts[p].append((last_updated, part_cols))
+        out = []
+        for p, (rows, snapshot) in enumerate(pool.map(diff_partition,
+                                                      parts, state)):
+            out += rows
+            state[p] = snapshot
+        out.sort(key=lambda row: (row.last_updated, row.station_id))
+        yield out
+
+
+def backfill(path, session, workers=None, batch_files=1000, mode='copy',
+             resume=True):
+    ''' Load every snapshot under path (directory or tarball).
+        With resume, diffing starts from the latest data already in the db
+        and older snapshots are skipped. Without it, diffing starts from
+        nothing, for archives from before the db's data.
+        A tarball is unpacked to a temp dir for the run.
+        Rows for stations that aren't in station_information would fail
+        its foreign key, they're skipped (load the dimensions first).
+        Each batch of snapshots is committed on its own.
+        mode is the load_db write mode (copy or values).
+        Returns {'rows': rows loaded, 'skipped': counts (see new_skipped),
+        'unknown_stations': sorted station_ids that were skipped}. '''
+    if mode not in ('copy', 'values'):
+        raise ValueError('backfill mode should be copy or values')
+    workers = workers or os.cpu_count()
+    if resume:
+        latest = get_latest_from_db(session)
+    else:
+        latest = Latest_Status()
+    known = {station_id for station_id, in
+             session.query(Station_Information.station_id)}
+    skipped = new_skipped()
+    unknown = set()
+    total = 0
+    with ProcessPoolExecutor(workers) as pool,\
+            tempfile.TemporaryDirectory(prefix='backfill_') as work_dir:
+        sources = list_snapshots(path, pool, skipped, work_dir)
+        for out in diff_snapshots(sources, latest, pool,
+                                  partitions=workers,
+                                  batch_files=batch_files,
+                                  skipped=skipped):
+            kept = [row for row in out if row.station_id in known]
+            if len(kept) < len(out):
+                skipped['unknown_station_rows'] += len(out) - len(kept)
+                unknown.update(row.station_id for row in out
+                               if row.station_id not in known)
+            if kept:
+                load_db(kept, session, mode)
+            total += len(kept)
+            print(f'loaded {len(kept)} rows ({total} total)')
+    return {'rows': total, 'skipped': skipped,
+            'unknown_stations': sorted(unknown)}
+
+
+def main(path, workers=None, batch_files=1000, mode='copy', resume=True):
+    session = get_session()
+    result = backfill(path, session, workers, batch_files, mode, resume)
+    skipped = result['skipped']
+    print(f"loaded {result['rows']} rows. skipped {skipped['older']} "
+          f"snapshots not newer than ones already loaded, "
+          f"{skipped['bad']} unreadable snapshots and "
+          f"{skipped['unknown_station_rows']} rows for stations not in "
+          f"station_information {result['unknown_stations']}")
+    session.close()
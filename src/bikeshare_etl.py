@@ -15,39 +15,66 @@ SQLAlchemy is used as an ORM
 import requests
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from time import perf_counter
 
+from sqlalchemy import text
 from sqlalchemy.orm import make_transient
 
 from .models import Station_Status, Station_Information
-from .models import System_Region, Dimension, Load_Metadata
+from .models import System_Region, Dimension, Load_Metadata, Load_Phase
+from .bulk_load import copy_rows
+from .timing import Phase_Timer
+from .registry import Feed_Registry, GBFS_DISCOVERY_URL, CACHE_FILE
+from .spatial import update_region_bounds
 from .utils import get_session
 
 
-def get_data(model, metadata):
+def get_data(model, metadata, registry=None, timer=None):
     ''' Lookup bikeshare data and return dict of objects like {id:obj}.
         Model should be one of the main data models in models.py
             ie System_Region or Station_Status
         Metadata should be an instance of a Load_Metadata object
         which will be updated with amount of source rows.
-        Whatever model is passed is the type of objects returned. '''
+        Whatever model is passed is the type of objects returned.
+        The feed url comes from registry (a Feed_Registry, capital
+        bikeshare's by default).
+        If a Phase_Timer is given, fetch, parse and transform
+        are timed on it. '''
+    registry = registry or Feed_Registry(cache_file=CACHE_FILE)
+    url = registry.feed_url(model.__tablename__)
+    try:
+        results = extract_data(model, metadata.load_id, url, timer)
+    except requests.RequestException:
+        # the url may have moved, look it up again next time
+        registry.invalidate()
+        raise
+    # update metadata
+    metadata.src_rows = len(results)
+    return results
+
+
+def extract_data(model, load_id, url, timer=None):
+    ''' The fetch and parse part of get_data. Doesn't touch the
+        session, metadata or registry, so it can run on another thread. '''
 
     results = {}
-    table_name = model.__tablename__
+    timer = timer or Phase_Timer()
 
     # model should only be subclasses of Dimension
     if not issubclass(model, Dimension):
         raise TypeError('model should be child of Dimension')
 
-    # build url using param
-    url = f'https://gbfs.capitalbikeshare.com/gbfs/en/{table_name}.json'
-
     # attempt to get url
-    response = requests.get(url)
+    with timer.phase('fetch') as fetch:
+        response = requests.get(url)
+        fetch.bytes = len(response.content)
     # if response is not good, raise error
     response.raise_for_status()
     # retrieve json and break into pieces needed
-    response_json = response.json()
+    with timer.phase('parse'):
+        response_json = response.json()
 
     # ensure data is as expected
     if len(response_json['data']) != 1:
@@ -64,39 +91,54 @@ def get_data(model, metadata):
     # get first (and only) value from data, which is list of dicts
     data = list(response_json['data'].values())[0]
     # create an object for each row pulled down
-    for row in data:
-        row = model(row)
-        row.load_id = metadata.load_id
-        results[row.id] = row
-    # update metadata
-    metadata.src_rows = len(results)
+    with timer.phase('transform') as transform:
+        for row in data:
+            row = model(row)
+            row.load_id = load_id
+            results[row.id] = row
+        transform.rows = len(results)
     print(f'{model.__name__}: extract done. {len(results)} rows of data')
     # return dictionary
     return results
 
 
-def compare_data(data, model, metadata, session):
+def refresh_hashes(data):
+    ''' row_hash is set when a record is parsed, recalc in case
+        attributes were changed since '''
+    for row in data.values():
+        row.row_hash = row.calc_row_hash()
+
+
+def compare_data(data, model, metadata, session, timer=None):
     ''' Compare data from API to current data in DB.
         If db data exists in new data but doesn't match: update.
         If db data doesn't exist in new data: insert.
         If db data exists and matches: do nothing
-        If nothing in db data: insert all '''
+        If nothing in db data: insert all
+        Rows are compared by row_hash, so only ids and hashes
+        are read from the db.
+        If a Phase_Timer is given, this is timed as compare. '''
+    timer = timer or Phase_Timer()
     upd_count = 0
-    # get all db objects with same id as new data
-    for match in session.query(model).filter(model.id.in_(data.keys())).all():
-        # if values in the row don't match, merge with new record
-        # != operator overridden to compare only certain attributes
-        if match != data[match.id]:
-            data[match.id].transtype = 'U'
-            session.merge(data.pop(match.id))
-            upd_count += 1
-        # if they do match, simply delete from data, since no change
-        else:
-            del(data[match.id])
-    # everything in data at this point is new inserts only
-    for insert in data:
-        data[insert].transtype = 'I'
-        session.add(data[insert])
+    with timer.phase('compare') as compare:
+        compare.rows = len(data)
+        refresh_hashes(data)
+        # get id and hash of db rows with same id as new data
+        matches = session.query(model.id, model.row_hash).\
+            filter(model.id.in_(data.keys())).all()
+        for match_id, match_hash in matches:
+            # if the hash doesn't match, merge with new record
+            if match_hash != data[match_id].row_hash:
+                data[match_id].transtype = 'U'
+                session.merge(data.pop(match_id))
+                upd_count += 1
+            # if they do match, simply delete from data, since no change
+            else:
+                del(data[match_id])
+        # everything in data at this point is new inserts only
+        for insert in data:
+            data[insert].transtype = 'I'
+            session.add(data[insert])
     # update metadata
     metadata.updates = upd_count
     metadata.inserts = len(session.new)
@@ -107,21 +149,195 @@ def compare_data(data, model, metadata, session):
           f'{metadata.updates} updates.')
 
 
-def etl(model, session):
-    ''' Get data, transform, update old if needed, insert new'''
+def upsert_sql(model, stage_name):
+    ''' INSERT ... ON CONFLICT from the staging table into model's table.
+        Conflicting rows are only updated when row_hash differs.
+        Selects (inserts, updates) using xmax, which is 0 for a row
+        this statement inserted. '''
+    table_name = model.__tablename__
+    key = model.__mapper__.primary_key[0].name
+    cols = ', '.join(model.load_columns)
+    updates = ', '.join(f'{col} = EXCLUDED.{col}'
+                        for col in model.load_columns if col != key)
+    return (f'''WITH upserted AS (
+                    INSERT INTO {table_name} AS t
+                        ({cols}, transtype, modified_by)
+                    SELECT {cols}, 'I', modified_by FROM {stage_name}
+                    ON CONFLICT ({key}) DO UPDATE
+                    SET {updates},
+                        transtype = 'U',
+                        modified_by = EXCLUDED.modified_by
+                    WHERE t.row_hash IS DISTINCT FROM EXCLUDED.row_hash
+                    RETURNING (t.xmax = 0) AS inserted)
+                SELECT count(*) FILTER (WHERE inserted),
+                       count(*) FILTER (WHERE NOT inserted)
+                FROM upserted''')
+
+
+def upsert_data(data, model, metadata, session, timer=None):
+    ''' Set based version of compare_data, same results.
+        COPY the new data into a temp staging table, then one
+        INSERT ... ON CONFLICT DO UPDATE writes new rows and changed rows
+        and leaves matching rows alone.
+        Takes a few statements no matter how many rows there are,
+        instead of a SELECT plus a merge per changed row.
+        If a Phase_Timer is given, this is timed as compare. '''
+    timer = timer or Phase_Timer()
+    stage_name = f'{model.__tablename__}_stage'
+    with timer.phase('compare') as compare:
+        compare.rows = len(data)
+        refresh_hashes(data)
+        session.execute(text(f'DROP TABLE IF EXISTS {stage_name}'))
+        session.execute(text(f'''CREATE TEMP TABLE {stage_name}
+                                 (LIKE {model.__tablename__})
+                                 ON COMMIT DROP'''))
+        copy_rows(data.values(), stage_name, model.load_columns, session)
+        inserts, updates = session.execute(
+            text(upsert_sql(model, stage_name))).first()
+    # update metadata
+    metadata.updates = updates
+    metadata.inserts = inserts
+    metadata.end_tstmp = datetime.now()
+    session.add(metadata)
+    print(f'{model.__name__}: upserted data.',
+          f'{metadata.inserts} inserts. ',
+          f'{metadata.updates} updates.')
+
+
+def etl(model, session, bulk=False, registry=None):
+    ''' Get data, transform, update old if needed, insert new.
+        With bulk, compare and load with upsert_data
+        instead of compare_data. '''
+    timer = Phase_Timer()
     metadata = Load_Metadata(model.__tablename__, session)
-    data = get_data(model, metadata)
-    compare_data(data, model, metadata, session)
-    session.commit()
+    data = get_data(model, metadata, registry, timer)
+    load_data(data, model, metadata, session, bulk, timer)
+
+
+# called as hook(model, metadata, session) after a load commits changes,
+# e.g. spatial.Station_Index.on_load
+LOAD_HOOKS = []
+
+
+def add_load_hook(hook):
+    LOAD_HOOKS.append(hook)
+
+
+def remove_load_hook(hook):
+    LOAD_HOOKS.remove(hook)
+
+
+def load_data(data, model, metadata, session, bulk=False, timer=None):
+    ''' Compare and load extracted data, then commit.
+        A station load also updates the region bounds.
+        The phases on timer are then saved as load_phase rows,
+        and LOAD_HOOKS are told if anything changed. '''
+    timer = timer or Phase_Timer()
+    if bulk:
+        upsert_data(data, model, metadata, session, timer)
+    else:
+        compare_data(data, model, metadata, session, timer)
+    changed = metadata.inserts + metadata.updates
+    if model is Station_Information and changed:
+        with timer.phase('bounds') as bounds:
+            bounds.rows = update_region_bounds(session)
+    with timer.phase('commit') as commit:
+        commit.rows = changed
+        session.commit()
+    save_phases(metadata, timer, session)
+    if changed:
+        for hook in LOAD_HOOKS:
+            hook(model, metadata, session)
     print(f'{model.__name__} load complete.')
     print(f'inserted {metadata.inserts} and updated {metadata.updates}')
+    print(f'{timer.report()}')
     print(f'see load_metadata table, load_id: {metadata.load_id}')
 
 
-def main():
+def save_phases(metadata, timer, session):
+    ''' Write a load_phase row per phase timed during the load.
+        Separate commit, so the commit phase can be included. '''
+    for phase in timer.phases.values():
+        metadata.phases.append(Load_Phase(phase))
+    session.commit()
+
+
+def load_order(models):
+    ''' Sort models so tables come after the tables their foreign keys
+        point to (ie System_Region before Station_Information).
+        Only FKs between the given models count. '''
+    tables = {model.__tablename__: model for model in models}
+    depends = {model: {fk.column.table.name
+                       for fk in model.__table__.foreign_keys} &
+               (set(tables) - {model.__tablename__})
+               for model in models}
+    ordered = []
+    done = set()
+    while len(ordered) < len(models):
+        ready = [model for model in models
+                 if model not in ordered and depends[model] <= done]
+        if not ready:
+            raise ValueError('foreign keys between models form a cycle')
+        for model in ready:
+            ordered.append(model)
+            done.add(model.__tablename__)
+    return ordered
+
+
+def run_etl(models, session, bulk=False, registry=None, workers=None):
+    ''' etl for several dimensions at once.
+        Every feed is fetched and parsed at the same time on a thread
+        pool. Loads run one at a time on the session, in foreign key
+        order, each starting as soon as its own feed is parsed (and
+        the tables it depends on are loaded).
+        So the whole run takes about as long as the slowest feed
+        plus the loads, not the sum of every fetch.
+        Returns {model name: {phase: seconds}}, where wait is how long
+        the load sat waiting on its feed. '''
+    start = perf_counter()
+    ordered = load_order(models)
+    # urls are looked up before the threads start,
+    # so only this thread touches the registry
+    registry = registry or Feed_Registry(cache_file=CACHE_FILE)
+    urls = {model: registry.feed_url(model.__tablename__)
+            for model in ordered}
+    # metadata rows need the session, so they're made up front here
+    metadatas = {model: Load_Metadata(model.__tablename__, session)
+                 for model in ordered}
+    # one timer per model, each is only used by one thread at a time
+    timers = {model: Phase_Timer() for model in ordered}
+    with ThreadPoolExecutor(workers or len(ordered)) as pool:
+        extracts = {model: pool.submit(extract_data, model,
+                                       metadatas[model].load_id,
+                                       urls[model], timers[model])
+                    for model in ordered}
+        for model in ordered:
+            with timers[model].phase('wait'):
+                try:
+                    data = extracts[model].result()
+                except requests.RequestException:
+                    registry.invalidate()
+                    raise
+            metadata = metadatas[model]
+            metadata.src_rows = len(data)
+            load_data(data, model, metadata, session, bulk, timers[model])
+    timings = {model.__name__: {name: phase.secs for name, phase
+                                in timers[model].phases.items()}
+               for model in ordered}
+    timings['total'] = {'total': perf_counter() - start}
+    for name, stages in timings.items():
+        print(f'{name}: ' + ', '.join(f'{stage} {secs:.2f}s'
+                                     for stage, secs in stages.items()))
+    return timings
+
+
+def main(bulk=False, discovery_url=None):
+    ''' Load the dimensions of the system whose gbfs.json is at
+        discovery_url (capital bikeshare by default) '''
     session = get_session(env="DEV")
-    etl(System_Region, session)
-    etl(Station_Information, session)
+    registry = Feed_Registry(discovery_url or GBFS_DISCOVERY_URL,
+                             cache_file=CACHE_FILE)
+    run_etl([System_Region, Station_Information], session, bulk, registry)
     session.close()
 
 
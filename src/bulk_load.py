@@ -0,0 +1,83 @@
+''' src.bulk_load
+
+    Bulk writers that skip the ORM unit of work.
+    Rows are pushed to postgres either with COPY FROM STDIN
+    or with a multi-row INSERT ... VALUES (executemany fallback).
+    Both run on the session's connection, so they share its transaction
+    and the caller is still responsible for commit.
+'''
+
+from io import StringIO
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+from sqlalchemy import select
+from sqlalchemy.sql.functions import current_user
+
+
+def get_raw_cursor(session):
+    ''' Return a psycopg2 cursor on the session's current connection.
+        Anything executed on it is part of the session's transaction. '''
+    return session.connection().connection.cursor()
+
+
+def get_current_user(session):
+    ''' COPY can't evaluate column defaults that only live in sqlalchemy
+        (like modified_by), so look up the value once per load. '''
+    return session.execute(select([current_user()])).scalar()
+
+
+def copy_value(value):
+    ''' Format one python value for postgres COPY text format '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    # escape characters that have meaning in COPY text format
+    return (str(value).replace('\\', '\\\\')
+                      .replace('\t', '\\t')
+                      .replace('\n', '\\n')
+                      .replace('\r', '\\r'))
+
+
+def copy_rows(rows, table_name, columns, session):
+    ''' Stream rows into table_name with COPY FROM STDIN.
+        rows is an iterable of objects with an attribute for each
+        name in columns. modified_by is filled with the current user.
+        Returns the number of rows copied. '''
+    user = copy_value(get_current_user(session))
+    buffer = StringIO()
+    count = 0
+    for row in rows:
+        values = [copy_value(getattr(row, col)) for col in columns]
+        values.append(user)
+        buffer.write('\t'.join(values) + '\n')
+        count += 1
+    if count == 0:
+        return 0
+    buffer.seek(0)
+    cols = ', '.join(columns + ('modified_by',))
+    cursor = get_raw_cursor(session)
+    cursor.copy_expert(f'COPY {table_name} ({cols}) FROM STDIN', buffer)
+    return count
+
+
+def insert_rows(rows, table_name, columns, session, page_size=1000):
+    ''' Insert rows into table_name with multi-row INSERT ... VALUES
+        statements of up to page_size rows each.
+        Fallback for when COPY isn't available (ie pgbouncer, proxies).
+        Returns the number of rows inserted. '''
+    values = [tuple(getattr(row, col) for col in columns) for row in rows]
+    if not values:
+        return 0
+    cols = ', '.join(columns + ('modified_by',))
+    template = '(' + ', '.join(['%s'] * len(columns)) + ', current_user)'
+    cursor = get_raw_cursor(session)
+    execute_values(cursor,
+                   f'INSERT INTO {table_name} ({cols}) VALUES %s',
+                   values,
+                   template=template,
+                   page_size=page_size)
+    return len(values)
@@ -2,27 +2,40 @@
     create all models in postgres db '''
 
 
-from os import environ
-
-from sqlalchemy import create_engine
+from os import path
 
+from .. import utils
 from ..models import Base, System_Region, Station_Information
-from ..models import Station_Status, Load_Metadata
+from ..models import Station_Status, Station_Status_Latest, Load_Metadata
+from ..models import Load_Phase, Cdc_Tick, Station_Status_Interval
+from ..models import Station_Status_Hourly
+from .partitions import create_partitions
 
 
 def get_engine():
-    pg_user = environ['POSTGRES_USER']
-    pg_pw = environ['POSTGRES_PW']
-    host = 'localhost'
-    port = '5432'
-    db = 'bikeshare'
+    return utils.get_engine('DEV')
+
 
-    return create_engine(f'postgres://{pg_user}:{pg_pw}@{host}:{port}/{db}')
+TRIGGERS_FILE = path.join(path.dirname(__file__), 'create_triggers.sql')
 
 
 def create_db():
     engine = get_engine()
     Base.metadata.create_all(engine)
+    create_triggers(engine)
+    with engine.begin() as connection:
+        create_partitions(connection)
+
+
+def create_triggers(engine):
+    ''' install the modified_by triggers. safe to rerun, it replaces
+        whatever version of them is already there '''
+    with open(TRIGGERS_FILE, 'r') as sql_file:
+        statements = sql_file.read().split('\n\n')
+    with engine.begin() as connection:
+        for sql in statements:
+            if sql.strip():
+                connection.execute(sql)
 
 
 def main():
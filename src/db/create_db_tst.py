@@ -2,40 +2,25 @@
     create all models in postgres db '''
 
 
-from os import environ
-
-from sqlalchemy import create_engine
-
+from .. import utils
 from ..models import Base, System_Region, Station_Information
-from ..models import Station_Status, Load_Metadata
-from ..utils import get_session
+from ..models import Station_Status, Station_Status_Latest, Load_Metadata
+from ..models import Load_Phase, Cdc_Tick, Station_Status_Interval
+from ..models import Station_Status_Hourly
+from .create_db import create_triggers
+from .partitions import create_partitions
 
 
 def get_engine():
-    pg_user = environ['POSTGRES_USER_TST']
-    pg_pw = environ['POSTGRES_PW_TST']
-    host = 'localhost'
-    port = '5432'
-    db = 'bikeshare_tst'
-
-    return create_engine(f'postgres://{pg_user}:{pg_pw}@{host}:{port}/{db}')
+    return utils.get_engine('TST')
 
 
 def create_db():
     engine = get_engine()
     Base.metadata.create_all(engine)
-    create_triggers()
-
-
-def create_triggers():
-    with open('src/db/create_triggers.sql', 'r') as sql_file:
-        statements = sql_file.read().split('\n\n')
-    session = get_session(env='TST')
-    connection = session.connection()
-    for sql in statements:
-        connection.execute(sql)
-    session.commit()
-    session.close()
+    create_triggers(engine)
+    with engine.begin() as connection:
+        create_partitions(connection)
 
 
 def drop_all_tables():
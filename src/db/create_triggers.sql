@@ -1,47 +1,32 @@
-CREATE OR REPLACE FUNCTION update_user_load_metadata() RETURNS trigger AS $update_user_load_metadata$
+-- the old AFTER triggers ran a second UPDATE per row to set modified_by
+DROP FUNCTION IF EXISTS update_user_load_metadata() CASCADE;
+
+DROP FUNCTION IF EXISTS update_user_system_regions() CASCADE;
+
+DROP FUNCTION IF EXISTS update_user_station_information() CASCADE;
+
+CREATE OR REPLACE FUNCTION set_modified_by() RETURNS trigger AS $set_modified_by$
 	BEGIN
-		-- check is row was midified by a different user
-		IF (new.modified_by != current_user) THEN
-			UPDATE load_metadata
-			SET modified_by = current_user
-			WHERE load_id = NEW.load_id;
-		END IF;
-		RETURN NULL; -- result is ignored since this is an AFTER trigger
+		-- set on the row being written, so no second update is needed
+		NEW.modified_by := current_user;
+		RETURN NEW;
 	END;
-$update_user_load_metadata$ LANGUAGE plpgsql;
+$set_modified_by$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS load_metadata_user ON load_metadata;
 
 CREATE TRIGGER load_metadata_user
-AFTER UPDATE ON load_metadata
-	FOR EACH ROW EXECUTE PROCEDURE update_user_load_metadata();
+BEFORE UPDATE ON load_metadata
+	FOR EACH ROW EXECUTE PROCEDURE set_modified_by();
 
-CREATE OR REPLACE FUNCTION update_user_system_regions() RETURNS trigger AS $update_user_system_regions$
-	BEGIN
-		-- check is row was midified by a different user
-		IF (new.modified_by != current_user) THEN
-			UPDATE system_regions
-			SET modified_by = current_user
-			WHERE region_id = NEW.region_id;
-		END IF;
-		RETURN NULL; -- result is ignored since this is an AFTER trigger
-	END;
-$update_user_system_regions$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS system_regions_user_update ON system_regions;
 
 CREATE TRIGGER system_regions_user_update
-AFTER UPDATE ON system_regions
-	FOR EACH ROW EXECUTE PROCEDURE update_user_system_regions();
+BEFORE UPDATE ON system_regions
+	FOR EACH ROW EXECUTE PROCEDURE set_modified_by();
 
-CREATE OR REPLACE FUNCTION update_user_station_information() RETURNS trigger AS $update_user_station_information$
-	BEGIN
-		-- check is row was midified by a different user
-		IF (new.modified_by != current_user) THEN
-			UPDATE station_information
-			SET modified_by = current_user
-			WHERE station_id = NEW.station_id;
-		END IF;
-		RETURN NULL; -- result is ignored since this is an AFTER trigger
-	END;
-$update_user_station_information$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS station_information_user_update ON station_information;
 
 CREATE TRIGGER station_information_user_update
-AFTER UPDATE ON station_information
-	FOR EACH ROW EXECUTE PROCEDURE update_user_station_information();
\ No newline at end of file
+BEFORE UPDATE ON station_information
+	FOR EACH ROW EXECUTE PROCEDURE set_modified_by();
@@ -0,0 +1,60 @@
+''' src.db.migrate_columns
+
+    Add the columns declared on the models to an existing database,
+    e.g. system_regions' min/max lat and lon.
+
+    Only nullable columns are added, with ALTER TABLE ... ADD COLUMN
+    IF NOT EXISTS, which is cheap (no table rewrite) and safe to rerun.
+    A missing NOT NULL column would need a value for the rows already
+    there, so it's reported instead. Tables that don't exist yet are
+    left to create_db.
+'''
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateColumn
+
+from ..models import Base
+from ..utils import get_engine
+
+
+def get_columns(connection, table):
+    ''' names of table's columns, empty if there's no such table '''
+    return {row[0] for row in connection.execute(text(
+        '''SELECT column_name FROM information_schema.columns
+           WHERE table_schema = current_schema()
+           AND table_name = :table'''), table=table)}
+
+
+def column_sql(column):
+    ''' ADD COLUMN for column, as create_db would declare it '''
+    ddl = CreateColumn(column).compile(dialect=postgresql.dialect())
+    return (f'ALTER TABLE {column.table.name} '
+            f'ADD COLUMN IF NOT EXISTS {ddl}')
+
+
+def migrate_columns(engine):
+    ''' Add the model columns the database is missing.
+        Returns the names (table.column) of the columns added. '''
+    added = []
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = get_columns(connection, table.name)
+            if not existing:
+                continue
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    print(f'{table.name}.{column.name} is missing and '
+                          'NOT NULL, add it by hand')
+                    continue
+                connection.execute(column_sql(column))
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def main():
+    engine = get_engine()
+    for name in migrate_columns(engine):
+        print(f'added {name}')
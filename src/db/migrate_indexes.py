@@ -0,0 +1,169 @@
+''' src.db.migrate_indexes
+
+    Build the indexes declared on the models in an existing database,
+    without blocking the CDC's inserts.
+
+    Each missing index is built with CREATE INDEX CONCURRENTLY. A
+    partitioned table can't build concurrently, so its index is
+    declared ON ONLY the parent, built concurrently on each partition,
+    and the partition indexes attached (the parent's index becomes
+    valid once every partition has one). Builds that failed part way
+    are dropped and redone. Indexes the models no longer declare are
+    dropped at the end.
+
+    station_status never had its unique key enforced, so duplicate
+    (station_id, last_updated) rows are removed first.
+'''
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from ..models import Station_Status, Station_Status_Latest
+from ..models import Station_Information, System_Region
+from ..utils import get_engine
+
+
+MODELS = (Station_Status, Station_Information, System_Region)
+
+# replaced by station_status_station_lu_key
+OBSOLETE_INDEXES = ('station_status_station_lu_idx',)
+
+
+def index_sql(index, name=None, table=None, only=False):
+    ''' CREATE INDEX for index, renamed and on another table if given.
+        Concurrent unless only (ON ONLY a partitioned parent). '''
+    sql = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+    target = f'INDEX {index.name} ON {index.table.name}'
+    if only:
+        replacement = f'INDEX {index.name} ON ONLY {index.table.name}'
+    else:
+        replacement = (f'INDEX CONCURRENTLY {name or index.name} '
+                       f'ON {table or index.table.name}')
+    return sql.replace(target, replacement)
+
+
+def get_index(connection, name):
+    ''' (valid, table) of the index, or None if it doesn't exist '''
+    return connection.execute(text(
+        '''SELECT i.indisvalid, t.relname FROM pg_index i
+           JOIN pg_class c ON c.oid = i.indexrelid
+           JOIN pg_class t ON t.oid = i.indrelid
+           WHERE c.relname = :name'''), name=name).fetchone()
+
+
+def is_partitioned(connection, table):
+    return connection.execute(text(
+        "SELECT relkind = 'p' FROM pg_class WHERE relname = :table"),
+        table=table).scalar()
+
+
+def get_partitions(connection, table):
+    return [row[0] for row in connection.execute(text(
+        '''SELECT c.relname FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = CAST(:table AS regclass)
+           ORDER BY c.relname'''), table=table)]
+
+
+def is_attached(connection, child, parent):
+    return connection.execute(text(
+        '''SELECT EXISTS (SELECT 1 FROM pg_inherits
+                          WHERE inhrelid = CAST(:child AS regclass)
+                          AND inhparent = CAST(:parent AS regclass))'''),
+        child=child, parent=parent).scalar()
+
+
+def build_index(connection, index):
+    ''' Build one index concurrently if it's missing or invalid.
+        connection must be in autocommit. Returns True if built. '''
+    table = index.table.name
+    existing = get_index(connection, index.name)
+    if not is_partitioned(connection, table):
+        if existing is not None and existing[0]:
+            return False
+        connection.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}')
+        connection.execute(index_sql(index))
+        return True
+    if existing is not None and existing[0]:
+        return False
+    if existing is None:
+        connection.execute(index_sql(index, only=True))
+    for partition in get_partitions(connection, table):
+        # station_status_p20240101 -> <index name>_p20240101
+        name = f'{index.name}_{partition[len(table) + 1:]}'[:63]
+        child = get_index(connection, name)
+        if child is not None and not child[0]:
+            connection.execute(f'DROP INDEX CONCURRENTLY {name}')
+            child = None
+        if child is None:
+            connection.execute(index_sql(index, name, partition))
+        if not is_attached(connection, name, index.name):
+            connection.execute(
+                f'ALTER INDEX {index.name} ATTACH PARTITION {name}')
+    return True
+
+
+def delete_duplicates(connection):
+    ''' Remove repeated (station_id, last_updated) station_status rows,
+        keeping the newest insert. station_status_latest rows pointing
+        at a removed copy are moved to the kept one first, so they
+        don't cascade away. Returns the number of rows deleted. '''
+    status = Station_Status.__tablename__
+    latest = Station_Status_Latest.__tablename__
+    duplicates = f'''SELECT station_id, last_updated,
+                            max(status_id) AS keep_id
+                     FROM {status}
+                     GROUP BY station_id, last_updated
+                     HAVING count(*) > 1'''
+    with connection.begin():
+        connection.execute(
+            f'''UPDATE {latest} l SET status_id = d.keep_id
+                FROM ({duplicates}) d
+                WHERE l.station_id = d.station_id
+                AND l.last_updated = d.last_updated
+                AND l.status_id <> d.keep_id''')
+        result = connection.execute(
+            f'''DELETE FROM {status} s
+                USING ({duplicates}) d
+                WHERE s.station_id = d.station_id
+                AND s.last_updated = d.last_updated
+                AND s.status_id <> d.keep_id''')
+    return result.rowcount
+
+
+def migrate_indexes(engine):
+    ''' Bring the database's indexes in line with the models.
+        Returns the names of the indexes built. '''
+    built = []
+    with engine.connect() as connection:
+        key = get_index(connection, 'station_status_station_lu_key')
+        if key is None or not key[0]:
+            deleted = delete_duplicates(connection)
+            if deleted:
+                print(f'deleted {deleted} duplicate station_status rows')
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        for model in MODELS:
+            for index in sorted(model.__table__.indexes,
+                                key=lambda index: index.name):
+                print(f'checking {index.name}')
+                if build_index(connection, index):
+                    built.append(index.name)
+        for name in OBSOLETE_INDEXES:
+            existing = get_index(connection, name)
+            if existing is None:
+                continue
+            if is_partitioned(connection, existing[1]):
+                # parent indexes can't be dropped concurrently
+                connection.execute(f'DROP INDEX {name}')
+            else:
+                connection.execute(f'DROP INDEX CONCURRENTLY {name}')
+            print(f'dropped {name}')
+    return built
+
+
+def main():
+    engine = get_engine()
+    for name in migrate_indexes(engine):
+        print(f'built {name}')
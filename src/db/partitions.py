@@ -0,0 +1,187 @@
+''' src.db.partitions
+
+    station_status is range partitioned on last_updated, one partition
+    per month (or week). Queries on a window of last_updated only read
+    the partitions in it, and old history is removed by dropping (or
+    detaching) whole partitions instead of deleting rows.
+
+    Rows outside every partition go to station_status_default, so an
+    insert never fails for lack of a partition. create_partitions makes
+    the partitions ahead of time and moves anything already sitting in
+    the default partition into the new one.
+
+    Run from cron with run_partitions.py.
+'''
+
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from ..models import Station_Status, Station_Status_Latest
+from ..utils import get_engine
+
+
+INTERVALS = ('month', 'week')
+PARTITION_INTERVAL = 'month'
+
+PARENT = Station_Status.__tablename__
+DEFAULT_PARTITION = f'{PARENT}_default'
+
+BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def period_start(day, interval=PARTITION_INTERVAL):
+    ''' start of the month (or monday of the week) day is in '''
+    if interval == 'month':
+        return datetime(day.year, day.month, 1)
+    if interval == 'week':
+        monday = day - timedelta(days=day.weekday())
+        return datetime(monday.year, monday.month, monday.day)
+    raise ValueError(f'interval should be one of {INTERVALS}')
+
+
+def next_start(start, interval=PARTITION_INTERVAL):
+    if interval == 'month':
+        if start.month == 12:
+            return datetime(start.year + 1, 1, 1)
+        return datetime(start.year, start.month + 1, 1)
+    return start + timedelta(days=7)
+
+
+def shift(start, periods, interval=PARTITION_INTERVAL):
+    ''' period start periods before (negative) or after start '''
+    if interval == 'month':
+        months = start.year * 12 + start.month - 1 + periods
+        return datetime(months // 12, months % 12 + 1, 1)
+    return start + timedelta(days=7 * periods)
+
+
+def partition_name(start):
+    return f'{PARENT}_p{start:%Y%m%d}'
+
+
+def get_partitions(connection):
+    ''' [(name, start, end)] of the range partitions, oldest first.
+        The default partition isn't included. '''
+    rows = connection.execute(text(
+        '''SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+           FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = CAST(:parent AS regclass)'''),
+        parent=PARENT).fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = BOUNDS.search(bound)
+        if match:
+            start, end = (datetime.fromisoformat(value)
+                          for value in match.groups())
+            partitions.append((name, start, end))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_default_partition(connection):
+    connection.execute(f'''CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION}
+                           PARTITION OF {PARENT} DEFAULT''')
+
+
+def create_partition(connection, start, end):
+    ''' Add the partition for [start, end). Rows for that range in the
+        default partition are moved into it, with the
+        station_status_latest rows that point at them (deleting them
+        from the default partition would cascade). '''
+    name = partition_name(start)
+    in_range = 'last_updated >= :start AND last_updated < :end'
+    bounds = {'start': start, 'end': end}
+    moving = connection.execute(text(
+        f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range})'),
+        **bounds).scalar()
+    if moving:
+        latest = Station_Status_Latest.__tablename__
+        connection.execute(
+            f'''CREATE TEMP TABLE moved_status
+                (LIKE {PARENT}) ON COMMIT DROP''')
+        connection.execute(
+            f'''CREATE TEMP TABLE moved_latest
+                (LIKE {latest}) ON COMMIT DROP''')
+        connection.execute(text(
+            f'''INSERT INTO moved_latest
+                SELECT * FROM {latest} WHERE {in_range}'''), **bounds)
+        connection.execute(text(
+            f'''WITH moved AS (DELETE FROM {DEFAULT_PARTITION}
+                               WHERE {in_range} RETURNING *)
+                INSERT INTO moved_status SELECT * FROM moved'''), **bounds)
+    connection.execute(text(
+        f'''CREATE TABLE {name} PARTITION OF {PARENT}
+            FOR VALUES FROM (:start) TO (:end)'''), **bounds)
+    if moving:
+        connection.execute(f'INSERT INTO {PARENT} SELECT * FROM moved_status')
+        connection.execute(f'INSERT INTO {latest} SELECT * FROM moved_latest')
+        connection.execute('DROP TABLE moved_status, moved_latest')
+    return name
+
+
+def create_partitions(connection, ahead=3, since=None,
+                      interval=PARTITION_INTERVAL, now=None):
+    ''' Make sure there is a partition for every period from since
+        (default: now) through ahead periods after now, plus the
+        default partition. Periods overlapping an existing partition
+        (e.g. after switching interval) are left to the default.
+        Returns the names of the new partitions. '''
+    now = now or datetime.now()
+    create_default_partition(connection)
+    existing = [(start, end) for _, start, end in get_partitions(connection)]
+    start = period_start(since or now, interval)
+    last = shift(period_start(now, interval), ahead, interval)
+    created = []
+    while start <= last:
+        end = next_start(start, interval)
+        if not any(start < e and s < end for s, e in existing):
+            created.append(create_partition(connection, start, end))
+        start = end
+    return created
+
+
+def drop_expired(connection, keep, interval=PARTITION_INTERVAL,
+                 detach_only=False, now=None):
+    ''' Drop partitions that ended before the last keep periods.
+        With detach_only they're detached and left as plain tables
+        (to archive or drop later). station_status_latest rows
+        pointing into them are deleted first, as a row delete would.
+        Returns the names of the partitions removed. '''
+    now = now or datetime.now()
+    cutoff = shift(period_start(now, interval), -keep, interval)
+    latest = Station_Status_Latest.__tablename__
+    removed = []
+    for name, start, end in get_partitions(connection):
+        if end > cutoff:
+            continue
+        connection.execute(text(
+            f'''DELETE FROM {latest}
+                WHERE last_updated >= :start AND last_updated < :end'''),
+            start=start, end=end)
+        connection.execute(f'ALTER TABLE {PARENT} DETACH PARTITION {name}')
+        if not detach_only:
+            connection.execute(f'DROP TABLE {name}')
+        removed.append(name)
+    return removed
+
+
+def maintain(engine, ahead=3, keep=None, since=None,
+             interval=PARTITION_INTERVAL, detach_only=False):
+    ''' create upcoming partitions and remove expired ones,
+        each in its own transaction '''
+    with engine.begin() as connection:
+        for name in create_partitions(connection, ahead, since, interval):
+            print(f'created {name}')
+    if keep is not None:
+        with engine.begin() as connection:
+            for name in drop_expired(connection, keep, interval,
+                                     detach_only):
+                print(f'{"detached" if detach_only else "dropped"} {name}')
+
+
+def main(ahead=3, keep=None, since=None, interval=PARTITION_INTERVAL,
+         detach_only=False):
+    engine = get_engine()
+    maintain(engine, ahead, keep, since, interval, detach_only)
@@ -0,0 +1,89 @@
+''' src.feeds
+
+    Fetching GBFS feeds without redoing work for versions we've seen.
+
+    Most ticks overnight return the same version of the feed again.
+    fetch_feed skips it as early as it can:
+        - a 304 when the server honours If-None-Match/If-Modified-Since
+        - the same md5 of the raw body as the last fetch, before decoding
+        - a last_updated that isn't newer than the last one we used
+    and counts why in Feed_State.skips.
+
+    A new version only counts as seen once the caller has loaded it
+    and passed it to Feed_State.accept. If the load fails, the same
+    version is fetched and tried again.
+'''
+
+from hashlib import md5
+
+import requests
+
+from .timing import Phase_Timer
+
+
+class Feed_State():
+    ''' What we know about the last version of one feed we used '''
+
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.fingerprint = None
+        self.last_updated = None
+        self.ttl = None
+        self.fetches = 0
+        self.skips = {'not_modified': 0, 'same_payload': 0, 'stale': 0}
+
+    def headers(self):
+        ''' conditional request headers for the next fetch '''
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def skipped(self):
+        return sum(self.skips.values())
+
+    def accept(self, version):
+        ''' Remember a version returned by fetch_feed, once it's loaded '''
+        if version is None:
+            return
+        for key, value in version.items():
+            setattr(self, key, value)
+
+
+def fetch_feed(url, state, http=requests, timer=None):
+    ''' Get a feed. Returns (decoded json, version), or (None, None) if
+        it's a version state has already seen. Pass version to
+        state.accept after the data is loaded.
+        http can be a requests.Session.
+        If a Phase_Timer is given, fetch and parse are timed on it. '''
+    timer = timer or Phase_Timer()
+    with timer.phase('fetch') as fetch:
+        response = http.get(url, headers=state.headers())
+        fetch.bytes = len(response.content)
+    state.fetches += 1
+    if response.status_code == 304:
+        state.skips['not_modified'] += 1
+        return None, None
+    response.raise_for_status()
+    fingerprint = md5(response.content).hexdigest()
+    if fingerprint == state.fingerprint:
+        state.skips['same_payload'] += 1
+        return None, None
+    with timer.phase('parse'):
+        data = response.json()
+    version = {'etag': response.headers.get('ETag'),
+               'last_modified': response.headers.get('Last-Modified'),
+               'fingerprint': fingerprint}
+    if state.last_updated is not None and\
+            data['last_updated'] <= state.last_updated:
+        # new bytes, but not a newer version (e.g. another cdn node).
+        # nothing to load, so these bytes count as seen now
+        state.accept(version)
+        state.skips['stale'] += 1
+        return None, None
+    version['last_updated'] = data['last_updated']
+    version['ttl'] = data['ttl']
+    return data, version
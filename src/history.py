@@ -0,0 +1,91 @@
+''' src.history
+
+    Read station_status history in fixed size chunks.
+
+    read_history streams rows through a server-side cursor and yields
+    numpy structured arrays of at most chunk_rows rows, so memory stays
+    the same however much history is asked for (unlike
+    Station_Information.station_statuses, which builds an ORM object
+    per row). Columns can be projected, and the time range and
+    stations are filtered in the query, so postgres skips the
+    partitions and index ranges outside them.
+
+    Timestamps are int64 microseconds since the epoch and missing
+    counts are NULL_COUNT, as in status_diff.
+'''
+
+import numpy as np
+
+from .models import Station_Status
+from .status_diff import COUNT_COLUMNS, FLAG_COLUMNS
+from .status_diff import column_sql, column_array
+from .utils import server_cursor
+
+
+DTYPES = {'status_id': np.int64,
+          'station_id': np.int64,
+          'last_updated': np.int64,
+          'last_reported': np.int64}
+DTYPES.update((col, np.float64) for col in COUNT_COLUMNS)
+DTYPES.update((col, np.bool_) for col in FLAG_COLUMNS)
+COLUMNS = ('status_id',) + Station_Status.load_columns
+
+
+def history_dtype(columns=COLUMNS):
+    unknown = set(columns) - set(COLUMNS)
+    if unknown:
+        raise ValueError(f'unknown station_status columns: {sorted(unknown)}')
+    return np.dtype([(col, DTYPES[col]) for col in columns])
+
+
+def to_array(rows, dtype):
+    ''' Structured array of dtype from rows in dtype's field order '''
+    chunk = np.empty(len(rows), dtype=dtype)
+    for col, values in zip(dtype.names, zip(*rows)):
+        chunk[col] = column_array(col, values)
+    return chunk
+
+
+def read_history(session, station_ids=None, start=None, end=None,
+                 columns=COLUMNS, chunk_rows=10000):
+    ''' Yield structured arrays of the station_status rows of
+        station_ids (default all) with start <= last_updated < end
+        (either can be None), ordered by station_id and last_updated.
+        columns picks the fields. Runs on the session's transaction,
+        read the generator to the end or close it. '''
+    dtype = history_dtype(columns)
+    conditions = []
+    params = []
+    if station_ids is not None:
+        conditions.append('station_id = ANY(%s)')
+        params.append(list(station_ids))
+    if start is not None:
+        conditions.append('last_updated >= %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('last_updated < %s')
+        params.append(end)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    cursor = server_cursor(session, 'history', chunk_rows)
+    try:
+        cursor.execute(f'''SELECT {', '.join(map(column_sql, columns))}
+                           FROM {Station_Status.__tablename__}
+                           {where}
+                           ORDER BY station_id, last_updated''', params)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield to_array(rows, dtype)
+    finally:
+        cursor.close()
+
+
+def read_station(session, station_id, start=None, end=None,
+                 columns=COLUMNS):
+    ''' One station's history as a single structured array '''
+    chunks = list(read_history(session, [station_id], start, end, columns))
+    if not chunks:
+        return np.empty(0, dtype=history_dtype(columns))
+    return np.concatenate(chunks)
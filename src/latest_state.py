@@ -0,0 +1,253 @@
+''' src.latest_state
+
+    In-memory latest status of every station, used by the CDC loop
+    in place of a dict of Station_Status objects.
+
+    Values live in parallel typed numpy arrays, one slot per station,
+    so a long running process holds a handful of arrays instead of an
+    ORM object (and its sqlalchemy instance state) per station.
+'''
+
+import numpy as np
+
+from .status_diff import Status_Columns, COUNT_COLUMNS, FLAG_COLUMNS
+from .status_diff import NULL_COUNT, count_value, changed_mask
+from .status_diff import datetime_to_micros, micros_to_datetime
+
+
+class Status_Record():
+    ''' Lightweight, read only copy of one station's latest status.
+        Has the same attributes Station_Status.__eq__ looks at,
+        so the two can be compared with == either way round. '''
+
+    __slots__ = ('station_id', 'last_updated', 'num_bikes_available',
+                 'num_bikes_disabled', 'num_docks_available',
+                 'num_docks_disabled', 'is_installed', 'is_renting',
+                 'is_returning', 'last_reported')
+
+    def __init__(self, **values):
+        for key in self.__slots__:
+            setattr(self, key, values[key])
+
+    def __eq__(self, other):
+        ''' same comparison as Station_Status.__eq__ '''
+        return (self.num_bikes_available == other.num_bikes_available and
+                self.num_bikes_disabled == other.num_bikes_disabled and
+                self.num_docks_available == other.num_docks_available and
+                self.num_docks_disabled == other.num_docks_disabled and
+                self.is_installed == other.is_installed and
+                self.is_renting == other.is_renting and
+                self.is_returning == other.is_returning and
+                self.last_reported == other.last_reported)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        values = ', '.join(f'{key}={getattr(self, key)}'
+                           for key in self.__slots__)
+        return f'<Status_Record({values})>'
+
+
+def records_from_columns(cols, rows, last_updated):
+    ''' Build Status_Records for rows (indices) of cols.
+        last_updated is the feed's timestamp in microseconds. '''
+    records = []
+    for i in rows:
+        values = {'station_id': int(cols.station_id[i]),
+                  'last_updated': micros_to_datetime(last_updated),
+                  'last_reported':
+                      micros_to_datetime(int(cols.last_reported[i]))}
+        for col in COUNT_COLUMNS:
+            value = cols.counts[col][i]
+            values[col] = None if value == NULL_COUNT else int(value)
+        for col in FLAG_COLUMNS:
+            values[col] = bool(cols.flags[col][i])
+        records.append(Status_Record(**values))
+    return records
+
+
+class Latest_Status():
+    ''' Latest status per station, keyed by station_id.
+        Behaves like the dict it replaces (in, [], []=, del, get, len, keys)
+        and adds columns_for, which lines the arrays up with a feed
+        for status_diff.changed_mask without a python loop.
+        Timestamps are int64 microseconds since the epoch. '''
+
+    def __init__(self, capacity=1024):
+        self.index = {}  # station_id -> slot
+        self.columns = {'station_id': np.zeros(capacity, dtype=np.int64),
+                        'last_updated': np.zeros(capacity, dtype=np.int64),
+                        'last_reported': np.zeros(capacity, dtype=np.int64)}
+        for col in COUNT_COLUMNS:
+            self.columns[col] = np.full(capacity, NULL_COUNT)
+        for col in FLAG_COLUMNS:
+            self.columns[col] = np.zeros(capacity, dtype=np.bool_)
+        # sorted station_ids and their slots, rebuilt when stations are
+        # added. lets columns_for look up a whole feed with searchsorted
+        self.sorted_ids = None
+        self.sorted_slots = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, station_id):
+        return station_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, station_id):
+        slot = self.index[station_id]
+        values = {key: self.columns[key][slot].item()
+                  for key in self.columns}
+        for col in COUNT_COLUMNS:
+            if values[col] == NULL_COUNT:
+                values[col] = None
+            else:
+                values[col] = int(values[col])
+        values['last_updated'] = micros_to_datetime(values['last_updated'])
+        values['last_reported'] = micros_to_datetime(values['last_reported'])
+        return Status_Record(**values)
+
+    def get(self, station_id, default=None):
+        if station_id in self.index:
+            return self[station_id]
+        return default
+
+    def __setitem__(self, station_id, record):
+        ''' Copy the values out of record (a Station_Status, a
+            Status_Record, or a query row with the same attributes).
+            The record itself isn't kept. '''
+        slot = self.slot_for(station_id)
+        self.columns['station_id'][slot] = station_id
+        self.columns['last_updated'][slot] =\
+            datetime_to_micros(record.last_updated)
+        self.columns['last_reported'][slot] =\
+            datetime_to_micros(record.last_reported)
+        for col in COUNT_COLUMNS:
+            self.columns[col][slot] = count_value(getattr(record, col))
+        for col in FLAG_COLUMNS:
+            self.columns[col][slot] = bool(getattr(record, col))
+
+    def __delitem__(self, station_id):
+        ''' Forget a station. The last slot is moved into its place
+            so the arrays stay packed. '''
+        slot = self.index.pop(station_id)
+        last = len(self.index)
+        if slot != last:
+            for array in self.columns.values():
+                array[slot] = array[last]
+            self.index[int(self.columns['station_id'][slot])] = slot
+        self.sorted_ids = None
+
+    def slot_for(self, station_id):
+        ''' Return the slot for station_id, adding one if it's new '''
+        slot = self.index.get(station_id)
+        if slot is None:
+            slot = len(self.index)
+            if slot == len(self.columns['station_id']):
+                self.grow()
+            self.index[station_id] = slot
+            self.sorted_ids = None
+        return slot
+
+    def grow(self):
+        ''' double the size of every array '''
+        for key, array in self.columns.items():
+            bigger = np.empty(len(array) * 2, dtype=array.dtype)
+            bigger[:len(array)] = array
+            self.columns[key] = bigger
+
+    def lookup(self, station_ids):
+        ''' Return array of slots for station_ids, -1 where unknown '''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        if len(self.index) == 0:
+            return np.full(len(station_ids), -1, dtype=np.int64)
+        if self.sorted_ids is None:
+            ids = self.columns['station_id'][:len(self.index)]
+            self.sorted_slots = np.argsort(ids, kind='stable')
+            self.sorted_ids = ids[self.sorted_slots]
+        pos = np.searchsorted(self.sorted_ids, station_ids)
+        pos[pos == len(self.sorted_ids)] = 0
+        found = self.sorted_ids[pos] == station_ids
+        return np.where(found, self.sorted_slots[pos], -1)
+
+    def columns_for(self, station_ids):
+        ''' Status_Columns lined up with station_ids, plus boolean array
+            that is False where the station isn't known yet '''
+        slots = self.lookup(station_ids)
+        present = slots >= 0
+        slots = np.where(present, slots, 0)
+        counts = {col: np.where(present, self.columns[col][slots],
+                                NULL_COUNT)
+                  for col in COUNT_COLUMNS}
+        flags = {col: self.columns[col][slots] & present
+                 for col in FLAG_COLUMNS}
+        last_reported = np.where(present,
+                                 self.columns['last_reported'][slots], 0)
+        return (Status_Columns(np.asarray(station_ids), counts, flags,
+                               last_reported),
+                present)
+
+    def merge(self, cols, last_updated):
+        ''' Compare a decoded feed (Status_Columns) with the latest state
+            and apply whatever changed. last_updated is the feed's
+            timestamp in microseconds since the epoch.
+            Returns the indices of the changed rows of cols, in feed order.
+            Same rules as station_status_cdc.get_changed_data. '''
+        old, present = self.columns_for(cols.station_id)
+        changed = changed_mask(cols, old, present).nonzero()[0]
+        if len(np.unique(cols.station_id[changed])) < len(changed):
+            # a station is in the feed more than once,
+            # so each row has to be compared with the one before it
+            return self.merge_rows(cols, changed, last_updated)
+        self.set_rows(cols, changed, last_updated)
+        return changed
+
+    def merge_rows(self, cols, rows, last_updated):
+        ''' merge, one row at a time '''
+        changed = []
+        for i in rows:
+            row = Status_Columns(cols.station_id[i:i+1],
+                                 {c: a[i:i+1] for c, a in cols.counts.items()},
+                                 {c: a[i:i+1] for c, a in cols.flags.items()},
+                                 cols.last_reported[i:i+1])
+            old, present = self.columns_for(row.station_id)
+            if changed_mask(row, old, present)[0]:
+                self.set_rows(cols, [i], last_updated)
+                changed.append(i)
+        return np.array(changed, dtype=np.int64)
+
+    def set_rows(self, cols, rows, last_updated):
+        ''' Copy rows (indices) of cols into the state '''
+        slots = [self.slot_for(station_id)
+                 for station_id in cols.station_id[rows].tolist()]
+        self.columns['station_id'][slots] = cols.station_id[rows]
+        self.columns['last_updated'][slots] = last_updated
+        self.columns['last_reported'][slots] = cols.last_reported[rows]
+        for col in COUNT_COLUMNS:
+            self.columns[col][slots] = cols.counts[col][rows]
+        for col in FLAG_COLUMNS:
+            self.columns[col][slots] = cols.flags[col][rows]
+
+    def snapshot(self):
+        ''' Return a copy of the state as a dict of arrays.
+            Cheap to take (a few array copies) and can be saved with
+            numpy.savez. See restore. '''
+        n = len(self.index)
+        return {key: array[:n].copy() for key, array in self.columns.items()}
+
+    @classmethod
+    def restore(cls, snapshot):
+        ''' Build a Latest_Status from the output of snapshot '''
+        n = len(snapshot['station_id'])
+        latest = cls(capacity=max(n, 1))
+        for key, array in snapshot.items():
+            latest.columns[key][:n] = array
+        latest.index = {station_id: slot for slot, station_id
+                        in enumerate(snapshot['station_id'].tolist())}
+        return latest
@@ -1,10 +1,13 @@
 # src.models
 
 from datetime import datetime
+from decimal import Decimal
+from hashlib import md5
 
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, Numeric, DateTime
-from sqlalchemy import Boolean, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Numeric, DateTime, Float
+from sqlalchemy import Boolean, ForeignKey, Index
+from sqlalchemy import ForeignKeyConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, synonym
 from sqlalchemy.sql.functions import current_user
@@ -25,6 +28,24 @@ class Dimension():
         else:
             return None
 
+    def calc_row_hash(self):
+        ''' md5 of the compare_columns, used to spot changed rows
+            without comparing every attribute.
+            lat/lon come back from the db as Decimal but are floats from
+            the api, so numbers are hashed as floats. '''
+        values = []
+        for col in self.compare_columns:
+            value = getattr(self, col)
+            if value is None:
+                values.append('\\N')
+            elif isinstance(value, bool):
+                values.append('t' if value else 'f')
+            elif isinstance(value, (float, Decimal)):
+                values.append(repr(float(value)))
+            else:
+                values.append(str(value))
+        return md5('\x1f'.join(values).encode()).hexdigest()
+
     def __repr__(self):
         ''' When session is commited, this no longer works.'''
         repr_str = f'<{type(self).__name__}(\n'
@@ -42,12 +63,15 @@ class Station_Status(Base):
         See https://github.com/NABSA/gbfs/blob/
         master/gbfs.md#station_statusjson
 
-        Has a many-to-one relationship with Station_Status'''
+        Has a many-to-one relationship with Station_Status
+
+        Range partitioned on last_updated (see db.partitions), so
+        last_updated is part of the primary key. '''
 
     __tablename__ = 'station_status'
 
-    status_id = Column(Integer, primary_key=True)
-    last_updated = Column(DateTime)
+    status_id = Column(Integer, primary_key=True, autoincrement=True)
+    last_updated = Column(DateTime, primary_key=True)
     station_id = Column(Integer, ForeignKey('station_information.station_id'))
     num_bikes_available = Column(Integer)
     num_bikes_disabled = Column(Integer)
@@ -62,9 +86,21 @@ class Station_Status(Base):
     station_information = relationship("Station_Information",
                                        back_populates='station_statuses')
 
-    # set unique constraint for primary key cols
-    UniqueConstraint(last_updated, station_id,
-                     name="station_status_lu_id_unique")
+    # columns written by the bulk loaders (status_id and modified_by
+    # are filled in by the database)
+    load_columns = ('last_updated', 'station_id', 'num_bikes_available',
+                    'num_bikes_disabled', 'num_docks_available',
+                    'num_docks_disabled', 'is_installed', 'is_renting',
+                    'is_returning', 'last_reported')
+
+    # one row per station per feed version. newest first, for the
+    # DISTINCT ON lookup of each station's latest row and history reads.
+    # brin keeps time range scans cheap, rows arrive in last_updated order
+    __table_args__ = (Index('station_status_station_lu_key',
+                            station_id, last_updated.desc(), unique=True),
+                      Index('station_status_lu_brin', last_updated,
+                            postgresql_using='brin'),
+                      {'postgresql_partition_by': 'RANGE (last_updated)'})
 
     def __init__(self, record):
         ''' record should be a dict with the following keys:
@@ -147,6 +183,126 @@ class Station_Status(Base):
         return not self.__eq__(other)
 
 
+class Station_Status_Latest(Base):
+    ''' Latest Station_Status row of each station (one row per station).
+        Kept up to date by station_status_cdc.load_db in the same
+        transaction as the station_status insert, so the CDC can start
+        up by reading this table instead of scanning all of history.
+        Rows are removed when the station_status row they copy is
+        deleted (cascade on status_id, last_updated). '''
+
+    __tablename__ = 'station_status_latest'
+
+    station_id = Column(Integer,
+                        ForeignKey('station_information.station_id'),
+                        primary_key=True,
+                        autoincrement=False)
+    status_id = Column(Integer, nullable=False)
+    last_updated = Column(DateTime, nullable=False)
+    num_bikes_available = Column(Integer)
+    num_bikes_disabled = Column(Integer)
+    num_docks_available = Column(Integer)
+    num_docks_disabled = Column(Integer)
+    is_installed = Column(Boolean)
+    is_renting = Column(Boolean)
+    is_returning = Column(Boolean)
+    last_reported = Column(DateTime)
+
+    # station_status is partitioned, so its key includes last_updated
+    __table_args__ = (ForeignKeyConstraint(
+        ['status_id', 'last_updated'],
+        ['station_status.status_id', 'station_status.last_updated'],
+        ondelete='CASCADE'),)
+
+    def __repr__(self):
+        return ('<Station_Status_Latest(\n'
+                f'\tstation_id={self.station_id},\n'
+                f'\tstatus_id={self.status_id},\n'
+                f'\tlast_updated={self.last_updated},\n'
+                ')>')
+
+
+class Station_Status_Interval(Base):
+    ''' A station_status row stored as the interval it was current for.
+        valid_to is the next row's last_updated, or null for a station's
+        current state. Written by station_status_cdc.load_db when run
+        with intervals=True (see status_intervals).
+        The primary key doubles as the index for "status of station X
+        at time T": the last valid_from <= T for that station. '''
+
+    __tablename__ = 'station_status_interval'
+
+    station_id = Column(Integer,
+                        ForeignKey('station_information.station_id'),
+                        primary_key=True,
+                        autoincrement=False)
+    valid_from = Column(DateTime, primary_key=True)
+    valid_to = Column(DateTime)
+    num_bikes_available = Column(Integer)
+    num_bikes_disabled = Column(Integer)
+    num_docks_available = Column(Integer)
+    num_docks_disabled = Column(Integer)
+    is_installed = Column(Boolean)
+    is_renting = Column(Boolean)
+    is_returning = Column(Boolean)
+    last_reported = Column(DateTime)
+
+    # one open interval per station, and finds it when closing
+    __table_args__ = (Index('station_status_interval_open_idx',
+                            'station_id', unique=True,
+                            postgresql_where=valid_to.is_(None)),)
+
+    def __repr__(self):
+        return ('<Station_Status_Interval(\n'
+                f'\tstation_id={self.station_id},\n'
+                f'\tvalid_from={self.valid_from},\n'
+                f'\tvalid_to={self.valid_to},\n'
+                ')>')
+
+
+class Station_Status_Hourly(Base):
+    ''' Time weighted availability of a station for one hour.
+        Each station_status row counts for the seconds from its
+        last_updated until the station's next row, split across the
+        hours it covers. A row's time is only counted once the next
+        row arrives, so the current status isn't in here yet.
+        Kept up to date by station_status_cdc.load_db with
+        rollups=True, rebuilt by rollups.rebuild_rollups. '''
+
+    __tablename__ = 'station_status_hourly'
+
+    station_id = Column(Integer,
+                        ForeignKey('station_information.station_id'),
+                        primary_key=True,
+                        autoincrement=False)
+    hour = Column(DateTime, primary_key=True)
+    # seconds of the hour with a known status
+    seconds = Column(Float)
+    # sums of available * seconds, for the averages
+    bike_seconds = Column(Float)
+    dock_seconds = Column(Float)
+    min_bikes = Column(Integer)
+    max_bikes = Column(Integer)
+    min_docks = Column(Integer)
+    max_docks = Column(Integer)
+    # seconds with no bikes / no docks available
+    empty_seconds = Column(Float)
+    full_seconds = Column(Float)
+
+    # dashboards ask for every station over a range of hours
+    __table_args__ = (Index('station_status_hourly_hour_idx', 'hour'),)
+
+    def avg_bikes(self):
+        return self.bike_seconds / self.seconds if self.seconds else None
+
+    def avg_docks(self):
+        return self.dock_seconds / self.seconds if self.seconds else None
+
+    def __repr__(self):
+        return (f'<Station_Status_Hourly({self.station_id} {self.hour} '
+                f'avg_bikes={self.avg_bikes()})>')
+
+
 class Station_Information(Dimension, Base):
     ''' Represents a record of information about a station
         extends Base from sqlalchemy
@@ -179,6 +335,7 @@ class Station_Information(Dimension, Base):
     rental_method_transitcard = Column(Boolean)
     rental_method_accountnumber = Column(Boolean)
     rental_method_phone = Column(Boolean)
+    row_hash = Column(String(length=32))
     row_modified_tstmp = Column(DateTime)
     load_id = Column(Integer, ForeignKey('load_metadata.load_id'))
     transtype = Column(String(length=1))
@@ -189,10 +346,33 @@ class Station_Information(Dimension, Base):
     station_statuses = relationship("Station_Status",
                                     order_by=Station_Status.last_updated,
                                     back_populates='station_information')
+    # the same rows as a query, for stations with too much history to
+    # load at once. history.read_history streams it as arrays
+    station_status_query = relationship("Station_Status",
+                                        order_by=Station_Status.last_updated,
+                                        lazy='dynamic', viewonly=True)
+
+    # lets the etl diff against just (id, row_hash)
+    __table_args__ = (Index('station_information_hash_idx',
+                            'station_id', 'row_hash'),
+                      Index('station_information_region_idx', 'region_id'),
+                      Index('station_information_load_idx', 'load_id'))
 
     # create sqlalchemy synonyms to lookup easier
     id = synonym("station_id")
 
+    # columns that make a change (same as __eq__, hashed into row_hash),
+    # and all columns written by a load
+    compare_columns = ('station_id', 'short_name', 'station_name',
+                       'lat', 'lon', 'capacity', 'region_id',
+                       'eightd_has_key_dispenser', 'rental_method_key',
+                       'rental_method_creditcard', 'rental_method_paypass',
+                       'rental_method_applepay', 'rental_method_androidpay',
+                       'rental_method_transitcard',
+                       'rental_method_accountnumber', 'rental_method_phone')
+    load_columns = compare_columns + ('row_hash', 'row_modified_tstmp',
+                                      'load_id')
+
     def __init__(self, record):
         ''' Record should be a dict with the following keys:
             station_id, name, lat, lon.
@@ -209,6 +389,7 @@ class Station_Information(Dimension, Base):
         self.eightd_has_key_dispenser = self.set_optional(
             'eightd_has_key_dispenser', record)
         self.unpack_rental_methods(record)
+        self.row_hash = self.calc_row_hash()
         self.row_modified_tstmp = datetime.now()
         self.transtype = None
 
@@ -308,6 +489,13 @@ class System_Region(Dimension, Base):
                        autoincrement=False,
                        unique=True)
     region_name = Column(String(length=50), nullable=False)
+    # box around the region's stations, set by spatial.update_region_bounds
+    # after each station_information load. not part of the feed
+    min_lat = Column(Numeric)
+    max_lat = Column(Numeric)
+    min_lon = Column(Numeric)
+    max_lon = Column(Numeric)
+    row_hash = Column(String(length=32))
     row_modified_tstmp = Column(DateTime)
     load_id = Column(Integer, ForeignKey('load_metadata.load_id'))
     transtype = Column(String(length=1))
@@ -319,14 +507,24 @@ class System_Region(Dimension, Base):
 
     load = relationship("Load_Metadata", back_populates='regions')
 
+    __table_args__ = (Index('system_regions_hash_idx',
+                            'region_id', 'row_hash'),
+                      Index('system_regions_load_idx', 'load_id'))
+
     # create sqlalchemy synonyms to lookup easier
     id = synonym("region_id")
 
+    # see Station_Information
+    compare_columns = ('region_id', 'region_name')
+    load_columns = compare_columns + ('row_hash', 'row_modified_tstmp',
+                                      'load_id')
+
     def __init__(self, record):
         ''' record should be a dict with the following keys:
             region_id, name '''
         self.region_id = int(record['region_id'])  # convert region_id to int
         self.region_name = record['name']
+        self.row_hash = self.calc_row_hash()
         self.row_modified_tstmp = datetime.now()
         self.transtype = None
 
@@ -376,6 +574,8 @@ class Load_Metadata(Base):
                             order_by=Station_Information.station_id,
                             back_populates="load")
 
+    phases = relationship("Load_Phase", back_populates="load")
+
     def __init__(self, dataset, session):
         ''' A new metadata record should be
             instantiated with the name of the dataset
@@ -404,3 +604,80 @@ class Load_Metadata(Base):
                 f'inserts={self.inserts}\n'
                 f'updates={self.updates}\n'
                 ')>')
+
+
+class Load_Phase(Base):
+    ''' Time spent in one phase of a load (fetch, parse, transform,
+        compare, commit), with the rows and bytes it handled.
+        Many-to-one with Load_Metadata. '''
+
+    __tablename__ = 'load_phase'
+
+    phase_id = Column(Integer, primary_key=True)
+    load_id = Column(Integer, ForeignKey('load_metadata.load_id',
+                                         ondelete='CASCADE'),
+                     index=True)
+    phase = Column(String(length=20))
+    secs = Column(Numeric)
+    rows = Column(Integer)
+    bytes = Column(Integer)
+    rows_per_sec = Column(Numeric)
+    modified_by = Column(String(length=50), default=current_user())
+
+    load = relationship("Load_Metadata", back_populates='phases')
+
+    def __init__(self, phase):
+        ''' phase should be a timing.Phase '''
+        self.phase = phase.name
+        self.secs = phase.secs
+        self.rows = phase.rows
+        self.bytes = phase.bytes
+        self.rows_per_sec = phase.rows_per_sec()
+
+    def __repr__(self):
+        return (f'<Load_Phase(load_id={self.load_id} {self.phase} '
+                f'{self.secs}s rows={self.rows} bytes={self.bytes})>')
+
+
+class Cdc_Tick(Base):
+    ''' One poll of the station_status CDC: how long each phase took,
+        how big the feed was and how many rows changed.
+        skipped ticks got a version we already had, so only fetch ran.
+        lag_secs is how long after the version's last_updated we
+        fetched it, recorded with or without the adaptive scheduler. '''
+
+    __tablename__ = 'cdc_tick'
+
+    tick_id = Column(Integer, primary_key=True)
+    tick_tstmp = Column(DateTime)
+    last_updated = Column(DateTime)
+    skipped = Column(Boolean)
+    payload_bytes = Column(Integer)
+    rows = Column(Integer)
+    fetch_secs = Column(Numeric)
+    parse_secs = Column(Numeric)
+    diff_secs = Column(Numeric)
+    load_secs = Column(Numeric)
+    lag_secs = Column(Numeric)
+    modified_by = Column(String(length=50), default=current_user())
+
+    def __init__(self, timer, last_updated, rows=0, skipped=False, lag=None):
+        ''' timer should be a timing.Phase_Timer for the tick,
+            last_updated is epoch seconds from the feed,
+            lag is freshness lag in seconds '''
+        self.tick_tstmp = datetime.now()
+        self.last_updated = datetime.fromtimestamp(last_updated)\
+            if last_updated is not None else None
+        self.skipped = skipped
+        fetch = timer.phases.get('fetch')
+        self.payload_bytes = fetch.bytes if fetch is not None else None
+        self.rows = rows
+        self.fetch_secs = timer.secs('fetch')
+        self.parse_secs = timer.secs('parse')
+        self.diff_secs = timer.secs('diff')
+        self.load_secs = timer.secs('load')
+        self.lag_secs = lag
+
+    def __repr__(self):
+        return (f'<Cdc_Tick({self.last_updated} rows={self.rows} '
+                f'skipped={self.skipped})>')
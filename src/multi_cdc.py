@@ -0,0 +1,259 @@
+''' src.multi_cdc
+
+    Run the station_status CDC for many GBFS systems in one process.
+
+    Each system gets a System_Poller coroutine with its own ttl schedule
+    and Latest_Status. The polls share:
+        - a thread pool for HTTP fetches (requests is blocking)
+        - a thread pool for db writes, no bigger than the engine's
+          connection pool, so all systems together never hold more than
+          pool_size connections
+    Versions of a feed that were already seen are skipped at the fetch,
+    before any parsing (see feeds.fetch_feed).
+    Rows for stations that aren't in station_information yet go through
+    the system's own station_cache.Known_Stations before the write, so
+    a new station doesn't fail the whole system's writes.
+    Systems are listed in a json file of {"name": "url"}, where url is
+    either the system's station_status feed or its gbfs.json, which
+    is used to look the feed up (see registry.Feed_Registry).
+'''
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from time import time
+
+import requests
+from sqlalchemy.exc import SQLAlchemyError
+
+from .feeds import Feed_State, fetch_feed
+from .latest_state import Latest_Status
+from .registry import Feed_Registry, CACHE_FILE, is_discovery_url
+from .scheduler import Poll_Scheduler
+from .station_cache import Known_Stations
+from .station_status_cdc import get_changed_data
+from .station_status_cdc import get_latest_from_db, load_db
+from .utils import get_sessionmaker, pool_stats
+
+
+class System_Poller():
+    ''' Polls one system's station_status feed.
+        fetch, load_latest and write are coroutine functions:
+            fetch(url, state) -> (feed dict, version), or (None, None)
+                for a version already seen (see feeds.fetch_feed)
+            load_latest(station_ids) -> Latest_Status
+            write(rows) -> None
+            filter(rows, latest) -> the rows that can be written
+                (optional, see station_cache.Known_Stations)
+        The latest state is loaded from the db on the first fetch, once
+        we know which stations belong to the system. A version is only
+        marked seen on the poller's Feed_State once its rows are
+        written, so a failed write is fetched and tried again.
+        If a Poll_Scheduler is given it times the polls,
+        otherwise the poller sleeps the feed's ttl. '''
+
+    def __init__(self, name, url, fetch, load_latest, write,
+                 retry_delay=10, scheduler=None, filter=None):
+        self.name = name
+        self.scheduler = scheduler
+        self.url = url
+        self.fetch = fetch
+        self.load_latest = load_latest
+        self.write = write
+        self.filter = filter
+        self.retry_delay = retry_delay
+        self.state = Feed_State()
+        self.latest = None
+        self.last_updated = None
+        self.ttl = None
+        # stats
+        self.ticks = 0
+        self.skips = 0
+        self.rows_written = 0
+        self.errors = 0
+
+    async def poll_once(self):
+        ''' Fetch, diff and write one version of the feed.
+            Returns seconds to wait before the next poll. '''
+        new_data, version = await self.fetch(self.url, self.state)
+        fetched_at = time()
+        if new_data is None:
+            self.skips += 1
+            return self.wait(self.last_updated, self.ttl, fetched_at)
+        if self.latest is None:
+            station_ids = [int(row['station_id'])
+                           for row in new_data['data']['stations']]
+            self.latest = await self.load_latest(station_ids)
+        before = self.latest.snapshot()
+        out, self.latest = get_changed_data(new_data, self.latest)
+        if out:
+            try:
+                if self.filter is not None:
+                    out = await self.filter(out, self.latest)
+                if out:
+                    await self.write(out)
+            except Exception:
+                # put the state back so the rows are picked up next tick
+                self.latest = Latest_Status.restore(before)
+                raise
+            self.rows_written += len(out)
+        self.state.accept(version)
+        self.ticks += 1
+        self.last_updated = new_data['last_updated']
+        self.ttl = new_data['ttl']
+        print(f'{self.name}: {len(out)} changed rows '
+              f'for {new_data["last_updated"]}')
+        return self.wait(new_data['last_updated'], new_data['ttl'],
+                         fetched_at)
+
+    def wait(self, last_updated, ttl, fetched_at):
+        ''' Seconds until the next poll. retry_delay until a version
+            has been loaded, there's no ttl to go on before that. '''
+        if last_updated is None or ttl is None:
+            return self.retry_delay
+        if self.scheduler is None:
+            return ttl
+        self.scheduler.observe(last_updated, ttl, fetched_at,
+                               time() - fetched_at)
+        return self.scheduler.next_delay(time())
+
+    async def run(self, stop):
+        ''' Poll until the stop event is set '''
+        while not stop.is_set():
+            try:
+                wait = await self.poll_once()
+            except (requests.RequestException, SQLAlchemyError,
+                    ValueError, KeyError) as e:
+                # one system's bad poll shouldn't stop the others
+                self.errors += 1
+                print(f'{self.name}: poll failed at '
+                      f'{datetime.strftime(datetime.now(), "%c")}: {e}')
+                wait = self.retry_delay
+            try:
+                await asyncio.wait_for(stop.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+def read_systems(filename):
+    ''' Read the {name: station_status or gbfs.json url} json file '''
+    with open(filename, 'r') as systems_file:
+        return json.load(systems_file)
+
+
+def make_pollers(systems, Session, write_mode='copy', pool_size=5,
+                 http_workers=20, adaptive=False, cache_file=CACHE_FILE):
+    ''' Build a System_Poller per system, sharing thread pools and
+        the connection pool behind Session (a sessionmaker).
+        With adaptive, each poller gets its own Poll_Scheduler.
+        Systems given by gbfs.json get a Feed_Registry, with
+        discovered urls cached in cache_file, and their new stations
+        are loaded when they show up. Other systems can't find their
+        dimension feeds, so rows for unknown stations are dropped.
+        Returns (pollers, executors), shut the executors down when done. '''
+    http_pool = ThreadPoolExecutor(http_workers, thread_name_prefix='http')
+    db_pool = ThreadPoolExecutor(pool_size, thread_name_prefix='db')
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=http_workers)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+
+    def db_call(func, *args):
+        session = Session()
+        try:
+            return func(*args, session)
+        finally:
+            session.close()
+
+    def latest_call(station_ids, session):
+        return get_latest_from_db(session, station_ids)
+
+    registries = {url: Feed_Registry(url, cache_file=cache_file, http=http)
+                  for url in systems.values() if is_discovery_url(url)}
+
+    def fetch_station_status(url, state):
+        registry = registries.get(url)
+        if registry is None:
+            return fetch_feed(url, state, http)
+        try:
+            return fetch_feed(registry.feed_url('station_status'),
+                              state, http)
+        except requests.RequestException:
+            # the feed may have moved, rediscover it next time
+            registry.invalidate()
+            raise
+
+    # a poller only has one fetch in flight, so its Feed_State
+    # (or registry) is never used by two threads at once
+    async def fetch(url, state):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            http_pool, fetch_station_status, url, state)
+
+    async def load_latest(station_ids):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            db_pool, db_call, latest_call, station_ids)
+
+    async def write(rows):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            db_pool, db_call, partial(load_db, mode=write_mode), rows)
+
+    def make_filter(url):
+        # one per system, and a poller only has one write in flight
+        registry = registries.get(url)
+        known = Known_Stations(registry=registry,
+                               min_interval=300 if registry else None)
+
+        async def filter(rows, latest):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                db_pool, db_call, known.filter, rows, latest)
+        filter.known = known
+        return filter
+
+    pollers = [System_Poller(name, url, fetch, load_latest, write,
+                             scheduler=Poll_Scheduler() if adaptive else None,
+                             filter=make_filter(url))
+               for name, url in systems.items()]
+    return pollers, (http_pool, db_pool)
+
+
+async def run_pollers(pollers, stop):
+    await asyncio.gather(*(poller.run(stop) for poller in pollers))
+
+
+def main(systems_file, env='DEV', write_mode='copy', pool_size=5,
+         http_workers=20, adaptive=False):
+    systems = read_systems(systems_file)
+    Session = get_sessionmaker(env, pool_size=pool_size, max_overflow=0)
+    pollers, executors = make_pollers(systems, Session, write_mode,
+                                      pool_size, http_workers, adaptive)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stop = asyncio.Event()
+    task = loop.create_task(run_pollers(pollers, stop))
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # let in-flight polls and writes finish before exiting
+        stop.set()
+        loop.run_until_complete(task)
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+        loop.close()
+    for poller in pollers:
+        print(f'{poller.name}: {poller.ticks} ticks, '
+              f'{poller.rows_written} rows, {poller.skips} skipped, '
+              f'{poller.errors} errors')
+        known = poller.filter.known
+        print(f'{poller.name}: {known.refreshes} station refreshes, '
+              f'{known.dropped} rows dropped for unknown stations')
+        if poller.scheduler is not None:
+            print(f'{poller.name}: {poller.scheduler.stats()}')
+    for (env, role), stats in pool_stats().items():
+        print(f'{env} {role} pool: {stats}')
@@ -0,0 +1,117 @@
+''' src.registry
+
+    Feed urls from a system's gbfs.json discovery document.
+
+    Every GBFS system publishes gbfs.json, listing the url of each feed
+    it has (station_status, station_information, system_regions...).
+    Feed_Registry looks the urls up there instead of hardcoding them,
+    and caches the result in a json file so a new run doesn't repeat
+    discovery. The cache is refreshed when its ttl runs out, or when a
+    fetch from one of its urls fails (invalidate).
+'''
+
+import json
+import os
+from threading import Lock
+from time import time
+
+import requests
+
+
+# capital bikeshare, the system this project started with
+GBFS_DISCOVERY_URL = 'https://gbfs.capitalbikeshare.com/gbfs/gbfs.json'
+
+# where the mains keep discovered feeds between runs
+CACHE_FILE = '.cache/gbfs_feeds.json'
+
+# registries for different systems can share a cache file and be used
+# from different threads (multi_cdc), so file updates take this lock
+cache_lock = Lock()
+
+
+class Feed_Registry():
+    ''' Resolves feed names to urls for one system.
+        cache_file is shared by registries for different systems
+        (entries are keyed by discovery url). None keeps it in memory.
+        gbfs.json ttls are often only a few seconds, but the feed list
+        rarely changes, so entries are kept at least min_ttl seconds. '''
+
+    def __init__(self, discovery_url=GBFS_DISCOVERY_URL, cache_file=None,
+                 language='en', min_ttl=86400, http=requests):
+        self.discovery_url = discovery_url
+        self.cache_file = cache_file
+        self.language = language
+        self.min_ttl = min_ttl
+        self.http = http
+        self.feeds = None
+        self.expires = 0
+        self.discoveries = 0
+        self.read_cache()
+
+    def feed_url(self, name):
+        ''' Url of the named feed, discovering it if needed.
+            Raises KeyError if the system doesn't publish that feed. '''
+        if self.feeds is None or time() >= self.expires:
+            self.discover()
+        try:
+            return self.feeds[name]
+        except KeyError:
+            raise KeyError(f'{self.discovery_url} has no {name} feed')
+
+    def invalidate(self):
+        ''' A url didn't work. Rediscover on the next lookup. '''
+        self.expires = 0
+        if self.feeds is not None:
+            self.write_cache()
+
+    def discover(self):
+        ''' Fetch gbfs.json and cache the feeds for our language '''
+        response = self.http.get(self.discovery_url)
+        response.raise_for_status()
+        discovery = response.json()
+        data = discovery['data']
+        # systems with one language sometimes use another key
+        languages = data.get(self.language) or next(iter(data.values()))
+        self.feeds = {feed['name']: feed['url']
+                      for feed in languages['feeds']}
+        ttl = max(discovery.get('ttl', 0), self.min_ttl)
+        self.expires = time() + ttl
+        self.discoveries += 1
+        self.write_cache()
+
+    def read_cache(self):
+        entry = self.read_cache_file().get(self.discovery_url)
+        if entry is not None:
+            self.feeds = entry['feeds']
+            self.expires = entry['expires']
+
+    def write_cache(self):
+        if self.cache_file is None:
+            return
+        with cache_lock:
+            cache = self.read_cache_file()
+            cache[self.discovery_url] = {'feeds': self.feeds,
+                                         'expires': self.expires}
+            directory = os.path.dirname(self.cache_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # write then rename so a reader never sees half a file
+            temp_file = f'{self.cache_file}.tmp'
+            with open(temp_file, 'w') as cache_file:
+                json.dump(cache, cache_file, indent=2)
+            os.replace(temp_file, self.cache_file)
+
+    def read_cache_file(self):
+        ''' whole cache as a dict, empty if missing or unreadable '''
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+
+def is_discovery_url(url):
+    ''' True if url is a gbfs.json rather than a feed '''
+    return url.split('?')[0].endswith('gbfs.json')
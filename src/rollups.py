@@ -0,0 +1,165 @@
+''' src.rollups
+
+    Hourly availability per station (station_status_hourly), so
+    dashboards read one row per station per hour instead of the raw
+    station_status rows.
+
+    A station_status row holds from its last_updated until the next row
+    for the station. That span is cut at hour boundaries and each piece
+    is added to its hour: seconds, available * seconds (for time
+    weighted averages), min/max and seconds empty/full.
+
+    update_rollups adds the spans a CDC batch closes (each new row ends
+    the row before it), in load_db's transaction. rebuild_rollups
+    recomputes a range of hours from station_status.
+'''
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from .models import Station_Status, Station_Status_Hourly
+from .models import Station_Information
+from .utils import get_session
+
+
+STATUS = Station_Status.__tablename__
+HOURLY = Station_Status_Hourly.__tablename__
+
+
+def rollup_sql(spans):
+    ''' Add spans (a subquery of station_id, span_start, span_end,
+        bikes, docks) into station_status_hourly '''
+    return (f'''INSERT INTO {HOURLY} AS r
+                    (station_id, hour, seconds, bike_seconds, dock_seconds,
+                     min_bikes, max_bikes, min_docks, max_docks,
+                     empty_seconds, full_seconds)
+                SELECT station_id, hour, sum(secs),
+                       sum(bikes * secs), sum(docks * secs),
+                       min(bikes), max(bikes), min(docks), max(docks),
+                       sum(CASE WHEN bikes = 0 THEN secs ELSE 0 END),
+                       sum(CASE WHEN docks = 0 THEN secs ELSE 0 END)
+                FROM (SELECT g.station_id, h.hour, g.bikes, g.docks,
+                             extract(epoch FROM
+                                 least(g.span_end,
+                                       h.hour + interval '1 hour') -
+                                 greatest(g.span_start, h.hour)) AS secs
+                      FROM ({spans}) g
+                      CROSS JOIN LATERAL generate_series(
+                          date_trunc('hour', g.span_start),
+                          g.span_end - interval '1 microsecond',
+                          interval '1 hour') AS h (hour)
+                      WHERE g.span_end > g.span_start) pieces
+                GROUP BY station_id, hour
+                ON CONFLICT (station_id, hour) DO UPDATE SET
+                    seconds = r.seconds + EXCLUDED.seconds,
+                    bike_seconds = r.bike_seconds + EXCLUDED.bike_seconds,
+                    dock_seconds = r.dock_seconds + EXCLUDED.dock_seconds,
+                    min_bikes = least(r.min_bikes, EXCLUDED.min_bikes),
+                    max_bikes = greatest(r.max_bikes, EXCLUDED.max_bikes),
+                    min_docks = least(r.min_docks, EXCLUDED.min_docks),
+                    max_docks = greatest(r.max_docks, EXCLUDED.max_docks),
+                    empty_seconds = r.empty_seconds + EXCLUDED.empty_seconds,
+                    full_seconds = r.full_seconds + EXCLUDED.full_seconds''')
+
+
+def previous_row_sql(station, condition, order='DESC'):
+    ''' LATERAL subquery for the station_status row of station closest
+        to a point in time (given by condition and order), found with
+        the (station_id, last_updated) index instead of a scan '''
+    return (f'''LATERAL (SELECT s.station_id, s.last_updated,
+                                s.num_bikes_available, s.num_docks_available
+                         FROM {STATUS} s
+                         WHERE s.station_id = {station}
+                         AND {condition}
+                         ORDER BY s.last_updated {order}
+                         LIMIT 1)''')
+
+
+def update_rollups(out, session):
+    ''' Add the spans closed by the rows in out, which must already be
+        in station_status: each row ends the station's row before it.
+        Runs on the session's transaction. '''
+    if not out:
+        return
+    spans = f'''SELECT p.station_id, p.last_updated AS span_start,
+                       n.last_updated AS span_end,
+                       p.num_bikes_available AS bikes,
+                       p.num_docks_available AS docks
+                FROM unnest(CAST(:station_ids AS integer[]),
+                            CAST(:last_updated AS timestamp[]))
+                     AS n (station_id, last_updated)
+                CROSS JOIN {previous_row_sql(
+                    'n.station_id', 's.last_updated < n.last_updated')} p'''
+    session.execute(text(rollup_sql(spans)),
+                    {'station_ids': [row.station_id for row in out],
+                     'last_updated': [row.last_updated for row in out]})
+
+
+def rebuild_rollups(session, start, end):
+    ''' Recompute the hours from start up to end (datetimes, truncated
+        to the hour). Each station's rows in the range are used, plus
+        its rows either side so spans crossing the edges are clipped
+        rather than lost. Caller commits. '''
+    start = start.replace(minute=0, second=0, microsecond=0)
+    end = end.replace(minute=0, second=0, microsecond=0)
+    stations = Station_Information.__tablename__
+    cols = ('station_id, last_updated, '
+            'num_bikes_available, num_docks_available')
+    spans = f'''SELECT station_id,
+                       greatest(last_updated, :start) AS span_start,
+                       least(next_updated, :end) AS span_end,
+                       num_bikes_available AS bikes,
+                       num_docks_available AS docks
+                FROM (SELECT *, lead(last_updated) OVER (
+                                    PARTITION BY station_id
+                                    ORDER BY last_updated) AS next_updated
+                      FROM (SELECT {cols} FROM {STATUS}
+                            WHERE last_updated >= :start
+                            AND last_updated < :end
+                            UNION ALL
+                            SELECT p.* FROM {stations} i
+                            CROSS JOIN {previous_row_sql(
+                                'i.station_id', 's.last_updated < :start')} p
+                            UNION ALL
+                            SELECT p.* FROM {stations} i
+                            CROSS JOIN {previous_row_sql(
+                                'i.station_id', 's.last_updated >= :end',
+                                'ASC')} p) history) w
+                WHERE next_updated IS NOT NULL
+                AND last_updated < :end'''
+    session.execute(text(f'''DELETE FROM {HOURLY}
+                             WHERE hour >= :start AND hour < :end'''),
+                    {'start': start, 'end': end})
+    session.execute(text(rollup_sql(spans)), {'start': start, 'end': end})
+
+
+def get_hourly(session, start, end, station_ids=None):
+    ''' Rows of station_status_hourly for hours from start up to end,
+        with avg_bikes and avg_docks. Plain rows, not ORM objects. '''
+    hourly = Station_Status_Hourly
+    columns = [getattr(hourly, col.name)
+               for col in hourly.__table__.columns]
+    query = session.query(
+        *columns,
+        (hourly.bike_seconds / hourly.seconds).label('avg_bikes'),
+        (hourly.dock_seconds / hourly.seconds).label('avg_docks')).\
+        filter(hourly.hour >= start, hourly.hour < end)
+    if station_ids is not None:
+        query = query.filter(hourly.station_id.in_(station_ids))
+    return query.order_by(hourly.station_id, hourly.hour).all()
+
+
+def main(start, end=None, days=7):
+    ''' Rebuild the dev db's rollups from start to end (default now),
+        days at a time, committing each chunk '''
+    session = get_session()
+    start = start.replace(minute=0, second=0, microsecond=0)
+    end = end or datetime.now()
+    while start < end:
+        chunk_end = min(start + timedelta(days=days), end)
+        rebuild_rollups(session, start, chunk_end)
+        session.commit()
+        print(f'rebuilt {start} to {chunk_end}')
+        start = chunk_end
+    session.close()
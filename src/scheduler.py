@@ -0,0 +1,140 @@
+''' src.scheduler
+
+    Adaptive poll timing for GBFS feeds.
+
+    Sleeping the full ttl after each poll means every cycle takes
+    fetch + diff + commit + ttl, and versions are picked up late.
+    Poll_Scheduler learns how often the feed actually publishes
+    (the step between last_updated values) and how long after
+    last_updated a new version is first visible to us (publish delay
+    plus clock skew), and aims the next fetch just after the next
+    version should appear.
+    The visibility delay is bracketed: a new version at lag x means
+    it's at most x, a duplicate pull means it's more than how far we
+    were past the expected last_updated. Until there's a duplicate,
+    fetches probe earlier by a doubling step; after that they aim
+    between the two bounds, and the lower bound is relaxed a step
+    each cycle so drift in either direction is followed.
+    A duplicate pull also widens the safety margin a little and each
+    clean pull narrows it again, more slowly. After max_duplicates pulls of the
+    same version it falls back to waiting the ttl.
+'''
+
+from collections import deque
+from statistics import median
+
+
+class Poll_Scheduler():
+    ''' Call observe() after each poll, then sleep next_delay().
+        All times are seconds since the epoch. '''
+
+    def __init__(self, margin=0.5, max_duplicates=3, retry_delay=1.0,
+                 step=0.25, history=30):
+        self.base_margin = margin
+        self.margin = margin
+        self.max_duplicates = max_duplicates
+        self.retry_delay = retry_delay
+        self.step = step
+        self.last_updated = None
+        self.ttl = None
+        self.duplicates = 0
+        # bounds on seconds from last_updated until a version is visible
+        self.floor = None
+        self.ceiling = None
+        self.creep = step
+        # rolling history used for estimates and reporting
+        self.intervals = deque(maxlen=history)
+        self.lags = deque(maxlen=history)
+        self.processing = deque(maxlen=history)
+        self.total_polls = 0
+        self.total_duplicates = 0
+
+    def observe(self, last_updated, ttl, fetched_at, processing_secs=0):
+        ''' Record a poll. last_updated and ttl are from the feed,
+            fetched_at is when the response came back and
+            processing_secs is how long diff + load took.
+            Returns freshness lag (fetched_at - last_updated). '''
+        self.total_polls += 1
+        self.ttl = ttl
+        self.processing.append(processing_secs)
+        lag = fetched_at - last_updated
+        if self.last_updated is not None and\
+                last_updated <= self.last_updated:
+            # pulled a version we already had: we were early
+            cadence = self.cadence()
+            if cadence is not None:
+                self.floor = fetched_at - (self.last_updated + cadence)
+            if self.duplicates == 0:
+                self.margin += self.step
+                if cadence is not None:
+                    # no point waiting longer than a whole cadence
+                    self.margin = min(self.margin, cadence)
+            self.duplicates += 1
+            self.total_duplicates += 1
+            return fetched_at - self.last_updated
+        if self.last_updated is not None:
+            self.intervals.append(last_updated - self.last_updated)
+        if self.duplicates == 0:
+            # clean pull, the margin can come back down slowly
+            self.margin = max(self.base_margin, self.margin - self.step / 4)
+        self.ceiling = lag
+        if self.floor is None:
+            self.creep = min(self.creep * 2, self.cadence() or self.step)
+        else:
+            self.floor -= self.step
+        self.lags.append(lag)
+        self.last_updated = last_updated
+        self.duplicates = 0
+        return lag
+
+    def offset(self):
+        ''' Estimated seconds from last_updated until the version is
+            visible to us, None until there's a lag to go on '''
+        if self.ceiling is None:
+            return None
+        if self.floor is None or self.floor >= self.ceiling:
+            # nothing below it yet, probe earlier, further each time
+            return self.ceiling - self.margin - self.creep
+        return (self.floor + self.ceiling) / 2
+
+    def cadence(self):
+        ''' Estimated seconds between versions, None until known.
+            Median, so a missed version (double step) doesn't skew it. '''
+        if not self.intervals:
+            return None
+        return median(self.intervals)
+
+    def next_fetch(self):
+        ''' Epoch time the next version should be visible to us,
+            None if there isn't enough history yet. '''
+        cadence = self.cadence()
+        offset = self.offset()
+        if cadence is None or offset is None:
+            return None
+        # offset converts feed time to our time
+        return self.last_updated + cadence + offset + self.margin
+
+    def next_delay(self, now):
+        ''' Seconds to wait before the next fetch '''
+        if self.duplicates >= self.max_duplicates:
+            # stop hammering the feed, wait a full ttl
+            self.duplicates = 0
+            return self.ttl
+        if self.duplicates > 0:
+            return self.retry_delay
+        target = self.next_fetch()
+        if target is None:
+            return self.ttl
+        return max(0, target - now)
+
+    def stats(self):
+        ''' Summary of recent polls for logging '''
+        return {'polls': self.total_polls,
+                'duplicates': self.total_duplicates,
+                'cadence': self.cadence(),
+                'margin': self.margin,
+                'offset': self.offset(),
+                'lag_median': median(self.lags) if self.lags else None,
+                'lag_max': max(self.lags) if self.lags else None,
+                'processing_median':
+                    median(self.processing) if self.processing else None}
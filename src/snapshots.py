@@ -0,0 +1,226 @@
+''' src.snapshots
+
+    What every station looked like at a point in time.
+
+    snapshot_at(session, at) finds each station's newest station_status
+    row at or before at, with one LATERAL probe per station of the
+    (station_id, last_updated DESC) index. Results are Snapshots: the
+    status_diff Status_Columns (counts with NULL_COUNT for missing,
+    flags, int64 microsecond timestamps) plus last_updated, one row per
+    station sorted by station_id. Recent results are kept in a small
+    LRU cache, dashboards ask for the same times over and over.
+
+    snapshots_between(session, start, end, step) yields a Snapshot for
+    every step from start to end. It takes one snapshot at start, then
+    streams the rows after it in last_updated order through a
+    server-side cursor, updating the state as it passes each step. A
+    year of hourly snapshots is one range scan, not 8760 queries.
+'''
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+
+import numpy as np
+from sqlalchemy import text
+
+from .models import Station_Status, Station_Information
+from .status_diff import Status_Columns, COUNT_COLUMNS, FLAG_COLUMNS
+from .status_diff import NULL_COUNT, datetime_to_micros
+from .status_diff import column_sql, column_array
+from .utils import server_cursor
+
+
+STATUS = Station_Status.__tablename__
+# in the order the queries select them
+COLUMNS = ('station_id', 'last_updated') + COUNT_COLUMNS + FLAG_COLUMNS + \
+    ('last_reported',)
+
+CACHE_SIZE = 256
+# a snapshot this close to now can still change as the CDC inserts,
+# so it isn't cached
+CACHE_DELAY = timedelta(minutes=10)
+CACHE = OrderedDict()
+CACHE_LOCK = Lock()
+
+
+class Snapshot(Status_Columns):
+    ''' Status_Columns of each station's status at time at.
+        last_updated is when each station's row started,
+        in microseconds since the epoch. '''
+
+    def __init__(self, at, station_id, last_updated, counts, flags,
+                 last_reported):
+        super().__init__(station_id, counts, flags, last_reported)
+        self.at = at
+        self.last_updated = last_updated
+
+    def arrays(self):
+        return ([self.station_id, self.last_updated, self.last_reported] +
+                list(self.counts.values()) + list(self.flags.values()))
+
+    def __repr__(self):
+        return f'<Snapshot({self.at} {len(self)} stations)>'
+
+
+def select_sql(table):
+    ''' COLUMNS of table after station_id, see status_diff.column_sql '''
+    return ', '.join(column_sql(col, table) for col in COLUMNS[1:])
+
+
+def lateral_sql(stations):
+    ''' Newest row at or before :at for each station_id in stations
+        (a FROM clause with a station_id column) '''
+    return text(f'''SELECT i.station_id, {select_sql('s')}
+                    FROM {stations}
+                    CROSS JOIN LATERAL (
+                        SELECT * FROM {STATUS} s
+                        WHERE s.station_id = i.station_id
+                        AND s.last_updated <= :at
+                        ORDER BY s.last_updated DESC
+                        LIMIT 1) s
+                    ORDER BY i.station_id''')
+
+
+SNAPSHOT_SQL = lateral_sql(f'{Station_Information.__tablename__} i')
+SNAPSHOT_IDS_SQL = lateral_sql(
+    'unnest(CAST(:station_ids AS integer[])) AS i (station_id)')
+
+
+class Row_Columns():
+    ''' Rows from select_sql, with station_id in front, as numpy arrays '''
+
+    def __init__(self, rows):
+        columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+        values = {col: column_array(col, column)
+                  for col, column in zip(COLUMNS, columns)}
+        self.station_id = values['station_id']
+        self.last_updated = values['last_updated']
+        self.last_reported = values['last_reported']
+        self.counts = {col: values[col] for col in COUNT_COLUMNS}
+        self.flags = {col: values[col] for col in FLAG_COLUMNS}
+
+
+def snapshot_at(session, at, station_ids=None):
+    ''' Snapshot of every station (or just station_ids) at datetime at.
+        Stations with no row at or before at are left out. The arrays
+        are shared with the cache, so they're read only. '''
+    if station_ids is not None:
+        station_ids = tuple(sorted(set(station_ids)))
+    url = session.bind.url
+    key = (url.host, url.database, at, station_ids)
+    with CACHE_LOCK:
+        snapshot = CACHE.get(key)
+        if snapshot is not None:
+            CACHE.move_to_end(key)
+            return snapshot
+    if station_ids is None:
+        rows = session.execute(SNAPSHOT_SQL, {'at': at}).fetchall()
+    else:
+        rows = session.execute(SNAPSHOT_IDS_SQL,
+                               {'at': at,
+                                'station_ids': list(station_ids)}).fetchall()
+    cols = Row_Columns(rows)
+    snapshot = Snapshot(at, cols.station_id, cols.last_updated, cols.counts,
+                        cols.flags, cols.last_reported)
+    for array in snapshot.arrays():
+        array.flags.writeable = False
+    if at <= datetime.now() - CACHE_DELAY:
+        with CACHE_LOCK:
+            CACHE[key] = snapshot
+            if len(CACHE) > CACHE_SIZE:
+                CACHE.popitem(last=False)
+    return snapshot
+
+
+def clear_cache():
+    ''' Forget cached snapshots, e.g. after a backfill changed history '''
+    with CACHE_LOCK:
+        CACHE.clear()
+
+
+class Snapshot_State():
+    ''' Every station's current row as arrays, indexed by position in
+        the sorted station_ids. Rows are applied in last_updated order. '''
+
+    def __init__(self, station_ids):
+        n = len(station_ids)
+        self.station_ids = station_ids
+        self.present = np.zeros(n, dtype=np.bool_)
+        self.last_updated = np.zeros(n, dtype=np.int64)
+        self.last_reported = np.zeros(n, dtype=np.int64)
+        self.counts = {col: np.full(n, NULL_COUNT) for col in COUNT_COLUMNS}
+        self.flags = {col: np.zeros(n, dtype=np.bool_)
+                      for col in FLAG_COLUMNS}
+
+    def apply(self, cols, start=0, end=None):
+        ''' Set the state from rows start:end of cols (Row_Columns).
+            When a station is in there more than once its last row wins. '''
+        positions = np.searchsorted(self.station_ids,
+                                    cols.station_id[start:end])
+        rows = np.arange(start, start + len(positions))
+        # np.unique finds first occurrences, so search from the end
+        _, first = np.unique(positions[::-1], return_index=True)
+        keep = len(positions) - 1 - first
+        positions, rows = positions[keep], rows[keep]
+        self.present[positions] = True
+        self.last_updated[positions] = cols.last_updated[rows]
+        self.last_reported[positions] = cols.last_reported[rows]
+        for col in COUNT_COLUMNS:
+            self.counts[col][positions] = cols.counts[col][rows]
+        for col in FLAG_COLUMNS:
+            self.flags[col][positions] = cols.flags[col][rows]
+
+    def snapshot(self, at):
+        present = self.present
+        return Snapshot(at, self.station_ids[present],
+                        self.last_updated[present],
+                        {col: values[present]
+                         for col, values in self.counts.items()},
+                        {col: values[present]
+                         for col, values in self.flags.items()},
+                        self.last_reported[present])
+
+
+def snapshots_between(session, start, end, step=timedelta(hours=1),
+                      station_ids=None, batch_rows=50000):
+    ''' Yield a Snapshot at start, start + step, ... up to and including
+        end. Streams the rows in between once, on a server-side cursor
+        in the session's transaction. '''
+    if station_ids is None:
+        station_ids = [row[0] for row in session.execute(
+            f'''SELECT station_id FROM {Station_Information.__tablename__}
+                ORDER BY station_id''')]
+    station_ids = np.unique(np.asarray(list(station_ids), dtype=np.int64))
+    state = Snapshot_State(station_ids)
+    state.apply(snapshot_at(session, start, station_ids.tolist()))
+    yield state.snapshot(start)
+
+    at = start + step
+    if at > end:
+        return
+    cursor = server_cursor(session, 'snapshot')
+    cursor.execute(f'''SELECT s.station_id, {select_sql('s')}
+                       FROM {STATUS} s
+                       WHERE last_updated > %s AND last_updated <= %s
+                       AND station_id = ANY(%s)
+                       ORDER BY last_updated, station_id''',
+                   (start, end, station_ids.tolist()))
+    try:
+        while at <= end:
+            rows = cursor.fetchmany(batch_rows)
+            cols = Row_Columns(rows)
+            done = 0
+            # emit every step the batch gets past
+            while at <= end:
+                cut = np.searchsorted(cols.last_updated,
+                                      datetime_to_micros(at), side='right')
+                if cut == len(rows) and rows:
+                    break
+                state.apply(cols, done, cut)
+                done = cut
+                yield state.snapshot(at)
+                at += step
+            state.apply(cols, done)
+    finally:
+        cursor.close()
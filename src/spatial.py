@@ -0,0 +1,249 @@
+''' src.spatial
+
+    In memory spatial index of the stations, for "nearest stations with
+    bikes" and bounding box lookups, plus the region bounds kept on
+    system_regions.
+
+    Station_Index projects lat/lon onto a flat plane in meters
+    (equirectangular around the stations' latitude, well under 1% off
+    across a city) and buckets the stations into square grid cells.
+    knn searches rings of cells outwards from the point until nothing
+    closer can be left. Below scan_below stations a plain numpy scan
+    of every station is quicker than walking the cells, so small
+    systems use that. Updates move one station between cells, so
+    the index follows the dimension etl without a rebuild: register
+    index.on_load with bikeshare_etl.add_load_hook.
+
+    update_region_bounds runs as part of the station_information load
+    (see bikeshare_etl.load_data) and sets min/max lat and lon on each
+    region from its stations.
+'''
+
+import numpy as np
+from sqlalchemy import text
+
+from .models import Station_Information, System_Region
+
+
+EARTH_RADIUS = 6371008.8  # meters
+
+
+class Station_Index():
+    ''' Grid index of station locations, keyed by station_id.
+        Stations are packed in slots like Latest_Status. '''
+
+    def __init__(self, cell_size=500, origin_lat=None, capacity=1024,
+                 scan_below=2000):
+        self.cell_size = cell_size
+        self.scan_below = scan_below
+        # latitude the projection is scaled for, taken from the first
+        # station if not given
+        self.origin_lat = origin_lat
+        self.slots = {}  # station_id -> slot
+        self.cells = {}  # (cell x, cell y) -> set of slots
+        # min/max cell x and y, rebuilt when stations change
+        self.extent = None
+        self.station_ids = np.zeros(capacity, dtype=np.int64)
+        self.lat = np.zeros(capacity)
+        self.lon = np.zeros(capacity)
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+
+    @classmethod
+    def from_db(cls, session, cell_size=500):
+        ''' Index every station_information row with a location '''
+        rows = session.query(Station_Information.station_id,
+                             Station_Information.lat,
+                             Station_Information.lon).all()
+        located = [row for row in rows if row.lat is not None]
+        origin = (float(np.mean([float(row.lat) for row in located]))
+                  if located else None)
+        index = cls(cell_size, origin, capacity=max(len(rows), 1))
+        index.update(rows)
+        return index
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, station_id):
+        return station_id in self.slots
+
+    def ids(self):
+        ''' station_ids in slot order, what knn's mask lines up with '''
+        return self.station_ids[:len(self.slots)]
+
+    def project(self, lat, lon):
+        ''' lat/lon (scalars or arrays) to x, y in meters '''
+        scale = np.cos(np.radians(self.origin_lat))
+        return (np.radians(lon) * EARTH_RADIUS * scale,
+                np.radians(lat) * EARTH_RADIUS)
+
+    def cell(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def update(self, rows):
+        ''' Add or move stations, from rows with station_id, lat and lon.
+            A station whose lat or lon is None is removed. '''
+        for row in rows:
+            if row.lat is None or row.lon is None:
+                if row.station_id in self.slots:
+                    self.remove(row.station_id)
+                continue
+            self.set(row.station_id, float(row.lat), float(row.lon))
+
+    def set(self, station_id, lat, lon):
+        if self.origin_lat is None:
+            self.origin_lat = lat
+        slot = self.slots.get(station_id)
+        if slot is None:
+            slot = len(self.slots)
+            if slot == len(self.station_ids):
+                self.grow()
+            self.slots[station_id] = slot
+        else:
+            self.cells[self.cell(self.x[slot], self.y[slot])].discard(slot)
+        x, y = self.project(lat, lon)
+        self.extent = None
+        self.station_ids[slot] = station_id
+        self.lat[slot], self.lon[slot] = lat, lon
+        self.x[slot], self.y[slot] = x, y
+        self.cells.setdefault(self.cell(x, y), set()).add(slot)
+
+    def remove(self, station_id):
+        ''' Forget a station. The last slot is moved into its place. '''
+        slot = self.slots.pop(station_id)
+        self.extent = None
+        self.cells[self.cell(self.x[slot], self.y[slot])].discard(slot)
+        last = len(self.slots)
+        if slot != last:
+            cell = self.cells[self.cell(self.x[last], self.y[last])]
+            cell.discard(last)
+            cell.add(slot)
+            for array in (self.station_ids, self.lat, self.lon,
+                          self.x, self.y):
+                array[slot] = array[last]
+            self.slots[int(self.station_ids[slot])] = slot
+
+    def grow(self):
+        for name in ('station_ids', 'lat', 'lon', 'x', 'y'):
+            array = getattr(self, name)
+            bigger = np.zeros(len(array) * 2, dtype=array.dtype)
+            bigger[:len(array)] = array
+            setattr(self, name, bigger)
+
+    def ring(self, cx, cy, r):
+        ''' cells r cells away from (cx, cy), in chebyshev distance '''
+        if r == 0:
+            return [(cx, cy)]
+        cells = [(cx + dx, cy + dy) for dx in range(-r, r + 1)
+                 for dy in (-r, r)]
+        cells += [(cx + dx, cy + dy) for dx in (-r, r)
+                  for dy in range(-r + 1, r)]
+        return cells
+
+    def knn(self, lat, lon, k=5, mask=None):
+        ''' The k stations nearest lat/lon, as arrays of station_ids and
+            distances in meters, nearest first. mask (bool array lined up
+            with ids()) limits the search to some stations. '''
+        none = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        if not self.slots or k <= 0:
+            return none
+        x, y = self.project(lat, lon)
+        if len(self.slots) < self.scan_below:
+            return self.scan(x, y, k, mask)
+        cx, cy = self.cell(x, y)
+        if self.extent is None:
+            xs = [key[0] for key in self.cells]
+            ys = [key[1] for key in self.cells]
+            self.extent = (min(xs), max(xs), min(ys), max(ys))
+        min_x, max_x, min_y, max_y = self.extent
+        max_r = max(abs(cx - min_x), abs(cx - max_x),
+                    abs(cy - min_y), abs(cy - max_y))
+        best = np.zeros(0, dtype=np.int64)
+        best_dist = np.zeros(0)
+        for r in range(max_r + 1):
+            found = [slot for cell in self.ring(cx, cy, r)
+                     for slot in self.cells.get(cell, ())]
+            if found:
+                found = np.array(found, dtype=np.int64)
+                if mask is not None:
+                    found = found[mask[found]]
+                dist = np.hypot(self.x[found] - x, self.y[found] - y)
+                best = np.concatenate([best, found])
+                best_dist = np.concatenate([best_dist, dist])
+                if len(best) > k:
+                    keep = np.argpartition(best_dist, k - 1)[:k]
+                    best, best_dist = best[keep], best_dist[keep]
+            # anything in a further ring is at least r cells away
+            if len(best) == k and best_dist.max() <= r * self.cell_size:
+                break
+        order = np.argsort(best_dist, kind='stable')
+        return self.station_ids[best[order]], best_dist[order]
+
+    def scan(self, x, y, k, mask=None):
+        ''' knn by measuring every station '''
+        n = len(self.slots)
+        slots = np.arange(n) if mask is None else mask.nonzero()[0]
+        dist = np.hypot(self.x[slots] - x, self.y[slots] - y)
+        if len(slots) > k:
+            keep = np.argpartition(dist, k - 1)[:k]
+            slots, dist = slots[keep], dist[keep]
+        order = np.argsort(dist, kind='stable')
+        return self.station_ids[slots[order]], dist[order]
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        ''' station_ids inside the box, sorted. A filter over the arrays,
+            a city's stations fit in a few cache lines. '''
+        n = len(self.slots)
+        lat, lon = self.lat[:n], self.lon[:n]
+        inside = ((lat >= min_lat) & (lat <= max_lat) &
+                  (lon >= min_lon) & (lon <= max_lon))
+        return np.sort(self.station_ids[:n][inside])
+
+    def on_load(self, model, metadata, session):
+        ''' bikeshare_etl load hook: apply the stations that load
+            inserted or updated '''
+        if model is not Station_Information:
+            return
+        self.update(session.query(Station_Information.station_id,
+                                  Station_Information.lat,
+                                  Station_Information.lon).
+                    filter(Station_Information.load_id == metadata.load_id))
+
+
+def nearest_available(index, latest, lat, lon, k=5, min_bikes=1):
+    ''' The k stations nearest lat/lon that are renting and have at
+        least min_bikes bikes in latest (a Latest_Status). Returns
+        arrays of station_ids, distances in meters and bikes. '''
+    slots = latest.lookup(index.ids())
+    known = slots >= 0
+    slots = np.where(known, slots, 0)
+    bikes = latest.columns['num_bikes_available'][slots]
+    mask = known & (bikes >= min_bikes) & latest.columns['is_renting'][slots]
+    station_ids, distances = index.knn(lat, lon, k, mask)
+    found = latest.lookup(station_ids)
+    return (station_ids, distances,
+            latest.columns['num_bikes_available'][found].astype(np.int64))
+
+
+def update_region_bounds(session):
+    ''' Set each region's min/max lat and lon from its stations (NULL
+        for a region without any). Only regions whose bounds changed
+        are written. Runs on the session's transaction. '''
+    regions = System_Region.__tablename__
+    stations = Station_Information.__tablename__
+    bounds = ('min_lat', 'max_lat', 'min_lon', 'max_lon')
+    session.flush()
+    result = session.execute(text(
+        f'''UPDATE {regions} r
+            SET {', '.join(f'{col} = b.{col}' for col in bounds)}
+            FROM (SELECT g.region_id,
+                         min(i.lat) AS min_lat, max(i.lat) AS max_lat,
+                         min(i.lon) AS min_lon, max(i.lon) AS max_lon
+                  FROM {regions} g
+                  LEFT JOIN {stations} i ON i.region_id = g.region_id
+                  GROUP BY g.region_id) b
+            WHERE r.region_id = b.region_id
+            AND ({' OR '.join(f'r.{col} IS DISTINCT FROM b.{col}'
+                              for col in bounds)})'''))
+    return result.rowcount
@@ -0,0 +1,91 @@
+''' src.station_cache
+
+    The station_ids the CDC can write status rows for.
+
+    station_status has a foreign key to station_information, which is
+    only loaded by the dimension etl a couple of times a day. When the
+    system adds a station, its status rows would fail that key (and
+    take the rest of the tick down with them) until the next etl.
+    Known_Stations keeps the station_ids in memory, and when a tick has
+    rows for a station it doesn't know, runs the dimension etl right
+    away, at most once every min_interval seconds.
+'''
+
+from time import time
+
+import requests
+from sqlalchemy.exc import SQLAlchemyError
+
+from .bikeshare_etl import run_etl
+from .models import Station_Information, System_Region
+
+
+class Known_Stations():
+    ''' station_ids in station_information, refreshed on demand.
+        session can be left out and passed to each filter instead, for
+        callers that use a new session per call (see multi_cdc). The ids
+        are then read on the first filter. With min_interval None it
+        never refreshes, for systems whose dimension feeds aren't known,
+        and rows for unknown stations are only dropped. '''
+
+    def __init__(self, session=None, registry=None, min_interval=300):
+        self.session = session
+        self.registry = registry
+        self.min_interval = min_interval
+        self.last_refresh = None
+        self.refreshes = 0
+        self.dropped = 0
+        self.ids = self.load_ids(session) if session is not None else None
+
+    def load_ids(self, session):
+        return {station_id for station_id, in
+                session.query(Station_Information.station_id)}
+
+    def refresh_due(self):
+        if self.min_interval is None:
+            return False
+        return (self.last_refresh is None or
+                time() - self.last_refresh >= self.min_interval)
+
+    def refresh(self, session=None):
+        ''' Load the dimensions (regions too, a new station can be in a
+            new region) and reread the station_ids '''
+        session = session or self.session
+        self.last_refresh = time()
+        self.refreshes += 1
+        try:
+            run_etl([System_Region, Station_Information], session,
+                    bulk=True, registry=self.registry)
+        except (requests.RequestException, SQLAlchemyError,
+                ValueError, KeyError) as e:
+            session.rollback()
+            print(f'station refresh failed: {e}')
+        self.ids = self.load_ids(session)
+
+    def filter(self, rows, latest, session=None):
+        ''' Return the rows whose station is in station_information.
+            If some aren't, refresh (unless one ran recently). Rows for
+            stations that are still unknown are dropped, and the
+            stations are taken out of latest (a Latest_Status) so they
+            show up as new, and get written, once they're loaded. '''
+        session = session or self.session
+        if self.ids is None:
+            self.ids = self.load_ids(session)
+        unknown = {row.station_id for row in rows} - self.ids
+        if not unknown:
+            return rows
+        if self.refresh_due():
+            print(f'{len(unknown)} new stations, refreshing '
+                  'station_information')
+            self.refresh(session)
+            unknown -= self.ids
+            if not unknown:
+                return rows
+        for station_id in unknown:
+            if station_id in latest:
+                del latest[station_id]
+        kept = [row for row in rows if row.station_id not in unknown]
+        self.dropped += len(rows) - len(kept)
+        print(f'dropped {len(rows) - len(kept)} rows for unknown '
+              f'stations {sorted(unknown)}')
+        return kept
@@ -4,41 +4,135 @@ import json  # temp for test files
 import requests
 from time import time, sleep, strftime
 from datetime import datetime
+from functools import partial
 
-from sqlalchemy import and_
-from sqlalchemy.sql import func
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 
 from .utils import get_session
-from .models import Station_Status
+from .models import Station_Status, Station_Status_Latest, Cdc_Tick
+from .bulk_load import copy_rows, insert_rows
+from .status_diff import decode_feed, align_records, changed_mask
+from .latest_state import Latest_Status
+from .write_buffer import Write_Buffer
+from .scheduler import Poll_Scheduler
+from .feeds import Feed_State, fetch_feed
+from .timing import Phase_Timer
+from .registry import Feed_Registry, GBFS_DISCOVERY_URL, CACHE_FILE
+from .station_cache import Known_Stations
+from .status_intervals import update_intervals
+from .rollups import update_rollups
 
 
-def get_latest_from_db(session):
+# ways rows can be written by load_db.
+# orm goes through the session unit of work (one INSERT per row),
+# copy streams rows with COPY FROM STDIN,
+# values uses multi-row INSERT ... VALUES statements.
+WRITE_MODES = ('orm', 'copy', 'values')
+
+STATION_STATUS_URL =\
+    'https://gbfs.capitalbikeshare.com/gbfs/en/station_status.json'
+
+
+def get_latest_from_db(session, station_ids=None):
     ''' Get latest station_status data from database
-        Returns dict with station_id as key and object as value '''
-    # first define subquery which gets latest timestamp and ID
-    subq = session.query(func.max(Station_Status.last_updated).
-                         label('last_updated'),
-                         Station_Status.station_id).group_by(
-        Station_Status.station_id).subquery()
-
-    # get latest by joining station_status with subquery
-    latest = session.query(Station_Status).join(
-        subq, and_(Station_Status.last_updated == subq.c.last_updated,
-                   Station_Status.station_id == subq.c.station_id)).all()
-
-    latest_dict = {}
+        Returns Latest_Status keyed by station_id.
+        If station_ids is given, only those stations are returned.
+        Reads the station_status_latest table (one row per station).
+        If that is empty (new db, or rows were loaded some other way than
+        load_db) fall back to a DISTINCT ON over station_status and
+        fill station_status_latest so the next start up is cheap.
+        Both only touch station_ids' rows when it's given. '''
+    # only select columns, we just want copies of the data
+    # not ORM objects connected to the db
+    columns = [getattr(Station_Status_Latest, col)
+               for col in Station_Status.load_columns]
+    query = session.query(*columns)
+    if station_ids is not None:
+        query = query.filter(
+            Station_Status_Latest.station_id.in_(station_ids))
+    latest = query.all()
+
+    if not latest:
+        columns = [getattr(Station_Status, col)
+                   for col in Station_Status.load_columns]
+        query = session.query(*columns).\
+            distinct(Station_Status.station_id).\
+            order_by(Station_Status.station_id,
+                     Station_Status.last_updated.desc())
+        if station_ids is not None:
+            query = query.filter(Station_Status.station_id.in_(station_ids))
+        latest = query.all()
+        if latest:
+            rebuild_latest_table(session, station_ids)
+            session.commit()
+
+    latest_data = Latest_Status()
     for row in latest:
-        # need to expunge and make transient because
-        # we just want copies of the data, not connected to db
-        latest_dict[row.station_id] = row
-    return latest_dict
+        latest_data[row.station_id] = row
+    return latest_data
+
+
+def upsert_latest_sql(source):
+    ''' INSERT into station_status_latest from the newest row of each
+        station in source (a FROM clause over station_status s).
+        Rows only replace ones that aren't newer. '''
+    cols = ', '.join(Station_Status.load_columns)
+    s_cols = ', '.join(f's.{col}' for col in Station_Status.load_columns)
+    updates = ', '.join(f'{col} = EXCLUDED.{col}'
+                        for col in ('status_id',) +
+                        Station_Status.load_columns
+                        if col != 'station_id')
+    latest = Station_Status_Latest.__tablename__
+    return (f'''INSERT INTO {latest} (status_id, {cols})
+                SELECT DISTINCT ON (s.station_id) s.status_id, {s_cols}
+                FROM {source}
+                ORDER BY s.station_id, s.last_updated DESC
+                ON CONFLICT (station_id) DO UPDATE SET {updates}
+                WHERE {latest}.last_updated <= EXCLUDED.last_updated''')
+
 
+def update_latest_table(out, session):
+    ''' Bring station_status_latest up to date with the rows in out,
+        which must already be inserted into station_status.
+        Runs on the session so it's part of the same transaction. '''
+    if not out:
+        return
+    source = (f'''{Station_Status.__tablename__} s
+                 JOIN unnest(CAST(:station_ids AS integer[]),
+                             CAST(:last_updated AS timestamp[]))
+                     AS b (station_id, last_updated)
+                 ON s.station_id = b.station_id
+                 AND s.last_updated = b.last_updated
+                 AND s.last_updated BETWEEN :first AND :last''')
+    last_updated = [row.last_updated for row in out]
+    # the range lets postgres skip the other station_status partitions
+    session.execute(text(upsert_latest_sql(source)),
+                    {'station_ids': [row.station_id for row in out],
+                     'last_updated': last_updated,
+                     'first': min(last_updated),
+                     'last': max(last_updated)})
 
-def get_data_from_api():
+
+def rebuild_latest_table(session, station_ids=None):
+    ''' Fill station_status_latest from all of station_status, or just
+        station_ids' rows. Only needed once, after that load_db keeps
+        it current. '''
+    source = f'{Station_Status.__tablename__} s'
+    if station_ids is None:
+        session.execute(text(upsert_latest_sql(source)))
+        return
+    # each station is a probe of the (station_id, last_updated) index
+    source += ' WHERE s.station_id = ANY(CAST(:station_ids AS integer[]))'
+    session.execute(text(upsert_latest_sql(source)),
+                    {'station_ids': list(station_ids)})
+
+
+def get_data_from_api(url=STATION_STATUS_URL, http=requests):
     ''' Get data from api.
-        Make sure to return data, last_updated, and ttl '''
-    url = 'https://gbfs.capitalbikeshare.com/gbfs/en/station_status.json'
-    response = requests.get(url)
+        Make sure to return data, last_updated, and ttl
+        http can be a requests.Session to reuse connections. '''
+    response = http.get(url)
     # if response is not good, raise error
     response.raise_for_status()
     return response.json()
@@ -47,16 +141,26 @@ def get_data_from_api():
 def get_changed_data(new_data, latest_data):
     ''' Compare new data (generally from API) against latest data
         (generally from DB). New data should be a dict with at least keys
-        'data' and 'last_updated'. latest_data should be list of Station_Status
-        objects.
+        'data' and 'last_updated'. latest_data should be a Latest_Status
+        (or a dict of Station_Status objects) keyed by station_id.
         For each row in new data, append to output list if:
         A) Is not already in latest data (ie a new record). Also add to latest
         B) Is already in latest data, but has a changed value (ie update)
+        The feed is first compared column-wise with numpy (see
+        status_diff) and only the flagged rows are turned into
+        Station_Status objects and checked with row_is_new.
         Returns list with Station_Status objects to insert
         into DB as well as updated latest_data list
     '''
     out = []
-    for new_row in new_data['data']['stations']:
+    rows = new_data['data']['stations']
+    new_cols = decode_feed(new_data)
+    if isinstance(latest_data, Latest_Status):
+        old_cols, present = latest_data.columns_for(new_cols.station_id)
+    else:
+        old_cols, present = align_records(latest_data, new_cols.station_id)
+    for i in changed_mask(new_cols, old_cols, present).nonzero()[0]:
+        new_row = rows[i]
         new_row['last_updated'] = new_data['last_updated']
         new_obj = Station_Status(new_row)
         if row_is_new(new_obj, latest_data):
@@ -71,7 +175,7 @@ def row_is_new(new_obj, latest_data):
         If yes, and rows are different, it should be loaded.
     '''
 
-    if new_obj.station_id not in latest_data.keys():
+    if new_obj.station_id not in latest_data:
         print(f'new row! id: {new_obj.station_id}')
         return True
     else:
@@ -80,13 +184,36 @@ def row_is_new(new_obj, latest_data):
     return False
 
 
-def load_db(out, session):
-    ''' Load new data into db '''
-    session.add_all(out)
+def load_db(out, session, mode='orm', intervals=False, rollups=False):
+    ''' Load new data into db.
+        mode should be one of WRITE_MODES. copy and values
+        bypass the ORM so the whole batch goes in one round trip.
+        station_status_latest is updated in the same transaction,
+        and so are station_status_interval if intervals is True and
+        station_status_hourly if rollups is True. '''
+    if mode == 'orm':
+        session.add_all(out)
+    elif mode == 'copy':
+        copy_rows(out, Station_Status.__tablename__,
+                  Station_Status.load_columns, session)
+    elif mode == 'values':
+        insert_rows(out, Station_Status.__tablename__,
+                    Station_Status.load_columns, session)
+    else:
+        raise ValueError(f'mode should be one of {WRITE_MODES}')
+    # orm rows need to be sent before they can be read back
+    session.flush()
+    update_latest_table(out, session)
+    if intervals:
+        update_intervals(out, session)
+    if rollups:
+        update_rollups(out, session)
     session.commit()
 
 
-def station_status_cdc(session):
+def station_status_cdc(session, write_mode='orm', buffer=None,
+                       scheduler=None, registry=None, retry_delay=10,
+                       intervals=False, rollups=False):
     ''' Get latest DB data and new API data.
         Iterate through API data. Compare against
         latest. If an API row is new, add to output
@@ -94,21 +221,92 @@ def station_status_cdc(session):
         Once all API rows have been checked,
         load output list, then sleep until the
         API should be refreshed.
+        write_mode, intervals and rollups are passed through to load_db.
+        If a Write_Buffer is passed, changed rows are handed to it
+        instead of being loaded before the sleep. It is closed
+        (and flushed) when the loop stops.
+        If a Poll_Scheduler is passed, it picks the sleep time
+        instead of the feed's ttl.
+        Fetches of a version we've already seen are skipped before
+        parsing (see feeds.fetch_feed).
+        Each tick's phase timings are saved as a cdc_tick row,
+        a batch at a time (see Tick_Log).
+        The feed url comes from registry (a Feed_Registry, capital
+        bikeshare's by default). If a fetch fails, the url is looked
+        up again and the poll retried after retry_delay. A failed load
+        is rolled back and the same version retried after retry_delay.
+        Rows for stations that aren't in station_information yet
+        trigger a dimension refresh (see station_cache.Known_Stations).
     '''
+    registry = registry or Feed_Registry(cache_file=CACHE_FILE)
     latest_data = get_latest_from_db(session)
+    known_stations = Known_Stations(session, registry)
+    feed_state = Feed_State()
+    tick_log = Tick_Log(session)
     while True:  # loop until ^C pressed
         try:
-            new_data = get_data_from_api()
-            print(f'got data for {new_data["last_updated"]} at {time():.2f}')
-            out, latest_data = get_changed_data(new_data, latest_data)
-            if len(out) > 0:
-                load_db(out, session)
+            timer = Phase_Timer()
+            try:
+                new_data, version = fetch_feed(
+                    registry.feed_url('station_status'), feed_state,
+                    timer=timer)
+            except requests.RequestException as e:
+                # the feed may have moved, rediscover it next time
+                registry.invalidate()
+                print(f'fetch failed: {e}. retrying in {retry_delay}')
+                sleep(retry_delay)
+                continue
+            fetched_at = time()
+            if new_data is None:
+                # same version as last time, nothing to parse or load
+                print(f'same data for {feed_state.last_updated}, skipped '
+                      f'({feed_state.skipped()} of {feed_state.fetches})')
+                tick_log.add(Cdc_Tick(timer, feed_state.last_updated,
+                                      skipped=True,
+                                      lag=freshness_lag(
+                                          feed_state.last_updated,
+                                          fetched_at)))
+                sleep(wait_time(feed_state.last_updated, feed_state.ttl,
+                                fetched_at, scheduler, retry_delay))
+                continue
+            lag = freshness_lag(new_data['last_updated'], fetched_at)
+            print(f'got data for {new_data["last_updated"]} at '
+                  f'{fetched_at:.2f}, freshness lag {lag:.2f}s')
+            with timer.phase('diff'):
+                # to put back if the load fails, buffered rows are
+                # retried by the buffer itself
+                before = latest_data.snapshot() if buffer is None else None
+                out, latest_data = get_changed_data(new_data, latest_data)
+                # new stations would fail the station_information FK
+                out = known_stations.filter(out, latest_data)
+            if len(out) > 0 and buffer is not None:
+                with timer.phase('load'):
+                    buffer.add(out)
+                print(f'queued {len(out)} rows '
+                      f'for {new_data["last_updated"]}')
+            elif len(out) > 0:
+                try:
+                    with timer.phase('load'):
+                        load_db(out, session, write_mode, intervals,
+                                rollups)
+                except SQLAlchemyError as e:
+                    # put the state back, this version isn't accepted
+                    # so the next fetch gets it and finds the rows again
+                    session.rollback()
+                    latest_data = Latest_Status.restore(before)
+                    print(f'load failed: {e}. retrying in {retry_delay}')
+                    sleep(retry_delay)
+                    continue
                 print(f'inserted {len(out)} rows at '
                       f'{datetime.strftime(datetime.now(),"%c")} '
                       f'for {new_data["last_updated"]}')
             else:
                 print('no changes. nothing to load '
                       f'for {new_data["last_updated"]}')
+            feed_state.accept(version)
+            tick_log.add(Cdc_Tick(timer, new_data['last_updated'],
+                                  len(out), lag=lag))
+            print(timer.report())
             ''' So let's talk timestamps. I originally wrote
                 logic to calculate sleep time based on last_update
                 and ttl. This didn't guarantee new files. Testing
@@ -118,16 +316,126 @@ def station_status_cdc(session):
                 it's preferable to potentially get an update a
                 few seconds late rather than repeatedly pulling
                 the same data. '''
-            sleep_time = new_data['ttl']
-            print(f'got data. will check again in {sleep_time}')
+            sleep_time = wait_time(new_data['last_updated'],
+                                   new_data['ttl'], fetched_at, scheduler,
+                                   retry_delay)
+            print(f'got data. will check again in {sleep_time:.2f}')
             sleep(sleep_time)
         except KeyboardInterrupt:
             break
+    if buffer is not None:
+        buffer.close()
+        if buffer.dead_rows:
+            print(f'{buffer.dead_rows} rows could not be written '
+                  'and were dropped')
+    tick_log.flush()
+    print(f'{tick_log.written} cdc ticks saved, {tick_log.dropped} dropped')
+    print(f'skipped {feed_state.skipped()} of {feed_state.fetches} '
+          f'fetches: {feed_state.skips}')
+    print(f'{known_stations.refreshes} station refreshes, '
+          f'{known_stations.dropped} rows dropped for unknown stations')
+    if scheduler is not None:
+        print(f'poll stats: {scheduler.stats()}')
+
+
+class Tick_Log():
+    ''' Collects Cdc_Ticks and writes them every batch_ticks ticks,
+        so the metrics cost one small transaction per batch rather than
+        one per poll. A failed write is rolled back and the ticks are
+        kept for the next try (at most max_ticks, oldest dropped first).
+        Metrics never stop the CDC, errors are only printed. '''
+
+    def __init__(self, session, batch_ticks=30, max_ticks=1000):
+        self.session = session
+        self.batch_ticks = batch_ticks
+        self.max_ticks = max_ticks
+        self.ticks = []
+        # stats
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def add(self, tick):
+        self.ticks.append(tick)
+        if len(self.ticks) > self.max_ticks:
+            self.dropped += len(self.ticks) - self.max_ticks
+            self.ticks = self.ticks[-self.max_ticks:]
+        if len(self.ticks) >= self.batch_ticks:
+            self.flush()
+
+    def flush(self):
+        ''' Write the waiting ticks. Returns False if that failed. '''
+        if not self.ticks:
+            return True
+        try:
+            save_ticks(self.ticks, self.session)
+        except SQLAlchemyError as e:
+            # the session is shared with load_db, leave it usable
+            self.session.rollback()
+            self.failures += 1
+            print(f'could not save {len(self.ticks)} cdc ticks: {e}')
+            return False
+        self.written += len(self.ticks)
+        self.ticks = []
+        return True
+
+
+def save_ticks(ticks, session):
+    ''' Write Cdc_Ticks in one small transaction '''
+    session.add_all(ticks)
+    session.commit()
+
+
+def wait_time(last_updated, ttl, fetched_at, scheduler=None,
+              retry_delay=10):
+    ''' Seconds to sleep before the next poll. Without a scheduler
+        that's the ttl. The scheduler aims for just after the next
+        version is published, and backs off when it pulls duplicates.
+        Before any version has been loaded there's no ttl yet,
+        so it's retry_delay. '''
+    if last_updated is None or ttl is None:
+        return retry_delay
+    if scheduler is None:
+        return ttl
+    scheduler.observe(last_updated, ttl, fetched_at, time() - fetched_at)
+    return scheduler.next_delay(time())
+
+
+def freshness_lag(last_updated, fetched_at):
+    ''' Seconds from a version's last_updated until we had it, None
+        before there's a version. Same as Poll_Scheduler.observe
+        returns, but kept without the scheduler too, as the baseline. '''
+    if last_updated is None:
+        return None
+    return fetched_at - last_updated
 
 
-def main():
+def main(write_mode='orm', group_commit=False, flush_rows=5000,
+         flush_age=30, max_batches=100, adaptive=False, discovery_url=None,
+         intervals=False, rollups=False):
+    ''' Run the CDC against the dev db.
+        With group_commit, writes go through a Write_Buffer which
+        flushes every flush_rows rows or flush_age seconds.
+        With adaptive, a Poll_Scheduler times the polls.
+        discovery_url is the system's gbfs.json, capital bikeshare's
+        by default.
+        With intervals and rollups, station_status_interval and
+        station_status_hourly are kept up to date too. '''
     session = get_session()
-    station_status_cdc(session)
+    registry = Feed_Registry(discovery_url or GBFS_DISCOVERY_URL,
+                             cache_file=CACHE_FILE)
+    scheduler = Poll_Scheduler() if adaptive else None
+    buffer = None
+    if group_commit:
+        buffer = Write_Buffer(partial(load_db, mode=write_mode,
+                                      intervals=intervals,
+                                      rollups=rollups),
+                              get_session,
+                              max_rows=flush_rows,
+                              max_age=flush_age,
+                              max_batches=max_batches)
+    station_status_cdc(session, write_mode, buffer, scheduler, registry,
+                       intervals=intervals, rollups=rollups)
     session.close()
     print('\nokay session closed')
 
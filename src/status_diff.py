@@ -0,0 +1,183 @@
+''' src.status_diff
+
+    Columnar change detection for station_status feeds.
+
+    The feed is decoded into numpy arrays (one per compared attribute)
+    and checked against the previous snapshot in one vectorized pass.
+    Only rows flagged here need a Station_Status object built and
+    compared with Station_Status.__eq__, so quiet ticks cost a few
+    array comparisons instead of one ORM object per station.
+
+    Timestamps are kept as int64 microseconds since the epoch so they
+    convert back to the exact datetime Station_Status would hold.
+'''
+
+from datetime import datetime, timedelta
+from math import floor
+
+import numpy as np
+
+
+# stands in for None in count columns. counts are never negative,
+# and -inf == -inf so two missing values compare equal like None == None
+NULL_COUNT = float('-inf')
+
+# the attributes compared by Station_Status.__eq__
+COUNT_COLUMNS = ('num_bikes_available', 'num_bikes_disabled',
+                 'num_docks_available', 'num_docks_disabled')
+FLAG_COLUMNS = ('is_installed', 'is_renting', 'is_returning')
+OPTIONAL_COLUMNS = ('num_bikes_disabled', 'num_docks_disabled')
+
+
+class Status_Columns():
+    ''' Station status attributes stored as parallel numpy arrays.
+        Row i of every array describes station station_id[i].
+        last_reported is microseconds since the epoch. '''
+
+    def __init__(self, station_id, counts, flags, last_reported):
+        self.station_id = station_id
+        self.counts = counts
+        self.flags = flags
+        self.last_reported = last_reported
+
+    def __len__(self):
+        return len(self.station_id)
+
+
+def count_value(value):
+    if value is None:
+        return NULL_COUNT
+    return value
+
+
+def to_micros(epoch):
+    ''' Seconds since the epoch (int or float, as found in the feed) to
+        int microseconds, rounded the same way datetime.fromtimestamp does '''
+    if isinstance(epoch, int):
+        return epoch * 1000000
+    seconds = floor(epoch)
+    return int(seconds) * 1000000 + round((epoch - seconds) * 1e6)
+
+
+def datetime_to_micros(value):
+    ''' Naive local datetime (as stored by Station_Status) to int
+        microseconds since the epoch. Inverse of micros_to_datetime. '''
+    seconds = int(value.replace(microsecond=0).timestamp())
+    return seconds * 1000000 + value.microsecond
+
+
+# DST changes fall on these boundaries of wall clock time
+WALL_BUCKET = 15 * 60 * 1000000
+
+
+def wall_micros_to_micros(wall):
+    ''' datetime_to_micros for an int64 array of local wall clock times,
+        given as microseconds since 1970-01-01 00:00 (what postgres'
+        extract(epoch) returns for a timestamp without time zone).
+        The utc offset is looked up once per WALL_BUCKET. '''
+    buckets, inverse = np.unique(wall // WALL_BUCKET, return_inverse=True)
+    starts = buckets * WALL_BUCKET
+    offsets = np.fromiter(
+        (start - datetime_to_micros(datetime(1970, 1, 1) +
+                                    timedelta(microseconds=start))
+         for start in starts.tolist()),
+        dtype=np.int64, count=len(starts))
+    return wall - offsets[inverse.reshape(-1)]
+
+
+TIMESTAMP_COLUMNS = ('last_updated', 'last_reported')
+
+
+def column_sql(col, table=None):
+    ''' col as selected for column_array. Timestamps come back as wall
+        clock microseconds, parsing them into datetimes would cost more
+        than the rest of the fetch. '''
+    name = f'{table}.{col}' if table else col
+    if col in TIMESTAMP_COLUMNS:
+        return f'(extract(epoch FROM {name}) * 1000000)::bigint'
+    return name
+
+
+def column_array(col, values):
+    ''' A station_status column fetched with column_sql as a numpy array.
+        Timestamps are microseconds since the epoch, counts are float
+        with NULL_COUNT for NULL, flags are bool and the rest int64. '''
+    if col in TIMESTAMP_COLUMNS:
+        return wall_micros_to_micros(np.array(values, dtype=np.int64))
+    if col in COUNT_COLUMNS:
+        # None comes through as nan
+        counts = np.array(values, dtype=np.float64)
+        counts[np.isnan(counts)] = NULL_COUNT
+        return counts
+    if col in FLAG_COLUMNS:
+        return np.array(values, dtype=np.bool_)
+    return np.array(values, dtype=np.int64)
+
+
+def micros_to_datetime(micros):
+    return (datetime.fromtimestamp(micros // 1000000) +
+            timedelta(microseconds=micros % 1000000))
+
+
+def decode_feed(new_data):
+    ''' Decode the stations in a station_status feed into Status_Columns.
+        Required keys raise KeyError same as Station_Status would. '''
+    rows = new_data['data']['stations']
+    n = len(rows)
+    station_id = np.fromiter((int(r['station_id']) for r in rows),
+                             dtype=np.int64, count=n)
+    counts = {}
+    for col in COUNT_COLUMNS:
+        if col in OPTIONAL_COLUMNS:
+            values = (count_value(r.get(col)) for r in rows)
+        else:
+            values = (count_value(r[col]) for r in rows)
+        counts[col] = np.fromiter(values, dtype=np.float64, count=n)
+    flags = {col: np.fromiter((bool(r[col]) for r in rows),
+                              dtype=np.bool_, count=n)
+             for col in FLAG_COLUMNS}
+    last_reported = np.fromiter((to_micros(r['last_reported'])
+                                 for r in rows),
+                                dtype=np.int64, count=n)
+    return Status_Columns(station_id, counts, flags, last_reported)
+
+
+def align_records(latest_data, station_ids):
+    ''' Build Status_Columns from a dict of {station_id: Station_Status},
+        lined up with station_ids. Also returns a boolean array which is
+        False where a station isn't in latest_data yet. '''
+    n = len(station_ids)
+    present = np.zeros(n, dtype=np.bool_)
+    counts = {col: np.full(n, NULL_COUNT) for col in COUNT_COLUMNS}
+    flags = {col: np.zeros(n, dtype=np.bool_) for col in FLAG_COLUMNS}
+    last_reported = np.zeros(n, dtype=np.int64)
+    for i, station_id in enumerate(station_ids.tolist()):
+        record = latest_data.get(station_id)
+        if record is None:
+            continue
+        present[i] = True
+        for col in COUNT_COLUMNS:
+            counts[col][i] = count_value(getattr(record, col))
+        for col in FLAG_COLUMNS:
+            flags[col][i] = getattr(record, col)
+        last_reported[i] = datetime_to_micros(record.last_reported)
+    return Status_Columns(station_ids, counts, flags, last_reported), present
+
+
+def changed_mask(new, old, present):
+    ''' Return boolean array, True where row i of new differs from row i
+        of old or the station isn't present in old.
+        Stations that show up more than once in new are always flagged,
+        so the caller can compare them in feed order. '''
+    changed = ~present
+    for col in COUNT_COLUMNS:
+        changed |= new.counts[col] != old.counts[col]
+    for col in FLAG_COLUMNS:
+        changed |= new.flags[col] != old.flags[col]
+    changed |= new.last_reported != old.last_reported
+    if len(new) > 0:
+        _, inverse, counts = np.unique(new.station_id,
+                                       return_inverse=True,
+                                       return_counts=True)
+        changed |= counts[inverse] > 1
+    return changed
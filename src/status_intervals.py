@@ -0,0 +1,102 @@
+''' src.status_intervals
+
+    station_status as intervals: each row is the state of a station
+    from valid_from until valid_to (the next change).
+
+    The CDC only inserts a row when a station changes, so a
+    station_status row is really the start of an interval, and asking
+    "what was station X at time T" otherwise means finding the newest
+    row before T with a window or a sort. station_status_interval keeps
+    the end on the row, so it's one probe of its primary key.
+
+    load_db(..., intervals=True) keeps it up to date after each insert.
+    rebuild_intervals fills it from the whole of station_status (for an
+    existing database, or after a backfill).
+'''
+
+from sqlalchemy import text
+
+from .models import Station_Status, Station_Status_Interval
+
+
+STATUS_COLUMNS = ('num_bikes_available', 'num_bikes_disabled',
+                  'num_docks_available', 'num_docks_disabled',
+                  'is_installed', 'is_renting', 'is_returning',
+                  'last_reported')
+
+
+def insert_intervals_sql(source):
+    ''' INSERT an interval for each station_status row in source (a FROM
+        clause over station_status s). Within source, each row ends at
+        the next row of its station. The newest row of each station
+        is left open. '''
+    cols = ', '.join(STATUS_COLUMNS)
+    s_cols = ', '.join(f's.{col}' for col in STATUS_COLUMNS)
+    intervals = Station_Status_Interval.__tablename__
+    return (f'''INSERT INTO {intervals}
+                    (station_id, valid_from, valid_to, {cols})
+                SELECT s.station_id, s.last_updated,
+                       lead(s.last_updated) OVER (PARTITION BY s.station_id
+                                                  ORDER BY s.last_updated),
+                       {s_cols}
+                FROM {source}''')
+
+
+def update_intervals(out, session):
+    ''' Close the open interval of each station in out, and add the
+        intervals for out, which must already be in station_status.
+        Rows have to be newer than the station's open interval, as
+        they are from the CDC. Runs on the session's transaction. '''
+    if not out:
+        return
+    intervals = Station_Status_Interval.__tablename__
+    last_updated = [row.last_updated for row in out]
+    params = {'station_ids': [row.station_id for row in out],
+              'last_updated': last_updated,
+              'first': min(last_updated),
+              'last': max(last_updated)}
+    batch = '''unnest(CAST(:station_ids AS integer[]),
+                      CAST(:last_updated AS timestamp[]))
+                   AS b (station_id, last_updated)'''
+    session.execute(text(
+        f'''UPDATE {intervals} i SET valid_to = b.first
+            FROM (SELECT station_id, min(last_updated) AS first
+                  FROM {batch}
+                  GROUP BY station_id) b
+            WHERE i.station_id = b.station_id
+            AND i.valid_to IS NULL
+            AND i.valid_from < b.first'''), params)
+    source = (f'''{Station_Status.__tablename__} s
+                 JOIN {batch}
+                 ON s.station_id = b.station_id
+                 AND s.last_updated = b.last_updated
+                 AND s.last_updated BETWEEN :first AND :last''')
+    session.execute(text(insert_intervals_sql(source)), params)
+
+
+def rebuild_intervals(session):
+    ''' Replace station_status_interval with intervals for all of
+        station_status. Caller commits. '''
+    session.execute(f'DELETE FROM {Station_Status_Interval.__tablename__}')
+    source = f'{Station_Status.__tablename__} s'
+    session.execute(text(insert_intervals_sql(source)))
+
+
+# built once, status_at runs a lot and compiling an ORM query each
+# time costs more than the lookup
+STATUS_AT_SQL = text(
+    f'''SELECT station_id, valid_from, valid_to, {', '.join(STATUS_COLUMNS)}
+        FROM {Station_Status_Interval.__tablename__}
+        WHERE station_id = :station_id
+        AND valid_from <= :at
+        AND (valid_to IS NULL OR valid_to > :at)
+        ORDER BY valid_from DESC
+        LIMIT 1''')
+
+
+def status_at(session, station_id, at):
+    ''' The interval station_id was in at datetime at, as a row with
+        the station_status_interval columns, or None if there's no
+        status for it then. '''
+    return session.execute(STATUS_AT_SQL, {'station_id': station_id,
+                                           'at': at}).fetchone()
@@ -0,0 +1,71 @@
+''' src.timing
+
+    Lightweight per-phase timing for loads and CDC ticks.
+
+        timer = Phase_Timer()
+        with timer.phase('fetch') as fetch:
+            response = requests.get(url)
+            fetch.bytes = len(response.content)
+
+    Phases with the same name add up. Whatever uses the timer decides
+    where the numbers end up (load_phase rows, cdc_tick rows, print).
+'''
+
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class Phase():
+    ''' Time spent in one phase, and optionally what it handled '''
+
+    __slots__ = ('name', 'secs', 'rows', 'bytes')
+
+    def __init__(self, name):
+        self.name = name
+        self.secs = 0.0
+        self.rows = None
+        self.bytes = None
+
+    def rows_per_sec(self):
+        if not self.rows or not self.secs:
+            return None
+        return self.rows / self.secs
+
+    def __repr__(self):
+        return (f'<Phase({self.name} {self.secs:.4f}s '
+                f'rows={self.rows} bytes={self.bytes})>')
+
+
+class Phase_Timer():
+    ''' Collects Phases in the order they first ran '''
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        ''' Time the with block. Yields the Phase so rows/bytes
+            can be set on it. '''
+        record = self.phases.get(name)
+        if record is None:
+            record = self.phases[name] = Phase(name)
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            record.secs += perf_counter() - start
+
+    def secs(self, name):
+        ''' seconds spent in a phase, 0 if it never ran '''
+        record = self.phases.get(name)
+        return record.secs if record is not None else 0.0
+
+    def report(self):
+        ''' one line summary for logging '''
+        parts = []
+        for record in self.phases.values():
+            part = f'{record.name} {record.secs:.3f}s'
+            if record.rows_per_sec() is not None:
+                part += f' ({record.rows_per_sec():.0f} rows/s)'
+            parts.append(part)
+        return ', '.join(parts)
@@ -1,16 +1,34 @@
 # Common utils used in different scripts
 from os import environ
+from threading import Lock
+from time import perf_counter
+from uuid import uuid4
 
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as Pool_Timeout
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 
-def get_session(env='DEV', echo=False):
-    ''' Create db connection and sqlalchemy engine
-        Return a session to interact with db
+# pool settings used for an engine unless configure_engine says otherwise.
+# statement_timeout is in ms, None leaves the server's setting
+POOL_DEFAULTS = {'pool_size': 5,
+                 'max_overflow': 10,
+                 'pool_timeout': 30,
+                 'pool_recycle': 1800,
+                 'pool_pre_ping': True,
+                 'statement_timeout': None}
 
-        Echo defaults to False, but if you want for debugging,
-        just pass echo=True and sql statements will print to console'''
+# (env, role) -> engine, one per process
+ENGINES = {}
+ENGINE_OPTIONS = {}
+ENGINES_LOCK = Lock()
+
+
+def get_db_url(env='DEV', role='write'):
+    ''' Build the postgres connection url for an environment.
+        The read role connects to POSTGRES_READ_HOST (a replica)
+        if it's set, else the same server as writes. '''
     if env == 'DEV':
         pg_user = environ['POSTGRES_USER']
         pg_pw = environ['POSTGRES_PW']
@@ -21,13 +39,135 @@ def get_session(env='DEV', echo=False):
         db = 'bikeshare_tst'
 
     host = 'localhost'
+    if role == 'read':
+        host = environ.get('POSTGRES_READ_HOST', host)
     port = '5432'
-    engine = create_engine(f'postgres://{pg_user}:{pg_pw}@{host}:{port}/{db}',
-                            echo=echo)
-    Session = sessionmaker(bind=engine)
+    return f'postgres://{pg_user}:{pg_pw}@{host}:{port}/{db}'
+
+
+class Timed_Pool(QueuePool):
+    ''' QueuePool that counts checkouts and how long they waited for
+        a free connection, to see pool contention '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_secs = 0.0
+        self.max_wait_secs = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except Pool_Timeout:
+            self.timeouts += 1
+            raise
+        finally:
+            wait = perf_counter() - start
+            self.checkouts += 1
+            self.wait_secs += wait
+            self.max_wait_secs = max(self.max_wait_secs, wait)
+
+    def stats(self):
+        return {'size': self.size(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_secs': self.wait_secs,
+                'max_wait_secs': self.max_wait_secs}
+
+
+def configure_engine(env='DEV', role='write', **options):
+    ''' Set pool options (see POOL_DEFAULTS) for an engine. An engine
+        that already exists is replaced: sessions already bound to it
+        keep working, new ones get the new pool. '''
+    unknown = set(options) - set(POOL_DEFAULTS)
+    if unknown:
+        raise ValueError(f'unknown engine options: {sorted(unknown)}')
+    with ENGINES_LOCK:
+        ENGINE_OPTIONS[(env, role)] = {**ENGINE_OPTIONS.get((env, role), {}),
+                                       **options}
+        engine = ENGINES.pop((env, role), None)
+    if engine is not None:
+        engine.dispose()
+
+
+def get_engine(env='DEV', role='write', echo=False):
+    ''' The process' sqlalchemy engine for env and role ('write' or
+        'read'), created on first use. Read engines open read only
+        transactions. echo=True gives a view of the engine that logs
+        its sql, sharing the pool, so the shared engine stays quiet. '''
+    key = (env, role)
+    with ENGINES_LOCK:
+        engine = ENGINES.get(key)
+        if engine is None:
+            options = {**POOL_DEFAULTS, **ENGINE_OPTIONS.get(key, {})}
+            settings = []
+            timeout = options.pop('statement_timeout')
+            if timeout is not None:
+                settings.append(f'-c statement_timeout={timeout}')
+            if role == 'read':
+                settings.append('-c default_transaction_read_only=on')
+            connect_args = {'options': ' '.join(settings)} if settings else {}
+            engine = create_engine(get_db_url(env, role),
+                                   poolclass=Timed_Pool,
+                                   connect_args=connect_args,
+                                   **options)
+            ENGINES[key] = engine
+    if echo:
+        engine = engine.execution_options()
+        engine.echo = True
+    return engine
+
+
+def pool_stats():
+    ''' {(env, role): pool stats} for every engine made so far '''
+    with ENGINES_LOCK:
+        return {key: engine.pool.stats() for key, engine in ENGINES.items()}
+
+
+def dispose_engines():
+    ''' Close every pooled connection and forget the engines '''
+    with ENGINES_LOCK:
+        engines = list(ENGINES.values())
+        ENGINES.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+def server_cursor(session, prefix, itersize=None):
+    ''' A psycopg2 server-side (named) cursor on the session's
+        connection and transaction. Names share the connection's
+        namespace, so each gets a uuid to keep two open reads apart. '''
+    cursor = session.connection().connection.cursor(
+        name=f'{prefix}_{uuid4().hex}')
+    if itersize is not None:
+        cursor.itersize = itersize
+    return cursor
+
+
+def get_session(env='DEV', echo=False, role='write'):
+    ''' Return a session to interact with db, on the shared engine
+        for env and role
+
+        Echo defaults to False, but if you want for debugging,
+        just pass echo=True and sql statements will print to console'''
+    Session = sessionmaker(bind=get_engine(env, role, echo))
 
     return Session()
 
 
+def get_sessionmaker(env='DEV', echo=False, role='write', **options):
+    ''' Return a sessionmaker bound to the shared engine for env and
+        role. Every session made from it shares the engine's
+        connection pool. Pool options (e.g. pool_size, max_overflow)
+        reconfigure the engine first, see configure_engine. '''
+    if options:
+        configure_engine(env, role, **options)
+    return sessionmaker(bind=get_engine(env, role, echo))
+
+
 if __name__ == '__main__':
     print('Why are you running this? It should only be imported.')
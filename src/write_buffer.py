@@ -0,0 +1,149 @@
+''' src.write_buffer
+
+    Group commit for the CDC loop.
+
+    Changed rows from each tick are handed to a Write_Buffer, which
+    writes them from a background thread once enough rows have built up,
+    the oldest row is old enough, or the buffer is closed.
+    The poll loop only waits on the database when the bounded queue is
+    full, so a slow commit stretches the flush interval instead of
+    delaying the next poll.
+    While a failed flush is being retried nothing more is taken off the
+    queue, so a database that's down pushes back on the poll loop
+    instead of growing the buffer. After max_retries failed tries the
+    rows are given up on and go to the dead letters.
+'''
+
+import queue
+import threading
+from time import monotonic, sleep
+
+
+class Write_Buffer():
+    ''' Buffer rows and write them in batches on a writer thread.
+
+        load is called as load(rows, session) and should commit,
+        ie station_status_cdc.load_db.
+        session_factory returns a new session for the writer thread
+        (sessions shouldn't be shared across threads).
+        A flush happens when max_rows rows are waiting, when the oldest
+        waiting row is max_age seconds old, or on close.
+        At most max_batches ticks can be queued ahead of the writer.
+        After that add() blocks until the writer catches up.
+        A failed flush is tried again every retry_delay seconds, up to
+        max_retries times. Then the rows are passed to dead_letter(rows)
+        if given, or kept in self.dead_letters, and the writer moves on. '''
+
+    STOP = object()
+
+    def __init__(self, load, session_factory, max_rows=5000, max_age=30,
+                 max_batches=100, retry_delay=5, max_retries=5,
+                 dead_letter=None):
+        self.load = load
+        self.session_factory = session_factory
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter
+        self.dead_letters = []
+        self.queue = queue.Queue(maxsize=max_batches)
+        # stats
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.dead_rows = 0
+        self.last_flush_secs = None
+        self.thread = threading.Thread(target=self.run,
+                                       name='write_buffer',
+                                       daemon=True)
+        self.thread.start()
+
+    def add(self, rows):
+        ''' Queue a tick's changed rows. Blocks if the queue is full. '''
+        if rows:
+            self.queue.put(list(rows))
+
+    def close(self):
+        ''' Write anything still buffered and stop the writer thread '''
+        self.queue.put(self.STOP)
+        self.thread.join()
+
+    def pending(self):
+        ''' number of ticks queued but not yet picked up by the writer '''
+        return self.queue.qsize()
+
+    def run(self):
+        session = self.session_factory()
+        rows = []
+        oldest = None
+        stopping = False
+        retries = 0
+        try:
+            while not stopping or rows:
+                batches = []
+                if retries:
+                    # leave the queue alone until these rows are written,
+                    # add() blocks once it fills up
+                    sleep(self.retry_delay)
+                else:
+                    if rows:
+                        timeout = max(0, oldest + self.max_age - monotonic())
+                    else:
+                        timeout = None
+                    try:
+                        batches.append(self.queue.get(timeout=timeout))
+                        # take everything else that's waiting too, so a
+                        # slow flush is followed by one bigger flush
+                        while True:
+                            batches.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        pass
+                for batch in batches:
+                    if batch is self.STOP:
+                        stopping = True
+                        continue
+                    if not rows:
+                        oldest = monotonic()
+                    rows.extend(batch)
+                if rows and (stopping or retries or
+                             len(rows) >= self.max_rows or
+                             monotonic() - oldest >= self.max_age):
+                    if self.flush(rows, session):
+                        rows = []
+                        retries = 0
+                        continue
+                    retries += 1
+                    if retries >= self.max_retries:
+                        self.give_up(rows)
+                        rows = []
+                        retries = 0
+        finally:
+            session.close()
+
+    def give_up(self, rows):
+        ''' Hand rows that couldn't be written to the dead letters '''
+        print(f'write buffer gave up on {len(rows)} rows '
+              f'after {self.max_retries} tries')
+        self.dead_rows += len(rows)
+        if self.dead_letter is not None:
+            self.dead_letter(rows)
+        else:
+            self.dead_letters.append(rows)
+
+    def flush(self, rows, session):
+        ''' Write rows with self.load. Returns False if it failed
+            (rows are kept and tried again, see run). '''
+        start = monotonic()
+        try:
+            self.load(rows, session)
+        except Exception as e:
+            session.rollback()
+            self.failures += 1
+            print(f'write buffer flush of {len(rows)} rows failed: {e}')
+            return False
+        self.last_flush_secs = monotonic() - start
+        self.flushes += 1
+        self.rows_written += len(rows)
+        print(f'flushed {len(rows)} rows in {self.last_flush_secs:.2f}s')
+        return True
@@ -0,0 +1,104 @@
+''' tests.test_archive '''
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+
+from src.archive import export_days, read_archive, read_manifest
+from src.models import Station_Status
+from src.station_status_cdc import load_db
+from src.status_diff import datetime_to_micros
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+def status_row(when, station_id, bikes):
+    timestamp = when.timestamp()
+    return Station_Status({'last_updated': timestamp,
+                           'station_id': station_id,
+                           'num_bikes_available': bikes,
+                           'num_docks_available': 15 - bikes,
+                           'is_installed': 1,
+                           'is_renting': 1,
+                           'is_returning': 1,
+                           'last_reported': timestamp})
+
+
+def empty_tables(session):
+    session.query(Station_Status).delete()
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = get_session(env='TST', echo=False)
+        empty_tables(self.session)
+        self.archive_dir = tempfile.mkdtemp()
+        rows = [status_row(datetime(2017, 8, day, hour), station_id, hour)
+                for day in (1, 3)
+                for hour in (0, 9, 23)
+                for station_id in (1, 2, 3)]
+        load_db(rows, self.session, 'copy')
+
+    def tearDown(self):
+        empty_tables(self.session)
+        self.session.close()
+        shutil.rmtree(self.archive_dir)
+
+    def test_export(self):
+        exported = export_days(self.session, self.archive_dir,
+                               until=date(2017, 8, 4), batch_rows=4)
+        self.assertEqual(exported, {'2017-08-01': 9, '2017-08-03': 9})
+        self.assertTrue(os.path.exists(os.path.join(
+            self.archive_dir, 'date=2017-08-01', 'station_status.parquet')))
+        days = read_manifest(self.archive_dir)['days']
+        self.assertEqual(sorted(days), ['2017-08-01', '2017-08-02',
+                                        '2017-08-03'])
+        self.assertEqual(days['2017-08-02'], {'file': None, 'rows': 0})
+
+        # nothing new until a later day closes
+        self.assertEqual(export_days(self.session, self.archive_dir,
+                                     until=date(2017, 8, 4)), {})
+        load_db([status_row(datetime(2017, 8, 4, 5), 1, 7)],
+                self.session, 'copy')
+        self.assertEqual(export_days(self.session, self.archive_dir,
+                                     until=date(2017, 8, 5)),
+                         {'2017-08-04': 1})
+
+    def test_read_archive(self):
+        export_days(self.session, self.archive_dir, until=date(2017, 8, 4))
+        start, end = datetime(2017, 8, 1, 9), datetime(2017, 8, 3, 9)
+        arrays = read_archive(start, end, [1, 3], self.archive_dir)
+        expected = self.session.query(Station_Status).\
+            filter(Station_Status.last_updated >= start,
+                   Station_Status.last_updated < end,
+                   Station_Status.station_id.in_([1, 3])).\
+            order_by(Station_Status.last_updated,
+                     Station_Status.station_id).all()
+        self.assertEqual(arrays['station_id'].tolist(),
+                         [row.station_id for row in expected])
+        self.assertEqual(arrays['last_updated'].tolist(),
+                         [datetime_to_micros(row.last_updated)
+                          for row in expected])
+        self.assertEqual(arrays['num_bikes_available'].tolist(),
+                         [row.num_bikes_available for row in expected])
+        self.assertEqual(len(arrays['status_id']), 6)
+
+    def test_read_outside_archive(self):
+        arrays = read_archive(datetime(2016, 1, 1), datetime(2016, 2, 1),
+                              archive_dir=self.archive_dir)
+        self.assertEqual(len(arrays['station_id']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
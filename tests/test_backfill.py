@@ -0,0 +1,196 @@
+''' tests.test_backfill '''
+
+import unittest
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from src.backfill import list_snapshots, parse_snapshot, diff_snapshots
+from src.backfill import backfill, new_skipped
+from src.latest_state import Latest_Status
+from src.models import Station_Status
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+DUMMY_FILES = ['tests/dummy1.json', 'tests/dummy2.json', 'tests/dummy3.json']
+
+
+def get_json_from_file(filename):
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+def make_archive_dir():
+    ''' copy the dummy files into a temp dir, named so they sort in order '''
+    path = tempfile.mkdtemp()
+    for i, filename in enumerate(DUMMY_FILES):
+        shutil.copy(filename, os.path.join(path, f'station_status_{i}.json'))
+    return path
+
+
+def make_tarball(directory):
+    ''' the dummy files, newest first '''
+    path = os.path.join(directory, 'archive.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        for i, filename in reversed(list(enumerate(DUMMY_FILES))):
+            tar.add(filename, arcname=f'snapshots/station_status_{i}.json')
+    return path
+
+
+def desired_tuples():
+    desired = get_json_from_file('tests/desired.json')['stations']
+    return sorted(Station_Status(row).to_tuple()[1:-1] for row in desired)
+
+
+def record_tuple(record):
+    return tuple(getattr(record, col) for col in Station_Status.load_columns)
+
+
+def status_tuple(status):
+    ''' to_tuple without status_id and modified_by '''
+    return status.to_tuple()[1:-1]
+
+
+def run_diff(sources, latest=None, batch_files=1000, skipped=None):
+    rows = []
+    with ProcessPoolExecutor(2) as pool:
+        for out in diff_snapshots(sources, latest or Latest_Status(), pool,
+                                  partitions=3, batch_files=batch_files,
+                                  skipped=skipped):
+            rows += out
+    return rows
+
+
+#############
+#   Tests   #
+#############
+
+class BackfillTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.archive = make_archive_dir()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive)
+
+    def test_list_snapshots_dir(self):
+        names = [os.path.basename(p) for p in list_snapshots(self.archive)]
+        self.assertEqual(names, ['station_status_0.json',
+                                 'station_status_1.json',
+                                 'station_status_2.json'])
+
+    def test_list_snapshots_by_time(self):
+        ''' sorted by last_updated, whatever the names say '''
+        for i in range(len(DUMMY_FILES)):
+            os.rename(os.path.join(self.archive, f'station_status_{i}.json'),
+                      os.path.join(self.archive, f'{"cba"[i]}.json'))
+        names = [os.path.basename(p) for p in list_snapshots(self.archive)]
+        self.assertEqual(names, ['c.json', 'b.json', 'a.json'])
+        rows = run_diff(list_snapshots(self.archive), batch_files=1)
+        self.assertEqual(sorted(record_tuple(r) for r in rows),
+                         desired_tuples())
+
+    def test_list_snapshots_bad(self):
+        ''' files without a last_updated are left out and counted '''
+        with open(os.path.join(self.archive, 'bad.json'), 'w') as bad_file:
+            bad_file.write('{"not": "a snapshot"}')
+        skipped = new_skipped()
+        self.assertEqual(len(list_snapshots(self.archive, skipped=skipped)),
+                         3)
+        self.assertEqual(skipped['bad'], 1)
+
+    def test_parse_snapshot(self):
+        last_updated, cols = parse_snapshot(DUMMY_FILES[0])
+        self.assertEqual(last_updated, 1501552111 * 1000000)
+        self.assertEqual(cols.station_id.tolist(), [1, 2, 3])
+
+    def test_parse_bad_snapshot(self):
+        bad = os.path.join(self.archive, 'bad.json')
+        with open(bad, 'w') as bad_file:
+            bad_file.write('{"not": "a snapshot"}')
+        self.assertIsNone(parse_snapshot(bad))
+
+    def test_diff_matches_desired(self):
+        ''' replaying dummy1..3 should give the rows in desired.json '''
+        rows = run_diff(list_snapshots(self.archive))
+        self.assertEqual(sorted(record_tuple(r) for r in rows),
+                         desired_tuples())
+
+    def test_diff_across_batches(self):
+        ''' state carries over from one batch to the next '''
+        rows = run_diff(list_snapshots(self.archive), batch_files=1)
+        self.assertEqual(sorted(record_tuple(r) for r in rows),
+                         desired_tuples())
+
+    def test_diff_tarball(self):
+        tarball = make_tarball(self.archive)
+        work_dir = os.path.join(self.archive, 'unpacked')
+        sources = list_snapshots(tarball, work_dir=work_dir)
+        self.assertEqual([os.path.dirname(p) for p in sources],
+                         [work_dir] * 3)
+        rows = run_diff(sources)
+        self.assertEqual(sorted(record_tuple(r) for r in rows),
+                         desired_tuples())
+
+    def test_old_snapshots_skipped(self):
+        ''' snapshots older than the starting state aren't replayed '''
+        latest = Latest_Status()
+        data = get_json_from_file(DUMMY_FILES[-1])
+        for row in data['data']['stations']:
+            row['last_updated'] = data['last_updated']
+            latest[int(row['station_id'])] = Station_Status(row)
+        skipped = new_skipped()
+        rows = run_diff(list_snapshots(self.archive), latest,
+                        skipped=skipped)
+        self.assertEqual(rows, [])
+        self.assertEqual(skipped['older'], 3)
+
+    def test_backfill_loads_db(self):
+        ''' full backfill into the test db '''
+        session = get_session(env='TST', echo=False)
+        session.query(Station_Status).delete()
+        session.commit()
+        result = backfill(self.archive, session, workers=2)
+        db_rows = session.query(Station_Status).all()
+        self.assertEqual(result['rows'], len(db_rows))
+        self.assertEqual(sorted(status_tuple(r) for r in db_rows),
+                         desired_tuples())
+        self.assertEqual(result['unknown_stations'], [])
+        session.query(Station_Status).delete()
+        session.commit()
+        session.close()
+
+    def test_backfill_unknown_station(self):
+        ''' rows for stations missing from station_information are
+            skipped and reported instead of failing the load '''
+        data = get_json_from_file(DUMMY_FILES[-1])
+        data['last_updated'] += 60
+        station = dict(data['data']['stations'][0], station_id='999')
+        data['data']['stations'].append(station)
+        with open(os.path.join(self.archive, 'station_status_3.json'),
+                  'w') as snapshot_file:
+            json.dump(data, snapshot_file)
+        session = get_session(env='TST', echo=False)
+        session.query(Station_Status).delete()
+        session.commit()
+        result = backfill(self.archive, session, workers=2)
+        self.assertEqual(result['unknown_stations'], [999])
+        self.assertEqual(result['skipped']['unknown_station_rows'], 1)
+        self.assertEqual(result['rows'],
+                         session.query(Station_Status).count())
+        self.assertEqual(session.query(Station_Status).
+                         filter(Station_Status.station_id == 999).count(), 0)
+        session.query(Station_Status).delete()
+        session.commit()
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
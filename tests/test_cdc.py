@@ -10,9 +10,12 @@ import psycopg2
 
 from src.station_status_cdc import get_data_from_api, load_db
 from src.station_status_cdc import get_latest_from_db, get_changed_data
+from src.station_status_cdc import Tick_Log
 from src.bikeshare_etl import etl
 from src.models import Station_Status, Station_Information
-from src.models import System_Region, Load_Metadata
+from src.models import Station_Status_Latest, System_Region, Load_Metadata
+from src.models import Cdc_Tick
+from src.timing import Phase_Timer
 from src.utils import get_session
 from src.db.create_db_tst import create_db, drop_all_tables
 
@@ -110,6 +113,36 @@ def get_json_from_file(filename):
         return json.load(json_file)
 
 
+def get_records_from_file(filename):
+    ''' build Station_Status objects from a dummy file '''
+    data = get_json_from_file(filename)
+    out = []
+    for row in data['data']['stations']:
+        row['last_updated'] = data['last_updated']
+        out.append(Station_Status(row))
+    return out
+
+
+def loaded_rows_match(records):
+    ''' pull everything from station_status and compare against
+        records (ignoring auto id and username) '''
+    conn, cur = get_connection_and_cursor()
+    cur.execute(select_all_stmt())
+    db_data = cur.fetchall()
+    if len(db_data) != len(records):
+        print(f'{len(db_data)} rows in db, expected {len(records)}')
+        return False
+    records = sorted(records, key=lambda r: (r.station_id, r.last_updated))
+    for row, record in zip(db_data, records):
+        if row[1:-1] != record.to_tuple()[1:-1]:
+            print(f'row {row} should match {record.to_tuple()}')
+            return False
+        if row[-1] != environ['POSTGRES_USER_TST']:
+            print(f'modified_by should be set, got {row[-1]}')
+            return False
+    return True
+
+
 #############
 #   Tests   #
 #############
@@ -223,6 +256,120 @@ class CdcTestCase(unittest.TestCase):
         empty_station_status_table(session)
         session.close()
 
+    def test_load_db_copy(self):
+        ''' COPY write mode should load the same rows as the ORM '''
+        session = get_session(env='TST', echo=True)
+        records = get_records_from_file('tests/dummy1.json')
+        load_db(records, session, mode='copy')
+        self.assertTrue(loaded_rows_match(records))
+        empty_station_status_table(session)
+        session.close()
+
+    def test_load_db_values(self):
+        ''' multi-row VALUES write mode should load the same rows '''
+        session = get_session(env='TST', echo=True)
+        records = get_records_from_file('tests/dummy1.json')
+        load_db(records, session, mode='values')
+        self.assertTrue(loaded_rows_match(records))
+        empty_station_status_table(session)
+        session.close()
+
+    def test_latest_table_maintained(self):
+        ''' load_db should keep station_status_latest in step, and
+            get_latest_from_db should read from it '''
+        session = get_session(env='TST', echo=True)
+        for mode, filename in (('orm', 'tests/dummy1.json'),
+                               ('copy', 'tests/dummy2.json'),
+                               ('values', 'tests/dummy3.json')):
+            load_db(get_records_from_file(filename), session, mode=mode)
+        latest_rows = session.query(Station_Status_Latest).all()
+        # one row per station (1, 2, 3, 4), each a copy of the newest
+        self.assertEqual(sorted(r.station_id for r in latest_rows),
+                         [1, 2, 3, 4])
+        latest = get_latest_from_db(session)
+        for row in latest_rows:
+            newest = session.query(Station_Status).\
+                filter(Station_Status.station_id == row.station_id).\
+                order_by(Station_Status.last_updated.desc()).first()
+            self.assertEqual(row.status_id, newest.status_id)
+            self.assertEqual(latest[row.station_id], newest)
+        # deleting the facts should empty the snapshot too
+        empty_station_status_table(session)
+        self.assertEqual(session.query(Station_Status_Latest).count(), 0)
+        session.close()
+
+    def test_latest_rebuilt_for_station_ids(self):
+        ''' the fallback only fills in the stations asked for '''
+        session = get_session(env='TST', echo=False)
+        empty_station_status_table(session)
+        for record in get_records_from_file('tests/dummy1.json'):
+            session.add(record)
+        session.commit()
+        self.assertEqual(session.query(Station_Status_Latest).count(), 0)
+        latest = get_latest_from_db(session, [1, 2])
+        self.assertEqual(sorted(latest), [1, 2])
+        self.assertEqual(sorted(station_id for station_id, in
+                                session.query(
+                                    Station_Status_Latest.station_id)),
+                         [1, 2])
+        empty_station_status_table(session)
+        session.close()
+
+    def test_load_db_bad_mode(self):
+        session = get_session(env='TST', echo=True)
+        with self.assertRaises(ValueError):
+            load_db([], session, mode='carrier pigeon')
+        session.close()
+
+    def test_save_tick(self):
+        ''' a tick's phase timings end up in cdc_tick '''
+        session = get_session(env='TST', echo=False)
+        timer = Phase_Timer()
+        with timer.phase('fetch') as fetch:
+            fetch.bytes = 1234
+        with timer.phase('diff'):
+            sleep(0.01)
+        tick_log = Tick_Log(session, batch_ticks=2)
+        tick_log.add(Cdc_Tick(timer, 1501552111, skipped=True))
+        self.assertEqual(session.query(Cdc_Tick).count(), 0)
+        tick_log.add(Cdc_Tick(timer, 1501552111, rows=3, lag=2.5))
+        self.assertEqual(session.query(Cdc_Tick).count(), 2)
+        tick = session.query(Cdc_Tick).\
+            order_by(Cdc_Tick.tick_id.desc()).first()
+        self.assertEqual(tick.payload_bytes, 1234)
+        self.assertEqual(tick.rows, 3)
+        self.assertFalse(tick.skipped)
+        self.assertGreaterEqual(tick.diff_secs, 0.01)
+        self.assertEqual(tick.load_secs, 0)
+        self.assertEqual(tick.last_updated.timestamp(), 1501552111)
+        self.assertEqual(tick.lag_secs, 2.5)
+        session.query(Cdc_Tick).delete()
+        session.commit()
+        session.close()
+
+    def test_tick_log_failure_kept(self):
+        ''' a failed tick write doesn't raise, and is tried again '''
+        session = get_session(env='TST', echo=False)
+        tick_log = Tick_Log(session, batch_ticks=1, max_ticks=2)
+        session.execute('ALTER TABLE cdc_tick RENAME TO cdc_tick_away')
+        session.commit()
+        try:
+            for _ in range(3):
+                tick_log.add(Cdc_Tick(Phase_Timer(), 1501552111))
+        finally:
+            session.rollback()
+            session.execute('ALTER TABLE cdc_tick_away RENAME TO cdc_tick')
+            session.commit()
+        self.assertEqual(tick_log.failures, 3)
+        self.assertEqual(tick_log.dropped, 1)
+        self.assertEqual(len(tick_log.ticks), 2)
+        # the session is still usable, and the kept ticks go in
+        self.assertTrue(tick_log.flush())
+        self.assertEqual(session.query(Cdc_Tick).count(), 2)
+        session.query(Cdc_Tick).delete()
+        session.commit()
+        session.close()
+
     def test_equal(self):
         dummy = create_dummy_data()
         dummy2 = create_dummy_data()
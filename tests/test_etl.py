@@ -0,0 +1,180 @@
+''' tests.test_etl '''
+
+import unittest
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep, perf_counter
+
+from src.bikeshare_etl import run_etl, load_order
+from src.bikeshare_etl import add_load_hook, remove_load_hook
+from src.models import Load_Metadata, System_Region, Station_Information
+from src.models import Station_Status, Load_Phase
+from src.registry import Feed_Registry
+from src.spatial import Station_Index
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+FEEDS = {
+    'system_regions': {'regions': [{'region_id': '9101', 'name': 'r1'},
+                                   {'region_id': '9102', 'name': 'r2'}]},
+    'station_information': {'stations': [
+        {'station_id': '9101', 'name': 's1', 'lat': 38.9, 'lon': -77.01,
+         'region_id': 9101, 'capacity': 11,
+         'rental_methods': ['KEY', 'CREDITCARD']},
+        {'station_id': '9102', 'name': 's2', 'lat': 38.91, 'lon': -77.02,
+         'region_id': 9102, 'capacity': 19}]}}
+
+# seconds each feed takes to answer
+DELAY = 0.4
+
+
+class Feed_Handler(BaseHTTPRequestHandler):
+    ''' serves FEEDS at /<table_name>.json, slowly,
+        and a gbfs.json listing them '''
+
+    def do_GET(self):
+        name = self.path.strip('/').replace('.json', '')
+        if name == 'gbfs':
+            base = f'http://localhost:{self.server.server_port}'
+            data = {'en': {'feeds': [{'name': feed,
+                                      'url': f'{base}/{feed}.json'}
+                                     for feed in FEEDS]}}
+        elif name in FEEDS:
+            sleep(DELAY)
+            data = FEEDS[name]
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({'last_updated': 1501552111, 'ttl': 10,
+                           'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def empty_test_rows(session):
+    session.query(Station_Information).\
+        filter(Station_Information.station_id.in_([9101, 9102])).\
+        delete(synchronize_session=False)
+    session.query(System_Region).\
+        filter(System_Region.region_id.in_([9101, 9102])).\
+        delete(synchronize_session=False)
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class EtlTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), Feed_Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.registry = Feed_Registry(
+            f'http://localhost:{self.server.server_port}/gbfs.json')
+        self.session = get_session(env='TST', echo=False)
+        empty_test_rows(self.session)
+
+    def tearDown(self):
+        empty_test_rows(self.session)
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_load_order(self):
+        self.assertEqual(load_order([Station_Information, System_Region]),
+                         [System_Region, Station_Information])
+        self.assertEqual(load_order([Station_Status, Station_Information,
+                                     System_Region]),
+                         [System_Region, Station_Information,
+                          Station_Status])
+
+    def test_run_etl_loads_all(self):
+        for bulk in (False, True):
+            timings = run_etl([Station_Information, System_Region],
+                              self.session, bulk, self.registry)
+            self.assertEqual(set(timings), {'System_Region',
+                                            'Station_Information',
+                                            'total'})
+            regions = self.session.query(System_Region.region_name).\
+                filter(System_Region.region_id.in_([9101, 9102])).\
+                order_by(System_Region.region_id).all()
+            self.assertEqual([r.region_name for r in regions], ['r1', 'r2'])
+            stations = self.session.query(Station_Information).\
+                filter(Station_Information.region_id.in_([9101, 9102])).\
+                count()
+            self.assertEqual(stations, 2)
+            empty_test_rows(self.session)
+
+    def test_feeds_fetched_concurrently(self):
+        ''' wall time is about one feed's delay, not the sum '''
+        start = perf_counter()
+        timings = run_etl([System_Region, Station_Information],
+                          self.session, registry=self.registry)
+        elapsed = perf_counter() - start
+        self.assertGreaterEqual(timings['Station_Information']['fetch'],
+                                DELAY)
+        self.assertLess(elapsed, 2 * DELAY)
+
+    def test_metadata_counts(self):
+        run_etl([System_Region, Station_Information], self.session,
+                registry=self.registry)
+        loads = self.session.query(Load_Metadata).\
+            order_by(Load_Metadata.load_id.desc()).limit(2).all()
+        counts = {m.dataset: (m.src_rows, m.inserts, m.updates)
+                  for m in loads}
+        self.assertEqual(counts, {'system_regions': (2, 2, 0),
+                                  'station_information': (2, 2, 0)})
+
+    def test_phases_saved(self):
+        ''' each load gets a load_phase row per phase '''
+        run_etl([System_Region, Station_Information], self.session,
+                registry=self.registry)
+        load = self.session.query(Load_Metadata).\
+            filter(Load_Metadata.dataset == 'station_information').\
+            order_by(Load_Metadata.load_id.desc()).first()
+        phases = {p.phase: p for p in load.phases}
+        self.assertEqual(set(phases), {'fetch', 'parse', 'transform',
+                                       'wait', 'compare', 'bounds',
+                                       'commit'})
+        self.assertGreater(phases['fetch'].bytes, 0)
+        self.assertGreaterEqual(phases['fetch'].secs, DELAY)
+        self.assertEqual(phases['transform'].rows, 2)
+        self.assertEqual(phases['commit'].rows, 2)
+        self.assertIsNotNone(phases['transform'].rows_per_sec)
+
+    def test_region_bounds(self):
+        run_etl([System_Region, Station_Information], self.session,
+                bulk=True, registry=self.registry)
+        region = self.session.query(System_Region).get(9101)
+        self.assertEqual((float(region.min_lat), float(region.max_lat),
+                          float(region.min_lon), float(region.max_lon)),
+                         (38.9, 38.9, -77.01, -77.01))
+
+    def test_load_hook_updates_index(self):
+        index = Station_Index(origin_lat=38.9)
+        add_load_hook(index.on_load)
+        try:
+            run_etl([System_Region, Station_Information], self.session,
+                    registry=self.registry)
+        finally:
+            remove_load_hook(index.on_load)
+        self.assertEqual(sorted(index.ids().tolist()), [9101, 9102])
+        self.assertEqual(index.knn(38.911, -77.021, 1)[0].tolist(), [9102])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+''' tests.test_feeds '''
+
+import unittest
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from src.feeds import Feed_State, fetch_feed
+from src.timing import Phase_Timer
+
+
+########################
+#   Helper Functions   #
+########################
+
+def get_json_from_file(filename):
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+class Feed_Handler(BaseHTTPRequestHandler):
+    ''' Serves whatever is in `payloads` for the path, one per request
+        (repeating the last). Paths under /etag/ send an ETag and
+        answer If-None-Match with a 304. '''
+
+    payloads = {}
+    hits = {}
+
+    def do_GET(self):
+        hit = self.hits.get(self.path, 0)
+        self.hits[self.path] = hit + 1
+        payloads = self.payloads[self.path]
+        body = payloads[min(hit, len(payloads) - 1)]
+        etag = f'"{hash(body)}"'
+        if self.path.startswith('/etag/') and\
+                self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path.startswith('/etag/'):
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def as_body(data, indent=None):
+    return json.dumps(data, indent=indent).encode()
+
+
+#############
+#   Tests   #
+#############
+
+class FeedsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dummy1 = get_json_from_file('tests/dummy1.json')
+        dummy2 = get_json_from_file('tests/dummy2.json')
+        Feed_Handler.hits = {}
+        Feed_Handler.payloads = {
+            '/plain/ss.json': [as_body(dummy1), as_body(dummy1),
+                               as_body(dummy2)],
+            '/etag/ss.json': [as_body(dummy1), as_body(dummy1),
+                              as_body(dummy2)],
+            # same version, serialized differently (another cdn node)
+            '/stale/ss.json': [as_body(dummy2), as_body(dummy1, indent=1),
+                               as_body(dummy2, indent=2)]}
+        self.server = HTTPServer(('localhost', 0), Feed_Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.base = f'http://localhost:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch_all(self, path, count=3):
+        state = Feed_State()
+        results = []
+        for _ in range(count):
+            data, version = fetch_feed(self.base + path, state)
+            state.accept(version)
+            results.append(data)
+        return results, state
+
+    def test_same_payload_skipped(self):
+        results, state = self.fetch_all('/plain/ss.json')
+        self.assertEqual(results[0]['last_updated'], 1501552111)
+        self.assertIsNone(results[1])
+        self.assertEqual(results[2]['last_updated'], 1501554111)
+        self.assertEqual(state.skips['same_payload'], 1)
+        self.assertEqual(state.skipped(), 1)
+        self.assertEqual(state.fetches, 3)
+
+    def test_not_modified_skipped(self):
+        results, state = self.fetch_all('/etag/ss.json')
+        self.assertIsNone(results[1])
+        self.assertEqual(results[2]['last_updated'], 1501554111)
+        self.assertEqual(state.skips['not_modified'], 1)
+        self.assertEqual(state.skips['same_payload'], 0)
+
+    def test_stale_version_skipped(self):
+        ''' different bytes but not a newer last_updated '''
+        results, state = self.fetch_all('/stale/ss.json')
+        self.assertEqual(results[0]['last_updated'], 1501554111)
+        self.assertEqual(results[1:], [None, None])
+        self.assertEqual(state.skips['stale'], 2)
+        self.assertEqual(state.last_updated, 1501554111)
+
+    def test_not_accepted_fetched_again(self):
+        ''' a version whose load failed isn't skipped next time '''
+        state = Feed_State()
+        data, _ = fetch_feed(self.base + '/plain/ss.json', state)
+        self.assertEqual(data['last_updated'], 1501552111)
+        self.assertIsNone(state.fingerprint)
+        self.assertIsNone(state.last_updated)
+        data, version = fetch_feed(self.base + '/plain/ss.json', state)
+        self.assertEqual(data['last_updated'], 1501552111)
+        state.accept(version)
+        self.assertEqual(state.last_updated, 1501552111)
+        self.assertEqual(state.skipped(), 0)
+
+    def test_timed(self):
+        ''' a skipped fetch is only timed up to the fetch '''
+        state = Feed_State()
+        timers = [Phase_Timer() for _ in range(2)]
+        for timer in timers:
+            _, version = fetch_feed(self.base + '/plain/ss.json', state,
+                                    timer=timer)
+            state.accept(version)
+        self.assertEqual(list(timers[0].phases), ['fetch', 'parse'])
+        self.assertGreater(timers[0].phases['fetch'].bytes, 0)
+        self.assertEqual(list(timers[1].phases), ['fetch'])
+
+    def test_conditional_headers(self):
+        state = Feed_State()
+        self.assertEqual(state.headers(), {})
+        state.etag = '"abc"'
+        state.last_modified = 'Mon, 31 Jul 2017 01:48:31 GMT'
+        self.assertEqual(state.headers(),
+                         {'If-None-Match': '"abc"',
+                          'If-Modified-Since':
+                              'Mon, 31 Jul 2017 01:48:31 GMT'})
+
+
+if __name__ == '__main__':
+    unittest.main()
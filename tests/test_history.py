@@ -0,0 +1,104 @@
+''' tests.test_history '''
+
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from src.history import read_history, read_station
+from src.models import Station_Status, Station_Information
+from src.station_status_cdc import load_db
+from src.status_diff import NULL_COUNT, datetime_to_micros
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+def at(hour, minute=0):
+    return datetime(2017, 8, 1, hour, minute)
+
+
+def status_row(when, station_id, bikes, disabled=0):
+    timestamp = when.timestamp()
+    record = {'last_updated': timestamp,
+              'station_id': station_id,
+              'num_bikes_available': bikes,
+              'num_docks_available': 15 - bikes,
+              'is_installed': 1,
+              'is_renting': 1,
+              'is_returning': 1,
+              'last_reported': timestamp}
+    if disabled is not None:
+        record['num_bikes_disabled'] = disabled
+    return Station_Status(record)
+
+
+def empty_tables(session):
+    session.query(Station_Status).delete()
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class HistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = get_session(env='TST', echo=False)
+        empty_tables(self.session)
+        rows = [status_row(at(hour), station_id, hour)
+                for hour in range(6, 12) for station_id in (1, 2)]
+        rows.append(status_row(at(12), 1, 3, disabled=None))
+        load_db(rows, self.session, 'copy')
+
+    def tearDown(self):
+        empty_tables(self.session)
+        self.session.close()
+
+    def test_chunks(self):
+        chunks = list(read_history(self.session, chunk_rows=5))
+        self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 3])
+        history = np.concatenate(chunks)
+        self.assertEqual(history['station_id'].tolist(), [1] * 7 + [2] * 6)
+        self.assertEqual(history['last_updated'][:2].tolist(),
+                         [datetime_to_micros(at(6)), datetime_to_micros(at(7))])
+        self.assertEqual(history['num_bikes_disabled'][6], NULL_COUNT)
+        self.assertTrue(history['is_renting'].all())
+
+    def test_filters(self):
+        history = read_station(self.session, 2, start=at(8), end=at(10),
+                               columns=('last_updated',
+                                        'num_bikes_available'))
+        self.assertEqual(history.dtype.names,
+                         ('last_updated', 'num_bikes_available'))
+        self.assertEqual(history['num_bikes_available'].tolist(), [8, 9])
+        self.assertEqual(len(read_station(self.session, 3)), 0)
+        with self.assertRaises(ValueError):
+            read_station(self.session, 2, columns=('bikes',))
+
+    def test_relationships(self):
+        ''' station_statuses is still a list, station_status_query
+            is the same rows as a query '''
+        station = self.session.query(Station_Information).get(1)
+        self.assertEqual(len(station.station_statuses), 7)
+        self.assertEqual(station.station_status_query.count(), 7)
+        self.assertEqual(station.station_status_query.first().last_updated,
+                         station.station_statuses[0].last_updated)
+
+    def test_two_reads_at_once(self):
+        ''' each read gets its own server-side cursor '''
+        first = read_history(self.session, chunk_rows=1)
+        second = read_history(self.session, chunk_rows=1)
+        self.assertEqual(len(next(first)), 1)
+        self.assertEqual(len(next(second)), 1)
+        rows = 2 + sum(len(chunk) for chunk in first) +\
+            sum(len(chunk) for chunk in second)
+        self.assertEqual(rows, 2 * sum(len(chunk) for chunk in
+                                       read_history(self.session)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+''' tests.test_latest_state '''
+
+import unittest
+import json
+
+from src.latest_state import Latest_Status, records_from_columns
+from src.status_diff import decode_feed
+from src.station_status_cdc import get_changed_data
+from src.models import Station_Status
+
+
+########################
+#   Helper Functions   #
+########################
+
+def get_json_from_file(filename):
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+def create_dummy_data(tstmp=0, station_id=1, bikes=100):
+    ss = {'last_updated': tstmp,
+          'station_id': station_id,
+          'num_bikes_available': bikes,
+          'num_docks_available': 200,
+          'num_bikes_disabled': 6,
+          'is_installed': True,
+          'is_renting': False,
+          'is_returning': True,
+          'last_reported': tstmp+10.5
+          }
+    return Station_Status(ss)
+
+
+def get_latest_from_file(filename):
+    data = get_json_from_file(filename)
+    latest = Latest_Status()
+    for row in data['data']['stations']:
+        row['last_updated'] = data['last_updated']
+        record = Station_Status(row)
+        latest[record.station_id] = record
+    return latest
+
+
+#############
+#   Tests   #
+#############
+
+class LatestStatusTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        ''' values put in should come back out equal '''
+        latest = Latest_Status()
+        record = create_dummy_data(1501552111.25)
+        latest[record.station_id] = record
+        self.assertEqual(record, latest[record.station_id])
+        self.assertEqual(latest[record.station_id], record)
+        self.assertEqual(latest[1].last_updated, record.last_updated)
+
+    def test_missing_optional(self):
+        latest = Latest_Status()
+        record = create_dummy_data()
+        record.num_docks_disabled = None
+        latest[1] = record
+        self.assertIsNone(latest[1].num_docks_disabled)
+
+    def test_update_replaces(self):
+        latest = Latest_Status()
+        latest[1] = create_dummy_data(bikes=1)
+        latest[1] = create_dummy_data(bikes=2)
+        self.assertEqual(len(latest), 1)
+        self.assertEqual(latest[1].num_bikes_available, 2)
+
+    def test_unknown_station(self):
+        latest = Latest_Status()
+        latest[5] = create_dummy_data(station_id=5)
+        self.assertNotIn(6, latest)
+        self.assertIsNone(latest.get(6))
+        self.assertEqual(latest.lookup([6, 5]).tolist(), [-1, 0])
+        with self.assertRaises(KeyError):
+            latest[6]
+
+    def test_delete(self):
+        ''' deleting keeps the other stations and lookups right '''
+        latest = Latest_Status()
+        for i in range(4):
+            latest[i] = create_dummy_data(station_id=i, bikes=i)
+        latest.lookup([0])
+        del latest[1]
+        self.assertEqual(len(latest), 3)
+        self.assertNotIn(1, latest)
+        for i in (0, 2, 3):
+            self.assertEqual(latest[i].num_bikes_available, i)
+        self.assertEqual((latest.lookup([1, 3]) >= 0).tolist(),
+                         [False, True])
+        latest[1] = create_dummy_data(station_id=1, bikes=7)
+        self.assertEqual(latest[1].num_bikes_available, 7)
+
+    def test_grows(self):
+        ''' adding more stations than capacity shouldn't lose any '''
+        latest = Latest_Status(capacity=2)
+        for i in range(10):
+            latest[i * 7] = create_dummy_data(station_id=i * 7, bikes=i)
+        self.assertEqual(len(latest), 10)
+        for i in range(10):
+            self.assertEqual(latest[i * 7].num_bikes_available, i)
+
+    def test_snapshot_restore(self):
+        latest = Latest_Status()
+        for i in range(3):
+            latest[i] = create_dummy_data(station_id=i, bikes=i)
+        snapshot = latest.snapshot()
+        latest[0] = create_dummy_data(station_id=0, bikes=99)
+        restored = Latest_Status.restore(snapshot)
+        self.assertEqual(len(restored), 3)
+        self.assertEqual(restored[0].num_bikes_available, 0)
+        self.assertEqual(latest[0].num_bikes_available, 99)
+        restored[3] = create_dummy_data(station_id=3)
+        self.assertIn(3, restored)
+
+    def test_merge(self):
+        ''' merge applies a decoded feed and returns changed rows,
+            comparing repeated stations in feed order '''
+        latest = get_latest_from_file('tests/dummy1.json')
+        data = get_json_from_file('tests/dummy2.json')
+        stations = data['data']['stations']
+        # repeat the first station with its dummy1 values
+        first = get_json_from_file('tests/dummy1.json')['data']
+        data['data']['stations'] = stations + [first['stations'][0]]
+        cols = decode_feed(data)
+        changed = latest.merge(cols, data['last_updated'] * 1000000)
+        out, _ = get_changed_data(data, get_latest_from_file(
+            'tests/dummy1.json'))
+        records = records_from_columns(cols, changed,
+                                       data['last_updated'] * 1000000)
+        self.assertEqual(len(records), len(out))
+        for record, row in zip(records, out):
+            self.assertEqual(record.station_id, row.station_id)
+            self.assertEqual(record.last_updated, row.last_updated)
+            self.assertEqual(record, row)
+
+    def test_changed_data_matches_desired(self):
+        ''' same expectations as test_cdc.test_comparison '''
+        latest = get_latest_from_file('tests/dummy1.json')
+        rows = [latest[station_id] for station_id in latest]
+        out, latest = get_changed_data(
+            get_json_from_file('tests/dummy2.json'), latest)
+        rows += out
+        out, latest = get_changed_data(
+            get_json_from_file('tests/dummy3.json'), latest)
+        rows += out
+        rows.sort(key=lambda r: (r.station_id, r.last_updated))
+        desired = get_json_from_file('tests/desired.json')['stations']
+        self.assertEqual(len(rows), len(desired))
+        for row, should_be in zip(rows, desired):
+            should_be = Station_Status(should_be)
+            self.assertEqual(row.last_updated, should_be.last_updated)
+            self.assertEqual(row, should_be)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+''' tests.test_migrate_columns '''
+
+import unittest
+
+from src.db.create_db_tst import get_engine
+from src.db.migrate_columns import migrate_columns, get_columns
+
+
+########################
+#   Helper Functions   #
+########################
+
+BOUNDS = ('min_lat', 'max_lat', 'min_lon', 'max_lon')
+
+
+def make_old_schema(engine):
+    ''' system_regions as it was before the region bounds '''
+    with engine.begin() as connection:
+        for col in BOUNDS:
+            connection.execute(
+                f'ALTER TABLE system_regions DROP COLUMN {col}')
+
+
+#############
+#   Tests   #
+#############
+
+class MigrateColumnsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = get_engine()
+
+    def tearDown(self):
+        migrate_columns(self.engine)
+
+    def test_nothing_to_do(self):
+        ''' a database made by create_db already has everything '''
+        self.assertEqual(migrate_columns(self.engine), [])
+
+    def test_old_database(self):
+        make_old_schema(self.engine)
+        self.assertEqual(sorted(migrate_columns(self.engine)),
+                         sorted(f'system_regions.{col}' for col in BOUNDS))
+        with self.engine.connect() as connection:
+            self.assertTrue(set(BOUNDS) <=
+                            get_columns(connection, 'system_regions'))
+            self.assertEqual(connection.execute(
+                '''SELECT data_type FROM information_schema.columns
+                   WHERE table_name = 'system_regions'
+                   AND column_name = 'min_lat' ''').scalar(), 'numeric')
+        # and again does nothing
+        self.assertEqual(migrate_columns(self.engine), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+''' tests.test_migrate_indexes '''
+
+import unittest
+
+import psycopg2
+
+from src.db.create_db_tst import get_engine
+from src.db.migrate_indexes import migrate_indexes, get_index
+from src.models import Station_Status, Station_Status_Latest
+from src.station_status_cdc import load_db
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+def status_row(bikes):
+    return Station_Status({'last_updated': 1501552111,
+                           'station_id': 1,
+                           'num_bikes_available': bikes,
+                           'num_docks_available': 2,
+                           'is_installed': 1,
+                           'is_renting': 1,
+                           'is_returning': 1,
+                           'last_reported': 1501552111})
+
+
+def make_old_schema(engine):
+    ''' indexes as a database from before the models declared them '''
+    with engine.begin() as connection:
+        connection.execute('DROP INDEX station_status_station_lu_key')
+        connection.execute('DROP INDEX station_status_lu_brin')
+        connection.execute('DROP INDEX station_information_region_idx')
+        connection.execute('''CREATE INDEX station_status_station_lu_idx
+                              ON station_status (station_id, last_updated)''')
+
+
+#############
+#   Tests   #
+#############
+
+class MigrateIndexesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = get_engine()
+        self.session = get_session(env='TST', echo=False)
+
+    def tearDown(self):
+        self.session.query(Station_Status).delete()
+        self.session.commit()
+        self.session.close()
+        migrate_indexes(self.engine)
+
+    def test_nothing_to_do(self):
+        ''' a database made by create_db already has everything '''
+        self.assertEqual(migrate_indexes(self.engine), [])
+
+    def test_old_database(self):
+        make_old_schema(self.engine)
+        # without the unique key the same version can be loaded twice
+        load_db([status_row(3)], self.session, 'copy')
+        load_db([status_row(3)], self.session, 'copy')
+        first_id = min(row.status_id for row in
+                       self.session.query(Station_Status.status_id))
+        self.session.query(Station_Status_Latest).\
+            update({'status_id': first_id})
+        self.session.commit()
+
+        self.assertEqual(sorted(migrate_indexes(self.engine)),
+                         ['station_information_region_idx',
+                          'station_status_lu_brin',
+                          'station_status_station_lu_key'])
+        with self.engine.connect() as connection:
+            self.assertEqual(get_index(connection,
+                                       'station_status_station_lu_key'),
+                             (True, 'station_status'))
+            self.assertEqual(get_index(connection,
+                                       'station_status_lu_brin')[0], True)
+            self.assertIsNone(get_index(connection,
+                                        'station_status_station_lu_idx'))
+        # one copy kept, and the snapshot row followed it
+        self.assertEqual(self.session.query(Station_Status).count(), 1)
+        kept = self.session.query(Station_Status.status_id).scalar()
+        latest = self.session.query(Station_Status_Latest).one()
+        self.assertEqual(latest.status_id, kept)
+        with self.assertRaises(psycopg2.IntegrityError):
+            load_db([status_row(3)], self.session, 'copy')
+        self.session.rollback()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+''' tests.test_multi_cdc '''
+
+import unittest
+import asyncio
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from src.feeds import fetch_feed
+from src.latest_state import Latest_Status
+from src.models import Station_Status
+from src.multi_cdc import System_Poller, make_pollers
+from src.scheduler import Poll_Scheduler
+from src.station_status_cdc import get_data_from_api
+from src.utils import get_sessionmaker
+
+
+########################
+#   Helper Functions   #
+########################
+
+DUMMY_FILES = ['tests/dummy1.json', 'tests/dummy2.json', 'tests/dummy3.json']
+
+
+def get_json_from_file(filename):
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+class Feed_Handler(BaseHTTPRequestHandler):
+    ''' Stand-in GBFS server. Every path is its own system, and each
+        request for it returns the next dummy file (then repeats the last).
+        Paths under /same/ always return the first one, and paths
+        under /new/ add a station that isn't in station_information.
+        ttl is cut down so the tests don't wait. '''
+
+    hits = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            hit = self.hits.get(self.path, 0)
+            self.hits[self.path] = hit + 1
+        if self.path.startswith('/same/'):
+            hit = 0
+        if self.path.startswith('/broken'):
+            self.send_response(500)
+            self.end_headers()
+            return
+        data = get_json_from_file(DUMMY_FILES[min(hit, 2)])
+        if self.path.startswith('/new/'):
+            stations = data['data']['stations']
+            stations.append(dict(stations[0], station_id='9301'))
+        data['ttl'] = 0.01
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    Feed_Handler.hits = {}
+    server = HTTPServer(('localhost', 0), Feed_Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def desired_rows():
+    desired = get_json_from_file('tests/desired.json')['stations']
+    return sorted((int(row['station_id']), row['last_updated'])
+                  for row in desired)
+
+
+class Fake_Db():
+    ''' records writes instead of hitting postgres '''
+
+    def __init__(self, fail_first=False):
+        self.rows = []
+        self.fail_first = fail_first
+
+    async def load_latest(self, station_ids):
+        return Latest_Status()
+
+    async def write(self, rows):
+        if self.fail_first:
+            self.fail_first = False
+            raise ValueError('db went away')
+        self.rows += rows
+
+
+async def run_until(pollers, ticks, timeout=10):
+    ''' run pollers until each has done at least `ticks` polls '''
+    stop = asyncio.Event()
+
+    async def watch():
+        while not all(p.ticks + p.errors >= ticks for p in pollers):
+            await asyncio.sleep(0.01)
+        stop.set()
+
+    await asyncio.wait_for(
+        asyncio.gather(watch(), *(p.run(stop) for p in pollers)), timeout)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+#############
+#   Tests   #
+#############
+
+class MultiCdcTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_server()
+        self.base = f'http://localhost:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_data_from_api_url(self):
+        data = get_data_from_api(f'{self.base}/one/station_status.json')
+        self.assertIn('last_updated', data)
+
+    def test_systems_polled_independently(self):
+        ''' each system gets its own latest state and schedule '''
+        dbs = {name: Fake_Db() for name in ('one', 'two')}
+
+        async def fetch(url, state):
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(None, get_data_from_api, url)
+            return data, None
+
+        pollers = [System_Poller(name, f'{self.base}/{name}/ss.json',
+                                 fetch, db.load_latest, db.write)
+                   for name, db in dbs.items()]
+        run(run_until(pollers, 3))
+        for db in dbs.values():
+            rows = sorted((r.station_id,
+                           int(r.last_updated.timestamp()))
+                          for r in db.rows)
+            self.assertEqual(rows, desired_rows())
+
+    def test_make_pollers_writes_db(self):
+        ''' real pollers write through the shared pool into the test db '''
+        Session = get_sessionmaker(env='TST', pool_size=2)
+        session = Session()
+        session.query(Station_Status).delete()
+        session.commit()
+        pollers, executors = make_pollers(
+            {'one': f'{self.base}/one/ss.json'}, Session, pool_size=2)
+        run(run_until(pollers, 3))
+        for executor in executors:
+            executor.shutdown()
+        # the server repeats dummy3, which is skipped, not a fourth tick
+        self.assertEqual(pollers[0].ticks, 3)
+        rows = sorted((r.station_id, int(r.last_updated.timestamp()))
+                      for r in session.query(Station_Status).all())
+        self.assertEqual(rows, desired_rows())
+        session.query(Station_Status).delete()
+        session.commit()
+        session.close()
+
+    def test_unknown_station_doesnt_stop_writes(self):
+        ''' a new station's rows are dropped, the rest are written '''
+        Session = get_sessionmaker(env='TST', pool_size=2)
+        session = Session()
+        session.query(Station_Status).delete()
+        session.commit()
+        pollers, executors = make_pollers(
+            {'new': f'{self.base}/new/ss.json'}, Session, pool_size=2)
+        run(run_until(pollers, 3))
+        for executor in executors:
+            executor.shutdown()
+        self.assertEqual(pollers[0].errors, 0)
+        self.assertGreater(pollers[0].filter.known.dropped, 0)
+        rows = sorted((r.station_id, int(r.last_updated.timestamp()))
+                      for r in session.query(Station_Status).all())
+        self.assertEqual(rows, desired_rows())
+        session.query(Station_Status).delete()
+        session.commit()
+        session.close()
+
+    def test_broken_system_doesnt_stop_others(self):
+        good = Fake_Db()
+        bad = Fake_Db()
+
+        async def fetch(url, state):
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(None, get_data_from_api, url)
+            return data, None
+
+        pollers = [System_Poller('good', f'{self.base}/good/ss.json',
+                                 fetch, good.load_latest, good.write),
+                   System_Poller('bad', f'{self.base}/broken/ss.json',
+                                 fetch, bad.load_latest, bad.write,
+                                 retry_delay=0.01)]
+        run(run_until(pollers, 3))
+        self.assertEqual(len(good.rows), len(desired_rows()))
+        self.assertGreaterEqual(pollers[1].errors, 3)
+
+    def test_failed_write_retried(self):
+        ''' rows from a failed write are found again on the next tick '''
+        db = Fake_Db(fail_first=True)
+
+        async def fetch(url, state):
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(None, get_data_from_api, url)
+            return data, None
+
+        poller = System_Poller('one', f'{self.base}/one/ss.json',
+                               fetch, db.load_latest, db.write,
+                               retry_delay=0.01)
+        run(run_until([poller], 4))
+        self.assertEqual(poller.errors, 1)
+        rows = sorted((r.station_id, int(r.last_updated.timestamp()))
+                      for r in db.rows)
+        # dummy1 rows were lost with the failed write, but the state was
+        # restored so dummy2 is compared against nothing and written whole
+        self.assertEqual(len(rows), len(set(rows)))
+        self.assertIn((4, 1501555111), rows)
+
+    def test_failed_version_fetched_again(self):
+        ''' a version whose write failed isn't skipped as already seen '''
+        db = Fake_Db(fail_first=True)
+
+        async def fetch(url, state):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, fetch_feed, url, state)
+
+        poller = System_Poller('one', f'{self.base}/same/ss.json',
+                               fetch, db.load_latest, db.write,
+                               retry_delay=0.01, scheduler=Poll_Scheduler())
+
+        async def until_skipped():
+            stop = asyncio.Event()
+
+            async def watch():
+                while poller.skips == 0:
+                    await asyncio.sleep(0.01)
+                stop.set()
+
+            await asyncio.wait_for(asyncio.gather(watch(), poller.run(stop)),
+                                   10)
+
+        run(until_skipped())
+        self.assertEqual(poller.errors, 1)
+        self.assertEqual(poller.ticks, 1)
+        self.assertEqual(poller.state.last_updated, 1501552111)
+        self.assertEqual(len(db.rows), 3)
+
+    def test_wait_before_first_version(self):
+        ''' no ttl to go on yet, so wait retry_delay '''
+        for scheduler in (None, Poll_Scheduler()):
+            poller = System_Poller('one', 'url', None, None, None,
+                                   retry_delay=7, scheduler=scheduler)
+            self.assertEqual(poller.wait(None, None, 0), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+''' tests.test_partitions '''
+
+import unittest
+from datetime import datetime
+
+from src.db.create_db_tst import get_engine
+from src.db.partitions import period_start, next_start, shift
+from src.db.partitions import get_partitions, create_partitions, drop_expired
+from src.db.partitions import DEFAULT_PARTITION
+from src.models import Station_Status, Station_Status_Latest
+from src.station_status_cdc import load_db
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+# station_status rows are from august 2017
+AUG = datetime(2017, 8, 1)
+SEP = datetime(2017, 9, 1)
+
+
+def create_status_rows(session):
+    ''' one status row for station 1 on aug 1st and one on aug 2nd,
+        loaded like the CDC does '''
+    for day, bikes in ((1501552111, 3), (1501638511, 4)):
+        load_db([Station_Status({'last_updated': day,
+                                 'station_id': 1,
+                                 'num_bikes_available': bikes,
+                                 'num_docks_available': 2,
+                                 'is_installed': 1,
+                                 'is_renting': 1,
+                                 'is_returning': 1,
+                                 'last_reported': day})], session)
+
+
+def count(connection, table):
+    return connection.execute(f'SELECT count(*) FROM {table}').scalar()
+
+
+#############
+#   Tests   #
+#############
+
+class PartitionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = get_engine()
+        self.session = get_session(env='TST', echo=False)
+
+    def tearDown(self):
+        self.session.query(Station_Status).delete()
+        self.session.commit()
+        self.session.close()
+        with self.engine.begin() as connection:
+            for name, start, _ in get_partitions(connection):
+                if start < datetime(2018, 1, 1):
+                    connection.execute(f'ALTER TABLE station_status '
+                                       f'DETACH PARTITION {name}')
+                    connection.execute(f'DROP TABLE {name}')
+            connection.execute('DROP TABLE IF EXISTS station_status_p20170801')
+
+    def test_periods(self):
+        day = datetime(2017, 12, 20, 13, 5)
+        self.assertEqual(period_start(day), datetime(2017, 12, 1))
+        self.assertEqual(next_start(datetime(2017, 12, 1)),
+                         datetime(2018, 1, 1))
+        self.assertEqual(period_start(day, 'week'), datetime(2017, 12, 18))
+        self.assertEqual(next_start(datetime(2017, 12, 18), 'week'),
+                         datetime(2017, 12, 25))
+        self.assertEqual(shift(datetime(2017, 2, 1), -3),
+                         datetime(2016, 11, 1))
+        with self.assertRaises(ValueError):
+            period_start(day, 'fortnight')
+
+    def test_create_db_partitions(self):
+        ''' create_db leaves the default plus this month and 3 ahead,
+            and rerunning creates nothing '''
+        with self.engine.begin() as connection:
+            partitions = get_partitions(connection)
+            self.assertEqual(partitions[0][1], period_start(datetime.now()))
+            self.assertGreaterEqual(len(partitions), 4)
+            self.assertEqual(create_partitions(connection), [])
+
+    def test_rows_moved_from_default(self):
+        create_status_rows(self.session)
+        with self.engine.begin() as connection:
+            self.assertEqual(count(connection, DEFAULT_PARTITION), 2)
+            created = create_partitions(connection, ahead=0, since=AUG,
+                                        now=AUG)
+            self.assertEqual(created, ['station_status_p20170801'])
+            self.assertEqual(count(connection, DEFAULT_PARTITION), 0)
+            self.assertEqual(count(connection, created[0]), 2)
+        # the latest row came along (it would have cascaded away)
+        latest = self.session.query(Station_Status_Latest).\
+            filter(Station_Status_Latest.station_id == 1).one()
+        self.assertEqual(latest.num_bikes_available, 4)
+
+    def test_drop_expired(self):
+        create_status_rows(self.session)
+        with self.engine.begin() as connection:
+            create_partitions(connection, ahead=1, since=AUG, now=AUG)
+            # september is within the last keep=1 months of october
+            dropped = drop_expired(connection, keep=1,
+                                   now=datetime(2017, 10, 5))
+            self.assertEqual(dropped, ['station_status_p20170801'])
+            names = [name for name, _, _ in get_partitions(connection)]
+            self.assertIn('station_status_p20170901', names)
+            self.assertEqual(count(connection, 'station_status'), 0)
+        self.assertEqual(self.session.query(Station_Status_Latest).count(),
+                         0)
+
+    def test_detach_only(self):
+        create_status_rows(self.session)
+        with self.engine.begin() as connection:
+            create_partitions(connection, ahead=0, since=AUG, now=AUG)
+            drop_expired(connection, keep=0, detach_only=True, now=SEP)
+            self.assertEqual(count(connection, 'station_status'), 0)
+            # still there as a plain table
+            self.assertEqual(count(connection, 'station_status_p20170801'),
+                             2)
+
+    def test_recent_window_pruned(self):
+        ''' a query on recent rows only reads their partition '''
+        this_month = period_start(datetime.now())
+        with self.engine.begin() as connection:
+            plan = '\n'.join(row[0] for row in connection.execute(
+                f'''EXPLAIN SELECT * FROM station_status
+                    WHERE last_updated >= '{this_month}'
+                    AND last_updated < '{next_start(this_month)}' '''))
+        self.assertIn(f'station_status_p{this_month:%Y%m%d}', plan)
+        self.assertNotIn(DEFAULT_PARTITION, plan)
+        self.assertNotIn(f'station_status_p{next_start(this_month):%Y%m%d}',
+                         plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+''' tests.test_registry '''
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from src.registry import Feed_Registry, is_discovery_url
+
+
+########################
+#   Helper Functions   #
+########################
+
+class Discovery_Handler(BaseHTTPRequestHandler):
+    ''' Stand-in for a system's gbfs.json. Feeds live under /v<version>/
+        so tests can move them by bumping version. '''
+
+    hits = 0
+    version = 1
+    ttl = 0
+
+    def do_GET(self):
+        if self.path != '/gbfs.json':
+            self.send_response(404)
+            self.end_headers()
+            return
+        Discovery_Handler.hits += 1
+        base = f'http://localhost:{self.server.server_port}/v{self.version}'
+        feeds = [{'name': name, 'url': f'{base}/{name}.json'}
+                 for name in ('station_status', 'station_information')]
+        body = json.dumps({'last_updated': 1501552111, 'ttl': self.ttl,
+                           'data': {'en': {'feeds': feeds}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+#############
+#   Tests   #
+#############
+
+class FeedRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        Discovery_Handler.hits = 0
+        Discovery_Handler.version = 1
+        Discovery_Handler.ttl = 0
+        self.server = HTTPServer(('localhost', 0), Discovery_Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.base = f'http://localhost:{self.server.server_port}'
+        self.discovery_url = f'{self.base}/gbfs.json'
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.cache_dir, 'feeds.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_resolves_feed(self):
+        registry = Feed_Registry(self.discovery_url)
+        self.assertEqual(registry.feed_url('station_status'),
+                         f'{self.base}/v1/station_status.json')
+        with self.assertRaises(KeyError):
+            registry.feed_url('free_bike_status')
+
+    def test_discovers_once(self):
+        registry = Feed_Registry(self.discovery_url)
+        for _ in range(3):
+            registry.feed_url('station_status')
+            registry.feed_url('station_information')
+        self.assertEqual(Discovery_Handler.hits, 1)
+
+    def test_cache_shared_between_runs(self):
+        ''' a second registry (ie the next run) reads the cache file '''
+        Feed_Registry(self.discovery_url, self.cache_file).\
+            feed_url('station_status')
+        registry = Feed_Registry(self.discovery_url, self.cache_file)
+        self.assertEqual(registry.feed_url('station_status'),
+                         f'{self.base}/v1/station_status.json')
+        self.assertEqual(Discovery_Handler.hits, 1)
+        self.assertEqual(registry.discoveries, 0)
+
+    def test_cache_keyed_by_system(self):
+        other = 'http://localhost:1/gbfs.json'
+        with open(self.cache_file, 'w') as cache_file:
+            json.dump({other: {'feeds': {'station_status': 'x'},
+                               'expires': 4102444800}}, cache_file)
+        Feed_Registry(self.discovery_url, self.cache_file).\
+            feed_url('station_status')
+        with open(self.cache_file, 'r') as cache_file:
+            cache = json.load(cache_file)
+        self.assertEqual(set(cache), {other, self.discovery_url})
+
+    def test_expired_cache_refreshed(self):
+        registry = Feed_Registry(self.discovery_url, min_ttl=0)
+        registry.feed_url('station_status')
+        Discovery_Handler.version = 2
+        self.assertEqual(registry.feed_url('station_status'),
+                         f'{self.base}/v2/station_status.json')
+        self.assertEqual(Discovery_Handler.hits, 2)
+
+    def test_invalidate_after_failure(self):
+        ''' a feed 404s because it moved, invalidating finds it again '''
+        registry = Feed_Registry(self.discovery_url, self.cache_file)
+        registry.feed_url('station_status')
+        Discovery_Handler.version = 2
+        # still cached, so the stale url is returned (and would fail)
+        self.assertIn('/v1/', registry.feed_url('station_status'))
+        response = requests.get(registry.feed_url('station_status'))
+        self.assertEqual(response.status_code, 404)
+        registry.invalidate()
+        self.assertIn('/v2/', registry.feed_url('station_status'))
+        # and the next run picks up the new url from the cache file
+        registry = Feed_Registry(self.discovery_url, self.cache_file)
+        self.assertIn('/v2/', registry.feed_url('station_status'))
+        self.assertEqual(Discovery_Handler.hits, 2)
+
+    def test_is_discovery_url(self):
+        self.assertTrue(is_discovery_url(self.discovery_url))
+        self.assertFalse(is_discovery_url(f'{self.base}/station_status.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
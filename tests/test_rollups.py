@@ -0,0 +1,99 @@
+''' tests.test_rollups '''
+
+import unittest
+from datetime import datetime
+
+from src.models import Station_Status, Station_Status_Hourly
+from src.rollups import rebuild_rollups, get_hourly
+from src.station_status_cdc import load_db
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+def at(hour, minute=0):
+    return datetime(2017, 8, 1, hour, minute)
+
+
+def status_row(when, bikes, docks):
+    timestamp = when.timestamp()
+    return Station_Status({'last_updated': timestamp,
+                           'station_id': 1,
+                           'num_bikes_available': bikes,
+                           'num_docks_available': docks,
+                           'is_installed': 1,
+                           'is_renting': 1,
+                           'is_returning': 1,
+                           'last_reported': timestamp})
+
+
+def get_rollups(session, start=at(0), end=at(23)):
+    ''' {hour: (seconds, avg bikes, min, max, empty, full)} '''
+    return {row.hour: (float(row.seconds), float(row.avg_bikes),
+                       row.min_bikes, row.max_bikes,
+                       float(row.empty_seconds), float(row.full_seconds))
+            for row in get_hourly(session, start, end, [1])}
+
+
+def empty_tables(session):
+    session.query(Station_Status_Hourly).delete()
+    session.query(Station_Status).delete()
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class RollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = get_session(env='TST', echo=False)
+        empty_tables(self.session)
+        # 6 bikes from 10:00, none from 10:30 (docks full) to 12:15
+        load_db([status_row(at(10), 6, 4)], self.session, 'copy',
+                rollups=True)
+        load_db([status_row(at(10, 30), 0, 0),
+                 status_row(at(12, 15), 9, 1)], self.session, 'values',
+                rollups=True)
+
+    def tearDown(self):
+        empty_tables(self.session)
+        self.session.close()
+
+    def test_time_weighted(self):
+        ''' each row counts until the next, split by hour,
+            and the open 12:15 row isn't counted yet '''
+        self.assertEqual(get_rollups(self.session),
+                         {at(10): (3600, 3, 0, 6, 1800, 1800),
+                          at(11): (3600, 0, 0, 0, 3600, 3600),
+                          at(12): (900, 0, 0, 0, 900, 900)})
+
+    def test_next_batch_adds(self):
+        load_db([status_row(at(12, 45), 3, 7)], self.session, 'copy',
+                rollups=True)
+        seconds, avg, low, high, _, _ = get_rollups(self.session)[at(12)]
+        self.assertEqual((seconds, avg, low, high), (2700, 6, 0, 9))
+
+    def test_rebuild_matches(self):
+        ''' a full rebuild and a rebuild of one hour in the middle
+            give what the CDC built as it went '''
+        loaded = get_rollups(self.session)
+        rebuild_rollups(self.session, at(0), at(23))
+        self.session.commit()
+        self.assertEqual(get_rollups(self.session), loaded)
+        rebuild_rollups(self.session, at(11), at(12))
+        self.session.commit()
+        self.assertEqual(get_rollups(self.session), loaded)
+        # rebuilding a range with no rows of its own still clips
+        # the span crossing it
+        self.session.query(Station_Status_Hourly).delete()
+        rebuild_rollups(self.session, at(11), at(12))
+        self.assertEqual(get_rollups(self.session),
+                         {at(11): loaded[at(11)]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+''' tests.test_scheduler '''
+
+import unittest
+from statistics import median
+
+from src.scheduler import Poll_Scheduler
+
+
+########################
+#   Helper Functions   #
+########################
+
+class Fake_Feed():
+    ''' Publishes a new version every `cadence` seconds (feed time).
+        A version becomes visible to us `delay` seconds after its
+        last_updated, and our clock is `skew` seconds ahead. '''
+
+    def __init__(self, cadence=10, delay=2, skew=0, start=1000):
+        self.cadence = cadence
+        self.delay = delay
+        self.skew = skew
+        self.start = start
+
+    def fetch(self, now):
+        ''' last_updated of the version visible at our time now '''
+        feed_now = now - self.skew - self.delay
+        versions = (feed_now - self.start) // self.cadence
+        return self.start + versions * self.cadence
+
+
+def simulate(feed, scheduler, polls, processing=0.3, ttl=10, start=1001):
+    ''' Poll the fake feed with the scheduler. Returns list of
+        (last_updated, lag, duplicate) per poll. '''
+    now = start
+    seen = None
+    out = []
+    for _ in range(polls):
+        last_updated = feed.fetch(now)
+        duplicate = seen is not None and last_updated <= seen
+        seen = max(seen or last_updated, last_updated)
+        lag = scheduler.observe(last_updated, ttl, now, processing)
+        out.append((last_updated, lag, duplicate))
+        now += processing
+        now += scheduler.next_delay(now)
+    return out
+
+
+#############
+#   Tests   #
+#############
+
+class PollSchedulerTestCase(unittest.TestCase):
+
+    def test_ttl_until_cadence_known(self):
+        scheduler = Poll_Scheduler()
+        scheduler.observe(100, 10, 103, 0.5)
+        self.assertEqual(scheduler.next_delay(104), 10)
+
+    def test_learns_cadence(self):
+        scheduler = Poll_Scheduler()
+        simulate(Fake_Feed(cadence=15), scheduler, 20)
+        self.assertEqual(scheduler.cadence(), 15)
+
+    def test_aims_after_publish(self):
+        ''' once warmed up, each version is picked up soon after it's
+            visible, not up to a full ttl later '''
+        feed = Fake_Feed(cadence=10, delay=2)
+        polls = simulate(feed, Poll_Scheduler(), 60)
+        fresh = [lag for _, lag, duplicate in polls[20:] if not duplicate]
+        # visible 2s after last_updated, so lag should stay close to that
+        self.assertLess(max(fresh), 2 + 1.5)
+        # and no versions were skipped
+        versions = sorted(set(lu for lu, _, _ in polls[20:]))
+        steps = {b - a for a, b in zip(versions, versions[1:])}
+        self.assertEqual(steps, {10})
+        # probing for the publish time costs the odd duplicate pull
+        duplicates = [duplicate for _, _, duplicate in polls[20:]]
+        self.assertLess(sum(duplicates), len(duplicates) / 4)
+
+    def test_handles_clock_skew(self):
+        feed = Fake_Feed(cadence=10, delay=1, skew=30)
+        polls = simulate(feed, Poll_Scheduler(), 60)
+        fresh = [lag for _, lag, duplicate in polls[20:] if not duplicate]
+        self.assertLess(max(fresh), 31 + 1.5)
+
+    def test_duplicates_capped(self):
+        ''' a feed that stops updating is only re-pulled max_duplicates
+            times before waiting a full ttl '''
+        scheduler = Poll_Scheduler(max_duplicates=3, retry_delay=1)
+        scheduler.observe(100, 10, 101, 0)
+        scheduler.observe(110, 10, 111, 0)
+        delays = []
+        for i in range(4):
+            scheduler.observe(110, 10, 120 + i, 0)
+            delays.append(scheduler.next_delay(120 + i))
+        self.assertEqual(delays, [1, 1, 10, 1])
+        self.assertEqual(scheduler.total_duplicates, 4)
+
+    def test_duplicate_pushes_later(self):
+        scheduler = Poll_Scheduler(margin=0.5, step=0.25)
+        scheduler.observe(100, 10, 101, 0)
+        scheduler.observe(110, 10, 111, 0)
+        scheduler.observe(110, 10, 121, 0)
+        self.assertEqual(scheduler.margin, 0.75)
+
+    def test_duplicate_before_cadence_known(self):
+        ''' the margin still widens, it isn't clamped to 0 '''
+        scheduler = Poll_Scheduler(margin=0.5, step=0.25)
+        scheduler.observe(100, 10, 101, 0)
+        scheduler.observe(100, 10, 102, 0)
+        self.assertEqual(scheduler.margin, 0.75)
+
+    def test_processing_doesnt_add_to_cycle(self):
+        ''' slow processing is absorbed into the wait, not added on top '''
+        feed = Fake_Feed(cadence=10, delay=2)
+        polls = simulate(feed, Poll_Scheduler(), 60, processing=4)
+        fresh = [lag for _, lag, duplicate in polls[20:] if not duplicate]
+        # sleeping the ttl after processing would be 2 + 4 + 10 at worst
+        self.assertLess(median(fresh), 2 + 2)
+        self.assertLess(max(fresh), 2 + 4 + 1.5)
+
+    def test_stats(self):
+        scheduler = Poll_Scheduler()
+        scheduler.observe(100, 10, 102, 0.5)
+        scheduler.observe(110, 10, 112, 0.7)
+        stats = scheduler.stats()
+        self.assertEqual(stats['polls'], 2)
+        self.assertEqual(stats['lag_median'], 2)
+        self.assertEqual(stats['cadence'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+''' tests.test_snapshots '''
+
+import unittest
+from datetime import datetime, timedelta
+
+from src.models import Station_Status
+from src.snapshots import snapshot_at, snapshots_between, clear_cache
+from src.snapshots import CACHE
+from src.station_status_cdc import load_db
+from src.status_diff import NULL_COUNT, datetime_to_micros
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+def at(hour, minute=0):
+    return datetime(2017, 8, 1, hour, minute)
+
+
+def status_row(when, station_id, bikes, disabled=0):
+    timestamp = when.timestamp()
+    record = {'last_updated': timestamp,
+              'station_id': station_id,
+              'num_bikes_available': bikes,
+              'num_docks_available': 15 - bikes,
+              'num_docks_disabled': 0,
+              'is_installed': 1,
+              'is_renting': bikes > 0,
+              'is_returning': 1,
+              'last_reported': timestamp}
+    if disabled is not None:
+        record['num_bikes_disabled'] = disabled
+    return Station_Status(record)
+
+
+def expected_at(session, when, station_ids=(1, 2, 3, 4)):
+    ''' the correlated subquery snapshot_at replaces '''
+    return session.execute(
+        '''SELECT station_id, last_updated, num_bikes_available,
+                  num_bikes_disabled, is_renting
+           FROM station_status s
+           WHERE last_updated = (SELECT max(last_updated)
+                                 FROM station_status
+                                 WHERE station_id = s.station_id
+                                 AND last_updated <= :at)
+           AND station_id = ANY(:ids)
+           ORDER BY station_id''',
+        {'at': when, 'ids': list(station_ids)}).fetchall()
+
+
+def as_rows(snapshot):
+    return [(station_id, last_updated, bikes,
+             None if disabled == NULL_COUNT else disabled, renting)
+            for station_id, last_updated, bikes, disabled, renting in zip(
+                snapshot.station_id.tolist(),
+                snapshot.last_updated.tolist(),
+                snapshot.counts['num_bikes_available'].tolist(),
+                snapshot.counts['num_bikes_disabled'].tolist(),
+                snapshot.flags['is_renting'].tolist())]
+
+
+def as_expected(rows):
+    return [(station_id, datetime_to_micros(last_updated), bikes,
+             disabled, renting)
+            for station_id, last_updated, bikes, disabled, renting in rows]
+
+
+def empty_tables(session):
+    session.query(Station_Status).delete()
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = get_session(env='TST', echo=False)
+        empty_tables(self.session)
+        clear_cache()
+        load_db([status_row(at(10), 1, 5), status_row(at(10), 2, 7),
+                 status_row(at(10, 30), 1, 0),
+                 status_row(at(11, 15), 3, 2),
+                 status_row(at(12), 2, 6, disabled=None),
+                 status_row(at(12), 1, 4),
+                 status_row(at(13, 5), 3, 1)], self.session, 'copy')
+
+    def tearDown(self):
+        empty_tables(self.session)
+        clear_cache()
+        self.session.close()
+
+    def test_snapshot_at(self):
+        for when in (at(9), at(10), at(10, 45), at(12), at(14)):
+            self.assertEqual(as_rows(snapshot_at(self.session, when)),
+                             as_expected(expected_at(self.session, when)))
+        self.assertEqual(
+            as_rows(snapshot_at(self.session, at(12), [3, 2])),
+            as_expected(expected_at(self.session, at(12), [2, 3])))
+
+    def test_cache(self):
+        first = snapshot_at(self.session, at(11))
+        self.assertIs(snapshot_at(self.session, at(11)), first)
+        self.assertFalse(first.station_id.flags.writeable)
+        # too recent to cache
+        snapshot_at(self.session, datetime.now())
+        self.assertEqual(len(CACHE), 1)
+
+    def test_snapshots_between(self):
+        step = timedelta(minutes=20)
+        for batch_rows in (1, 2, 100):
+            snapshots = list(snapshots_between(self.session, at(9, 50),
+                                               at(13), step,
+                                               batch_rows=batch_rows))
+            self.assertEqual(len(snapshots), 10)
+            for snapshot in snapshots:
+                self.assertEqual(
+                    as_rows(snapshot),
+                    as_expected(expected_at(self.session, snapshot.at)))
+        snapshots = list(snapshots_between(self.session, at(10), at(12),
+                                           timedelta(hours=1),
+                                           station_ids=[1]))
+        self.assertEqual([snapshot.at for snapshot in snapshots],
+                         [at(10), at(11), at(12)])
+        self.assertEqual([snapshot.counts['num_bikes_available'].tolist()
+                          for snapshot in snapshots], [[5], [0], [4]])
+
+    def test_snapshots_between_at_once(self):
+        ''' two walks open on one session don't share a cursor '''
+        step = timedelta(minutes=20)
+        first = snapshots_between(self.session, at(9, 50), at(13), step,
+                                  batch_rows=1)
+        second = snapshots_between(self.session, at(9, 50), at(13), step,
+                                   batch_rows=1)
+        for one, two in zip(first, second):
+            self.assertEqual(as_rows(one), as_rows(two))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+''' tests.test_spatial '''
+
+import unittest
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from src.latest_state import Latest_Status
+from src.spatial import Station_Index, nearest_available
+
+
+########################
+#   Helper Functions   #
+########################
+
+Location = namedtuple('Location', 'station_id lat lon')
+
+Status = namedtuple('Status', 'last_updated last_reported '
+                              'num_bikes_available num_bikes_disabled '
+                              'num_docks_available num_docks_disabled '
+                              'is_installed is_renting is_returning')
+
+
+def random_stations(n, seed=1):
+    ''' n stations spread over about 20km around DC '''
+    rng = np.random.default_rng(seed)
+    lats = 38.9 + rng.uniform(-0.09, 0.09, n)
+    lons = -77.03 + rng.uniform(-0.12, 0.12, n)
+    return [Location(i, lat, lon)
+            for i, (lat, lon) in enumerate(zip(lats, lons), start=1)]
+
+
+def brute_force(index, lat, lon, k, mask=None):
+    x, y = index.project(lat, lon)
+    n = len(index)
+    dist = np.hypot(index.x[:n] - x, index.y[:n] - y)
+    if mask is not None:
+        dist = np.where(mask, dist, np.inf)
+    order = np.argsort(dist, kind='stable')[:k]
+    order = order[np.isfinite(dist[order])]
+    return index.ids()[order].tolist()
+
+
+def status(bikes, renting=True):
+    now = datetime(2017, 8, 1, 12)
+    return Status(now, now, bikes, 0, 10, 0, True, renting, True)
+
+
+#############
+#   Tests   #
+#############
+
+class StationIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stations = random_stations(500)
+        # walk the grid, the scan is checked in test_scan
+        self.index = Station_Index(cell_size=400, origin_lat=38.9,
+                                   capacity=16, scan_below=0)
+        self.index.update(self.stations)
+
+    def test_knn_matches_brute_force(self):
+        for lat, lon in ((38.9, -77.03), (38.85, -77.1), (39.5, -76.0)):
+            for k in (1, 5, 50):
+                station_ids, distances = self.index.knn(lat, lon, k)
+                self.assertEqual(station_ids.tolist(),
+                                 brute_force(self.index, lat, lon, k))
+                self.assertTrue((np.diff(distances) >= 0).all())
+
+    def test_knn_mask(self):
+        mask = self.index.ids() % 3 == 0
+        station_ids, _ = self.index.knn(38.9, -77.03, 10, mask)
+        self.assertEqual(station_ids.tolist(),
+                         brute_force(self.index, 38.9, -77.03, 10, mask))
+        nothing = np.zeros(len(self.index), dtype=np.bool_)
+        self.assertEqual(len(self.index.knn(38.9, -77.03, 3, nothing)[0]), 0)
+
+    def test_scan(self):
+        index = Station_Index(origin_lat=38.9)
+        index.update(self.stations)
+        mask = index.ids() % 2 == 0
+        for lat, lon in ((38.9, -77.03), (38.85, -77.1)):
+            self.assertEqual(index.knn(lat, lon, 7)[0].tolist(),
+                             self.index.knn(lat, lon, 7)[0].tolist())
+            self.assertEqual(index.knn(lat, lon, 7, mask)[0].tolist(),
+                             self.index.knn(lat, lon, 7, mask)[0].tolist())
+
+    def test_distance(self):
+        # 0.01 degrees of latitude is about 1112m
+        index = Station_Index(origin_lat=38.9)
+        index.update([Location(1, 38.91, -77.0)])
+        _, distances = index.knn(38.9, -77.0, 1)
+        self.assertAlmostEqual(distances[0], 1112, delta=1)
+
+    def test_bbox(self):
+        box = (38.88, -77.05, 38.92, -77.0)
+        expected = sorted(s.station_id for s in self.stations
+                          if box[0] <= s.lat <= box[2] and
+                          box[1] <= s.lon <= box[3])
+        self.assertEqual(self.index.bbox(*box).tolist(), expected)
+
+    def test_update_and_remove(self):
+        # move station 1 onto the query point, and drop station 2
+        self.index.update([Location(1, 38.95, -77.0),
+                           Location(2, None, None)])
+        self.assertEqual(len(self.index), 499)
+        self.assertNotIn(2, self.index)
+        self.assertEqual(self.index.knn(38.95, -77.0, 1)[0].tolist(), [1])
+        for lat, lon in ((38.9, -77.03), (38.95, -77.0)):
+            self.assertEqual(self.index.knn(lat, lon, 20)[0].tolist(),
+                             brute_force(self.index, lat, lon, 20))
+
+    def test_nearest_available(self):
+        index = Station_Index(origin_lat=38.9)
+        index.update([Location(1, 38.900, -77.0), Location(2, 38.901, -77.0),
+                      Location(3, 38.902, -77.0), Location(4, 38.903, -77.0)])
+        latest = Latest_Status()
+        latest[1] = status(0)
+        latest[2] = status(4, renting=False)
+        latest[3] = status(2)
+        # station 4 has no status yet
+        station_ids, distances, bikes = nearest_available(
+            index, latest, 38.9, -77.0, k=2)
+        self.assertEqual(station_ids.tolist(), [3])
+        self.assertEqual(bikes.tolist(), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
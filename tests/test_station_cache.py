@@ -0,0 +1,147 @@
+''' tests.test_station_cache '''
+
+import unittest
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from src.latest_state import Latest_Status
+from src.models import Station_Status, Station_Information, System_Region
+from src.registry import Feed_Registry
+from src.station_cache import Known_Stations
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+NEW_IDS = [9201, 9202, 9203]
+
+
+class Dimension_Handler(BaseHTTPRequestHandler):
+    ''' gbfs.json plus dimension feeds with whatever is in `feeds` '''
+
+    feeds = {}
+    hits = 0
+
+    def do_GET(self):
+        name = self.path.strip('/').replace('.json', '')
+        if name == 'gbfs':
+            base = f'http://localhost:{self.server.server_port}'
+            data = {'en': {'feeds': [
+                {'name': feed, 'url': f'{base}/{feed}.json'}
+                for feed in ('system_regions', 'station_information')]}}
+        else:
+            Dimension_Handler.hits += 1
+            data = self.feeds[name]
+        body = json.dumps({'last_updated': 1501552111, 'ttl': 10,
+                           'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def publish_stations(station_ids):
+    ''' what the stand-in dimension feeds return '''
+    Dimension_Handler.feeds = {
+        'system_regions': {'regions': [{'region_id': '9201',
+                                        'name': 'new region'}]},
+        'station_information': {'stations': [
+            {'station_id': str(station_id), 'name': f'new {station_id}',
+             'lat': 38.9, 'lon': -77.0, 'region_id': 9201}
+            for station_id in station_ids]}}
+
+
+def status_row(station_id):
+    return Station_Status({'last_updated': 1501552111,
+                           'station_id': station_id,
+                           'num_bikes_available': 1,
+                           'num_docks_available': 2,
+                           'is_installed': 1,
+                           'is_renting': 1,
+                           'is_returning': 1,
+                           'last_reported': 1501552000})
+
+
+def delete_new_stations(session):
+    session.query(Station_Information).\
+        filter(Station_Information.station_id.in_(NEW_IDS)).\
+        delete(synchronize_session=False)
+    session.query(System_Region).\
+        filter(System_Region.region_id == 9201).\
+        delete(synchronize_session=False)
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class KnownStationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        Dimension_Handler.hits = 0
+        publish_stations([])
+        self.server = HTTPServer(('localhost', 0), Dimension_Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.registry = Feed_Registry(
+            f'http://localhost:{self.server.server_port}/gbfs.json')
+        self.session = get_session(env='TST', echo=False)
+        delete_new_stations(self.session)
+
+    def tearDown(self):
+        delete_new_stations(self.session)
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_known_rows_pass(self):
+        known = Known_Stations(self.session, self.registry)
+        rows = [status_row(station_id) for station_id in known.ids]
+        self.assertEqual(known.filter(rows, Latest_Status()), rows)
+        self.assertEqual(known.refreshes, 0)
+
+    def test_new_stations_loaded(self):
+        ''' a burst of new stations is one refresh, then rows are kept '''
+        known = Known_Stations(self.session, self.registry)
+        publish_stations(NEW_IDS[:2])
+        rows = [status_row(station_id) for station_id in NEW_IDS[:2]]
+        self.assertEqual(known.filter(rows, Latest_Status()), rows)
+        self.assertEqual(known.refreshes, 1)
+        # one request per dimension feed
+        self.assertEqual(Dimension_Handler.hits, 2)
+        loaded = self.session.query(Station_Information.station_id).\
+            filter(Station_Information.station_id.in_(NEW_IDS)).count()
+        self.assertEqual(loaded, 2)
+
+    def test_still_unknown_dropped(self):
+        ''' stations the feed doesn't have yet are dropped and forgotten,
+            and another refresh waits for min_interval '''
+        known = Known_Stations(self.session, self.registry, min_interval=60)
+        old_id = next(iter(known.ids))
+        latest = Latest_Status()
+        rows = [status_row(old_id), status_row(NEW_IDS[2])]
+        for row in rows:
+            latest[row.station_id] = row
+        self.assertEqual(known.filter(rows, latest), rows[:1])
+        self.assertNotIn(NEW_IDS[2], latest)
+        self.assertIn(old_id, latest)
+        self.assertEqual(known.dropped, 1)
+        # published now, but the refresh is debounced
+        publish_stations(NEW_IDS[2:])
+        self.assertEqual(known.filter(rows[1:], latest), [])
+        self.assertEqual(known.refreshes, 1)
+        known.min_interval = 0
+        self.assertEqual(known.filter(rows[1:], latest), rows[1:])
+        self.assertEqual(known.refreshes, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
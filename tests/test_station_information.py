@@ -1,12 +1,13 @@
 ''' tests.test_station_information'''
 
 import unittest
+from decimal import Decimal
 from os import environ
 
 from sqlalchemy import delete
 import psycopg2
 
-from src.bikeshare_etl import get_data, compare_data, etl
+from src.bikeshare_etl import get_data, compare_data, etl, upsert_data
 from src.models import Load_Metadata, System_Region, Station_Information
 from src.utils import get_session
 from src.db.create_db_tst import create_db, drop_all_tables
@@ -302,5 +303,41 @@ class StationInformationTestCase(unittest.TestCase):
         empty_table_station_information(session)
         session.close()
 
+    def test_row_hash(self):
+        ''' row_hash follows __eq__: same attributes hash the same,
+            including lat/lon read back as Decimal '''
+        s1 = create_dummy_station()
+        s2 = create_dummy_station()
+        s2.load_id = 77
+        s2.lat = Decimal('100.1')
+        self.assertEqual(s1.row_hash, s2.calc_row_hash())
+        s2.rental_method_key = False
+        self.assertNotEqual(s1.row_hash, s2.calc_row_hash())
+        s3 = create_dummy_station(name='other')
+        self.assertNotEqual(s1.row_hash, s3.row_hash)
+
+    def test_upsert_unchanged_station(self):
+        ''' reloading the same station shouldn't count as an update,
+            lat/lon come back from the db as Decimal '''
+        session = get_session(env='TST', echo=False)
+        counts = []
+        for load in range(3):
+            metadata = create_metadata(Station_Information, session)
+            station = create_dummy_station()
+            station.region_id = None
+            if load == 2:
+                station.rental_method_phone = True
+            station.load_id = metadata.load_id
+            upsert_data({station.id: station}, Station_Information,
+                        metadata, session)
+            session.commit()
+            counts.append((metadata.inserts, metadata.updates))
+        self.assertEqual(counts, [(1, 0), (0, 0), (0, 1)])
+        session.query(Station_Information).\
+            filter(Station_Information.station_id == 9999).delete()
+        session.commit()
+        session.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,177 @@
+''' tests.test_status_diff '''
+
+import os
+import time
+import unittest
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from src.station_status_cdc import get_changed_data
+from src.status_diff import decode_feed, align_records, changed_mask
+from src.status_diff import datetime_to_micros, wall_micros_to_micros
+from src.status_diff import column_sql, column_array, NULL_COUNT
+from src.models import Station_Status
+
+
+########################
+#   Helper Functions   #
+########################
+
+def get_json_from_file(filename):
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+def get_latest_from_file(filename):
+    ''' dict of Station_Status like get_latest_from_db would return '''
+    data = get_json_from_file(filename)
+    latest = {}
+    for row in data['data']['stations']:
+        row['last_updated'] = data['last_updated']
+        record = Station_Status(row)
+        latest[record.station_id] = record
+    return latest
+
+
+def create_feed(*stations, last_updated=1501552111):
+    return {'last_updated': last_updated,
+            'ttl': 10,
+            'data': {'stations': list(stations)}}
+
+
+def create_station(station_id='1', bikes=5, tstmp=1501546327, **kwargs):
+    row = {'station_id': station_id,
+           'num_bikes_available': bikes,
+           'num_bikes_disabled': 0,
+           'num_docks_available': 10,
+           'num_docks_disabled': 0,
+           'is_installed': 1,
+           'is_renting': 1,
+           'is_returning': 1,
+           'last_reported': tstmp}
+    row.update(kwargs)
+    return row
+
+
+#############
+#   Tests   #
+#############
+
+class StatusDiffTestCase(unittest.TestCase):
+
+    def test_decode_feed(self):
+        ''' each compared attribute should become an array '''
+        cols = decode_feed(get_json_from_file('tests/dummy1.json'))
+        self.assertEqual(cols.station_id.tolist(), [1, 2, 3])
+        self.assertEqual(cols.counts['num_bikes_available'].tolist(),
+                         [6, 12, 2])
+        self.assertEqual(cols.flags['is_installed'].tolist(),
+                         [True, True, False])
+
+    def test_matches_desired(self):
+        ''' diffing dummy1 -> dummy2 -> dummy3 should give the same rows
+            as the desired file (same as test_cdc.test_comparison) '''
+        latest = get_latest_from_file('tests/dummy1.json')
+        rows = list(latest.values())
+        out, latest = get_changed_data(
+            get_json_from_file('tests/dummy2.json'), latest)
+        rows += out
+        out, latest = get_changed_data(
+            get_json_from_file('tests/dummy3.json'), latest)
+        rows += out
+        rows.sort(key=lambda r: (r.station_id, r.last_updated))
+        desired = get_json_from_file('tests/desired.json')['stations']
+        self.assertEqual(len(rows), len(desired))
+        for row, should_be in zip(rows, desired):
+            should_be = Station_Status(should_be)
+            self.assertEqual(row.to_tuple()[1:-1],
+                             should_be.to_tuple()[1:-1])
+
+    def test_unchanged_not_flagged(self):
+        feed = create_feed(create_station('1'), create_station('2'))
+        latest = {1: Station_Status(dict(create_station('1'),
+                                         last_updated=1)),
+                  2: Station_Status(dict(create_station('2'),
+                                         last_updated=1))}
+        new = decode_feed(feed)
+        old, present = align_records(latest, new.station_id)
+        self.assertFalse(changed_mask(new, old, present).any())
+
+    def test_missing_optionals_are_equal(self):
+        ''' None == None for optional counts, like Station_Status.__eq__ '''
+        station = create_station('1')
+        del station['num_bikes_disabled']
+        latest = {1: Station_Status(dict(station, last_updated=1))}
+        out, latest = get_changed_data(create_feed(dict(station)), latest)
+        self.assertEqual(out, [])
+
+    def test_only_changed_rows_returned(self):
+        latest = {1: Station_Status(dict(create_station('1'),
+                                         last_updated=1)),
+                  2: Station_Status(dict(create_station('2'),
+                                         last_updated=1))}
+        feed = create_feed(create_station('1'),
+                           create_station('2', bikes=4),
+                           create_station('3'))
+        out, latest = get_changed_data(feed, latest)
+        self.assertEqual([r.station_id for r in out], [2, 3])
+        self.assertEqual(latest[2].num_bikes_available, 4)
+
+    def test_duplicate_station_in_feed(self):
+        ''' duplicates are compared in feed order, one after another '''
+        latest = {1: Station_Status(dict(create_station('1'),
+                                         last_updated=1))}
+        feed = create_feed(create_station('1', bikes=2),
+                           create_station('1'))
+        out, latest = get_changed_data(feed, latest)
+        self.assertEqual([r.num_bikes_available for r in out], [2, 5])
+
+    def test_empty_feed(self):
+        new = decode_feed(create_feed())
+        old, present = align_records({}, new.station_id)
+        mask = changed_mask(new, old, present)
+        self.assertEqual(mask.dtype, np.bool_)
+        self.assertEqual(len(mask), 0)
+
+    def test_wall_micros_to_micros(self):
+        ''' same as datetime_to_micros, across DST changes '''
+        old_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            times = [datetime(2017, 3, 12) + timedelta(minutes=7 * i)
+                     for i in range(100)]
+            times += [datetime(2017, 11, 5) + timedelta(minutes=7 * i,
+                                                        microseconds=i)
+                      for i in range(100)]
+            wall = np.array([(t - datetime(1970, 1, 1)) //
+                             timedelta(microseconds=1) for t in times])
+            self.assertEqual(wall_micros_to_micros(wall).tolist(),
+                             [datetime_to_micros(t) for t in times])
+        finally:
+            if old_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = old_tz
+            time.tzset()
+
+    def test_column_array(self):
+        ''' fetched columns as the arrays status_diff works with '''
+        self.assertEqual(column_sql('last_updated', 's'),
+                         '(extract(epoch FROM s.last_updated) '
+                         '* 1000000)::bigint')
+        self.assertEqual(column_sql('station_id', 's'), 's.station_id')
+        self.assertEqual(column_array('num_bikes_disabled',
+                                      (3, None)).tolist(), [3, NULL_COUNT])
+        self.assertEqual(column_array('is_renting', (1, 0)).dtype, np.bool_)
+        self.assertEqual(column_array('station_id', ()).dtype, np.int64)
+        wall = (datetime(2017, 8, 1, 9) - datetime(1970, 1, 1)) //\
+            timedelta(microseconds=1)
+        self.assertEqual(column_array('last_reported', (wall,)).tolist(),
+                         [datetime_to_micros(datetime(2017, 8, 1, 9))])
+
+
+if __name__ == '__main__':
+    unittest.main()
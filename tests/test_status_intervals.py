@@ -0,0 +1,100 @@
+''' tests.test_status_intervals '''
+
+import unittest
+import json
+from datetime import datetime
+
+from src.models import Station_Status, Station_Status_Interval
+from src.station_status_cdc import load_db
+from src.status_intervals import rebuild_intervals, status_at
+from src.utils import get_session
+
+
+########################
+#   Helper Functions   #
+########################
+
+def get_records_from_file(filename):
+    ''' build Station_Status objects from a dummy file '''
+    with open(filename, 'r') as json_file:
+        data = json.load(json_file)
+    out = []
+    for row in data['data']['stations']:
+        row['last_updated'] = data['last_updated']
+        out.append(Station_Status(row))
+    return out
+
+
+def get_intervals(session):
+    ''' {station_id: [(valid_from, valid_to, bikes)]} '''
+    intervals = {}
+    for row in session.query(Station_Status_Interval).\
+            order_by(Station_Status_Interval.station_id,
+                     Station_Status_Interval.valid_from):
+        intervals.setdefault(row.station_id, []).append(
+            (row.valid_from, row.valid_to, row.num_bikes_available))
+    return intervals
+
+
+def ts(timestamp):
+    return datetime.fromtimestamp(timestamp)
+
+
+def empty_tables(session):
+    session.query(Station_Status_Interval).delete()
+    session.query(Station_Status).delete()
+    session.commit()
+
+
+#############
+#   Tests   #
+#############
+
+class StatusIntervalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = get_session(env='TST', echo=False)
+        empty_tables(self.session)
+        # dummy2 and dummy3 go in one batch, like a group commit flush
+        load_db(get_records_from_file('tests/dummy1.json'), self.session,
+                mode='copy', intervals=True)
+        load_db(get_records_from_file('tests/dummy2.json') +
+                get_records_from_file('tests/dummy3.json'), self.session,
+                mode='values', intervals=True)
+
+    def tearDown(self):
+        empty_tables(self.session)
+        self.session.close()
+
+    def test_intervals_chain(self):
+        ''' each row ends where the station's next row starts,
+            and only the newest is open '''
+        t1, t2, t3 = ts(1501552111), ts(1501554111), ts(1501555111)
+        self.assertEqual(get_intervals(self.session),
+                         {1: [(t1, t2, 6), (t2, t3, 9), (t3, None, 9)],
+                          2: [(t1, t2, 12), (t2, None, 12)],
+                          3: [(t1, t2, 2), (t2, t3, 2), (t3, None, 2)],
+                          4: [(t3, None, 2)]})
+
+    def test_status_at(self):
+        self.assertEqual(status_at(self.session, 1,
+                                   ts(1501553000)).num_bikes_available, 6)
+        # valid_from is inclusive, valid_to isn't
+        self.assertEqual(status_at(self.session, 1,
+                                   ts(1501554111)).num_bikes_available, 9)
+        self.assertIsNone(status_at(self.session, 4, ts(1501553000)))
+        self.assertEqual(status_at(self.session, 2,
+                                   datetime.now()).valid_from,
+                         ts(1501554111))
+
+    def test_rebuild_matches(self):
+        ''' rebuilding from station_status gives the same intervals
+            as loading them as we went '''
+        loaded = get_intervals(self.session)
+        rebuild_intervals(self.session)
+        self.session.commit()
+        self.assertEqual(get_intervals(self.session), loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,7 @@ from os import environ
 from sqlalchemy import delete
 import psycopg2
 
-from src.bikeshare_etl import get_data, compare_data, etl
+from src.bikeshare_etl import get_data, compare_data, etl, upsert_data
 from src.models import Load_Metadata, System_Region
 from src.utils import get_session
 from src.db.create_db_tst import create_db, drop_all_tables
@@ -45,6 +45,23 @@ def create_dummy_region(name='test_region'):
     return sr
 
 
+def create_regions(names, load_id):
+    ''' {region_id: System_Region} for region_ids starting at 9001 '''
+    regions = {}
+    for i, name in enumerate(names):
+        region = System_Region({'region_id': 9001 + i, 'name': name})
+        region.load_id = load_id
+        regions[region.id] = region
+    return regions
+
+
+def delete_regions(regions, session):
+    session.query(System_Region).\
+        filter(System_Region.region_id.in_(list(regions))).\
+        delete(synchronize_session=False)
+    session.commit()
+
+
 def create_metadata(model, session):
     return Load_Metadata(model.__tablename__, session)
 
@@ -243,5 +260,79 @@ class SystemRegionTestCase(unittest.TestCase):
         empty_db(session)
         session.close()
 
+    def test_upsert_data(self):
+        ''' set based upsert inserts new, updates changed,
+            leaves matching rows alone, and counts each '''
+        session = get_session(env='TST', echo=False)
+        metadata = create_metadata(System_Region, session)
+        first = create_regions(['a', 'b'], metadata.load_id)
+        upsert_data(dict(first), System_Region, metadata, session)
+        session.commit()
+        self.assertEqual((metadata.inserts, metadata.updates), (2, 0))
+        m2 = create_metadata(System_Region, session)
+        second = create_regions(['a', 'changed', 'c'], m2.load_id)
+        upsert_data(dict(second), System_Region, m2, session)
+        session.commit()
+        self.assertEqual((m2.inserts, m2.updates), (1, 1))
+        db_rows = {r.region_id: (r.region_name, r.transtype, r.load_id)
+                   for r in session.query(System_Region).
+                   filter(System_Region.region_id.in_(list(second)))}
+        self.assertEqual(db_rows,
+                         {9001: ('a', 'I', metadata.load_id),
+                          9002: ('changed', 'U', m2.load_id),
+                          9003: ('c', 'I', m2.load_id)})
+        user = session.query(System_Region.modified_by).\
+            filter(System_Region.region_id == 9002).scalar()
+        self.assertEqual(user, environ['POSTGRES_USER_TST'])
+        delete_regions(second, session)
+        session.close()
+
+    def test_upsert_matches_compare(self):
+        ''' upsert_data and compare_data leave the same rows behind '''
+        session = get_session(env='TST', echo=False)
+        results = []
+        for load in (compare_data, upsert_data):
+            metadata = create_metadata(System_Region, session)
+            load(create_regions(['a', 'b'], metadata.load_id),
+                 System_Region, metadata, session)
+            session.commit()
+            m2 = create_metadata(System_Region, session)
+            regions = create_regions(['a', 'changed', 'c'], m2.load_id)
+            load(dict(regions), System_Region, m2, session)
+            session.commit()
+            rows = session.query(System_Region.region_id,
+                                 System_Region.region_name,
+                                 System_Region.transtype).\
+                filter(System_Region.region_id.in_(list(regions))).\
+                order_by(System_Region.region_id).all()
+            results.append((rows, m2.inserts, m2.updates))
+            delete_regions(regions, session)
+        self.assertEqual(results[0], results[1])
+        session.close()
+
+    def test_modified_by_set_in_place(self):
+        ''' the trigger sets modified_by on the row being updated,
+            without updating it a second time '''
+        session = get_session(env='TST', echo=False)
+        metadata = create_metadata(System_Region, session)
+        regions = create_regions(['a', 'b'], metadata.load_id)
+        upsert_data(dict(regions), System_Region, metadata, session)
+        session.commit()
+        conn, cur = get_connection_and_cursor()
+        cur.execute('''UPDATE system_regions
+                       SET region_name = 'renamed', modified_by = 'nobody'
+                       WHERE region_id IN (9001, 9002);''')
+        cur.execute('''SELECT n_tup_upd FROM pg_stat_xact_user_tables
+                       WHERE relname = 'system_regions';''')
+        self.assertEqual(cur.fetchone()[0], 2)
+        conn.commit()
+        cur.execute('''SELECT DISTINCT modified_by FROM system_regions
+                       WHERE region_id IN (9001, 9002);''')
+        self.assertEqual(cur.fetchall(), [(environ['POSTGRES_USER_TST'],)])
+        conn.close()
+        delete_regions(regions, session)
+        session.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,53 @@
+''' tests.test_timing '''
+
+import unittest
+from time import sleep
+
+from src.timing import Phase_Timer
+
+
+#############
+#   Tests   #
+#############
+
+class PhaseTimerTestCase(unittest.TestCase):
+
+    def test_phases_in_order(self):
+        timer = Phase_Timer()
+        with timer.phase('fetch') as fetch:
+            fetch.bytes = 100
+        with timer.phase('parse'):
+            pass
+        self.assertEqual(list(timer.phases), ['fetch', 'parse'])
+        self.assertEqual(timer.phases['fetch'].bytes, 100)
+
+    def test_same_phase_adds_up(self):
+        timer = Phase_Timer()
+        for _ in range(2):
+            with timer.phase('load'):
+                sleep(0.01)
+        self.assertGreaterEqual(timer.secs('load'), 0.02)
+        self.assertEqual(timer.secs('never'), 0)
+
+    def test_timed_on_error(self):
+        timer = Phase_Timer()
+        with self.assertRaises(ValueError):
+            with timer.phase('load'):
+                sleep(0.01)
+                raise ValueError('boom')
+        self.assertGreaterEqual(timer.secs('load'), 0.01)
+
+    def test_rows_per_sec(self):
+        timer = Phase_Timer()
+        with timer.phase('transform') as transform:
+            sleep(0.01)
+            transform.rows = 10
+        rate = timer.phases['transform'].rows_per_sec()
+        self.assertGreater(rate, 0)
+        self.assertLessEqual(rate, 1000)
+        self.assertIn('transform', timer.report())
+        self.assertIn('rows/s', timer.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,9 +4,21 @@ test.test_utils
 
 import unittest
 
+from sqlalchemy.exc import InternalError, TimeoutError as Pool_Timeout
 from sqlalchemy.orm.session import Session
 
-from src.utils import get_session
+from src.utils import get_session, get_engine, configure_engine
+from src.utils import get_sessionmaker, pool_stats, POOL_DEFAULTS
+from src.utils import Timed_Pool
+
+
+########################
+#   Helper Functions   #
+########################
+
+def broken_connect():
+    raise ConnectionError('no database')
+
 
 #############
 #   Tests   #
@@ -15,9 +27,63 @@ from src.utils import get_session
 
 class UtilsTestCase(unittest.TestCase):
 
+    def tearDown(self):
+        configure_engine('TST', 'read', **POOL_DEFAULTS)
+
     def test_get_session_returns_Session(self):
         self.assertIsInstance(get_session(env='TST'), Session)
 
+    def test_engine_shared(self):
+        self.assertIs(get_engine('TST'), get_engine('TST'))
+        self.assertIs(get_session(env='TST').bind, get_engine('TST'))
+        self.assertIsNot(get_engine('TST', 'read'), get_engine('TST'))
+
+    def test_echo_not_shared(self):
+        session = get_session(env='TST', echo=True)
+        self.assertTrue(session.bind.echo)
+        self.assertIs(session.bind.pool, get_engine('TST').pool)
+        self.assertFalse(get_engine('TST').echo)
+        self.assertFalse(get_session(env='TST').bind.echo)
+        session.close()
+
+    def test_timeouts_counted(self):
+        Session = get_sessionmaker('TST', role='read', pool_size=1,
+                                   max_overflow=0, pool_timeout=0.1)
+        session = Session()
+        session.execute('SELECT 1')
+        with self.assertRaises(Pool_Timeout):
+            get_engine('TST', 'read').connect()
+        self.assertEqual(pool_stats()[('TST', 'read')]['timeouts'], 1)
+        session.close()
+
+    def test_connect_errors_not_timeouts(self):
+        pool = Timed_Pool(broken_connect)
+        with self.assertRaises(ConnectionError):
+            pool.connect()
+        self.assertEqual(pool.stats()['timeouts'], 0)
+        self.assertEqual(pool.stats()['checkouts'], 1)
+
+    def test_read_engine_is_read_only(self):
+        session = get_session(env='TST', role='read')
+        self.assertEqual(session.execute('SELECT 1').scalar(), 1)
+        with self.assertRaises(InternalError):
+            session.execute('CREATE TEMP TABLE t (i integer)')
+        session.close()
+
+    def test_configure(self):
+        Session = get_sessionmaker('TST', role='read', pool_size=1,
+                                   max_overflow=0, statement_timeout=1234)
+        session = Session()
+        self.assertEqual(session.execute('SHOW statement_timeout').scalar(),
+                         '1234ms')
+        stats = pool_stats()[('TST', 'read')]
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['checkouts'], 1)
+        session.close()
+        with self.assertRaises(ValueError):
+            configure_engine('TST', pool_sise=3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,180 @@
+''' tests.test_write_buffer '''
+
+import unittest
+import threading
+from time import sleep, monotonic
+
+from src.write_buffer import Write_Buffer
+
+
+########################
+#   Helper Functions   #
+########################
+
+class Dummy_Session():
+    ''' stands in for a sqlalchemy session '''
+
+    def __init__(self):
+        self.rollbacks = 0
+        self.closed = False
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class Recording_Load():
+    ''' load function that remembers each batch it was given.
+        Fails the first `failures` calls, and can be made slow. '''
+
+    def __init__(self, failures=0, delay=0):
+        self.batches = []
+        self.failures = failures
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def __call__(self, rows, session):
+        sleep(self.delay)
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError('db went away')
+            self.batches.append(list(rows))
+
+    def rows(self):
+        return [row for batch in self.batches for row in batch]
+
+
+def wait_for(condition, timeout=5):
+    end = monotonic() + timeout
+    while not condition() and monotonic() < end:
+        sleep(0.01)
+    return condition()
+
+
+#############
+#   Tests   #
+#############
+
+class WriteBufferTestCase(unittest.TestCase):
+
+    def test_flush_on_close(self):
+        ''' nothing written until close, then everything in order '''
+        load = Recording_Load()
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=100, max_age=60)
+        buffer.add([1, 2])
+        buffer.add([3])
+        sleep(0.1)
+        self.assertEqual(load.batches, [])
+        buffer.close()
+        self.assertEqual(load.rows(), [1, 2, 3])
+        self.assertEqual(buffer.flushes, 1)
+
+    def test_flush_on_row_count(self):
+        load = Recording_Load()
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=3, max_age=60)
+        buffer.add([1, 2])
+        buffer.add([3, 4])
+        self.assertTrue(wait_for(lambda: len(load.batches) == 1))
+        self.assertEqual(load.batches[0], [1, 2, 3, 4])
+        buffer.close()
+
+    def test_flush_on_age(self):
+        load = Recording_Load()
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=100, max_age=0.1)
+        buffer.add([1])
+        self.assertTrue(wait_for(lambda: len(load.batches) == 1))
+        buffer.close()
+        self.assertEqual(load.rows(), [1])
+
+    def test_empty_ticks_ignored(self):
+        load = Recording_Load()
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=1, max_age=60)
+        buffer.add([])
+        buffer.close()
+        self.assertEqual(load.batches, [])
+
+    def test_failed_flush_retried(self):
+        ''' rows from a failed flush are kept and written next time '''
+        load = Recording_Load(failures=1)
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=1, max_age=60,
+                              retry_delay=0.01)
+        buffer.add([1])
+        self.assertTrue(wait_for(lambda: len(load.batches) == 1))
+        buffer.close()
+        self.assertEqual(load.rows(), [1])
+        self.assertEqual(buffer.failures, 1)
+
+    def test_slow_db_batches_up(self):
+        ''' while a slow flush runs, ticks queue up and go in the next
+            flush together instead of blocking add '''
+        load = Recording_Load(delay=0.2)
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=1, max_age=60)
+        start = monotonic()
+        for i in range(5):
+            buffer.add([i])
+        self.assertLess(monotonic() - start, 0.2)
+        buffer.close()
+        self.assertEqual(load.rows(), [0, 1, 2, 3, 4])
+        self.assertLess(len(load.batches), 5)
+
+    def test_backpressure(self):
+        ''' add blocks once max_batches ticks are waiting '''
+        load = Recording_Load(delay=0.3)
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=1, max_age=60,
+                              max_batches=1)
+        buffer.add([1])
+        # give the writer time to pick up the first batch
+        sleep(0.05)
+        buffer.add([2])
+        start = monotonic()
+        buffer.add([3])
+        self.assertGreater(monotonic() - start, 0.1)
+        buffer.close()
+        self.assertEqual(load.rows(), [1, 2, 3])
+
+    def test_no_draining_while_retrying(self):
+        ''' a failing flush stops taking ticks, so add blocks '''
+        load = Recording_Load(failures=3)
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=1, max_age=60,
+                              max_batches=1, retry_delay=0.1)
+        buffer.add([1])
+        sleep(0.05)
+        buffer.add([2])
+        start = monotonic()
+        buffer.add([3])
+        self.assertGreater(monotonic() - start, 0.1)
+        buffer.close()
+        self.assertEqual(load.rows(), [1, 2, 3])
+        self.assertEqual(load.batches[0], [1])
+        self.assertEqual(buffer.failures, 3)
+
+    def test_dead_letter_after_max_retries(self):
+        ''' rows that keep failing are given up on, later rows still go in '''
+        load = Recording_Load(failures=3)
+        dead = []
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=1, max_age=60,
+                              retry_delay=0.01, max_retries=3,
+                              dead_letter=dead.append)
+        buffer.add([1, 2])
+        self.assertTrue(wait_for(lambda: dead == [[1, 2]]))
+        buffer.add([3])
+        buffer.close()
+        self.assertEqual(load.rows(), [3])
+        self.assertEqual(buffer.dead_rows, 2)
+
+    def test_close_gives_up_eventually(self):
+        ''' close doesn't hang on a database that never comes back '''
+        load = Recording_Load(failures=100)
+        buffer = Write_Buffer(load, Dummy_Session, max_rows=100, max_age=60,
+                              retry_delay=0.01, max_retries=2)
+        buffer.add([1])
+        buffer.close()
+        self.assertEqual(buffer.dead_letters, [[1]])
+        self.assertEqual(buffer.failures, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()